@@ -1,7 +1,13 @@
+import math
+import threading
 import time
-from collections import Counter
+from array import array
+from collections import Counter, deque
 from random import random
 
+from bashtasks.csv_writer import CsvWriter, DEFAULT_FLUSH_INTERVAL
+from bashtasks.message import is_batch, unpack_responses
+
 
 def currtimemillis():
     return int(round(time.time() * 1000))
@@ -18,6 +24,14 @@ def time_waiting(msg):
 def time_executing(msg):
     return msg['post_command_ts'] - msg['pre_command_ts']
 
+
+def get_error_summary(msg):
+    """ :return: <dict> error_fields of msg and the tail of its stderr.
+    """
+    summary = dict((field, msg[field]) for field in error_fields if field in msg)
+    summary['stderr'] = (msg.get('stderr') or '')[-ERROR_STDERR_CHARS:]
+    return summary
+
 csv_fields = (
     "request_ts",
     "correlation_id",
@@ -31,109 +45,317 @@ csv_fields = (
     "non_retriable"
 )
 
+# csv_fields kept in array('d') columns when samples are retained, the rest in lists.
+numeric_fields = ("request_ts", "correlation_id", "pre_command_ts", "post_command_ts",
+                  "returncode", "retries", "max_retries")
+MISSING = float('nan')
+
 DEFAULT_CSV = 'stats_bashtasks.csv'
+DEFAULT_MAX_ERRORS = 100  # last errors kept without samples
+ERROR_STDERR_CHARS = 1024  # stderr tail kept per error without samples
+error_fields = ("correlation_id", "returncode", "executor_name", "command")
+HISTOGRAM_PRECISION = 0.02  # relative error of percentiles
+
+
+class LatencyHistogram:
+    """ mergeable histogram of non negative times (ms), log sized buckets.
+        percentiles have HISTOGRAM_PRECISION relative error, memory depends on the value range
+        only: a few hundred buckets at most.
+    """
+    log_base = math.log(1 + HISTOGRAM_PRECISION)
+
+    def __init__(self):
+        self.buckets = Counter()  # bucket index -> count
+        self.count = 0
+
+    @classmethod
+    def bucket_of(cls, value):
+        if value < 1:
+            return 0
+        return int(math.log(value) / cls.log_base) + 1
+
+    @classmethod
+    def bucket_value(cls, bucket):
+        """ :return: representative (mid) value of bucket
+        """
+        if bucket == 0:
+            return 0
+        low = math.exp((bucket - 1) * cls.log_base)
+        high = math.exp(bucket * cls.log_base)
+        return int(round((low + high) / 2))
+
+    def add(self, value):
+        self.buckets[self.bucket_of(value)] += 1
+        self.count += 1
+
+    def merge(self, other):
+        self.buckets.update(other.buckets)
+        self.count += other.count
+
+    def percentile(self, p):
+        """ p: 0-100. :return: value at percentile p, 0 if empty.
+        """
+        if not self.count:
+            return 0
+        rank = max(1, int(math.ceil(self.count * p / 100.0)))
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return self.bucket_value(bucket)
+        return self.bucket_value(max(self.buckets))
+
+
+class StreamingStat:
+    """ running count, sum, min, max and histogram of a time.
+    """
+    def __init__(self):
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        self.histogram = LatencyHistogram()
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.histogram.add(value)
+
+    def merge(self, other):
+        self.count += other.count
+        self.sum += other.sum
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+        self.histogram.merge(other.histogram)
+
+    def avg(self):
+        """ :return: integer average, as TaskStatistics always did. 0 if empty.
+        """
+        if self.sum:
+            return self.sum // self.count
+        else:
+            return 0
+
+    def maximum(self):
+        return self.max if self.max is not None else 0
+
+    def percentile(self, p):
+        return self.histogram.percentile(p)
+
+
+class SampleColumns:
+    """ csv_fields of every tracked msg, column wise: numbers in arrays, text in lists.
+        stdout, stderr and other fields are not retained.
+    """
+    def __init__(self):
+        self.numeric = dict((field, array('d')) for field in numeric_fields)
+        self.other = dict((field, []) for field in csv_fields if field not in numeric_fields)
+        self.missing = {}  # field -> set of row indexes where msg did not have the field
+        self.size = 0
+
+    def append(self, msg):
+        for field, column in self.numeric.items():
+            value = msg.get(field)
+            column.append(MISSING if value is None else value)
+            if value is None:
+                self.missing.setdefault(field, set()).add(self.size)
+        for field, column in self.other.items():
+            if field not in msg:
+                self.missing.setdefault(field, set()).add(self.size)
+            column.append(msg.get(field))
+        self.size += 1
+
+    def extend(self, other):
+        for field in self.numeric:
+            self.numeric[field].extend(other.numeric[field])
+        for field in self.other:
+            self.other[field].extend(other.other[field])
+        for field, rows in other.missing.items():
+            self.missing.setdefault(field, set()).update(row + self.size for row in rows)
+        self.size += other.size
+
+    def row(self, i):
+        """ :return: <dict> csv_fields of the i-th msg, as tracked.
+        """
+        row = {}
+        for field, column in self.numeric.items():
+            if i not in self.missing.get(field, ()):
+                value = column[i]
+                row[field] = int(value) if value.is_integer() else value
+        for field, column in self.other.items():
+            if i not in self.missing.get(field, ()):
+                row[field] = column[i]
+        return row
+
+    def rows(self):
+        return (self.row(i) for i in range(self.size))
 
 
 class TaskStatistics:
-    def __init__(self, csvAuto=False, csvFileName=DEFAULT_CSV, csvPersistenceRatio=0.2):
-        self.msgs = []
+    def __init__(self, csvAuto=False, csvFileName=DEFAULT_CSV, csvPersistenceRatio=0.2,
+                 keepSamples=False, csvFlushInterval=DEFAULT_FLUSH_INTERVAL, csvRotateBytes=None,
+                 csvGzip=False, maxErrors=DEFAULT_MAX_ERRORS):
+        """ keepSamples: retain csv_fields of every msg (in compact columns), needed by msgs,
+            toCsv and the all* generators, and error msgs whole. Summaries never need them:
+            by default memory stays constant however many msgs are tracked.
+            maxErrors: without keepSamples, allErrors keeps the last maxErrors errors only,
+            summarized (see get_error_summary).
+            csvAuto: tracked msgs are written to csvFileName by a background CsvWriter,
+            flushed at least every csvFlushInterval secs. See csv_writer for csvRotateBytes
+            and csvGzip. csvPersistenceRatio only applies to writeCsvMessage.
+        """
         self.firstMsgTs = 0
         self.csvAuto = csvAuto
         self.csvFileName = csvFileName
         self.csvFile = None  # lazy initialized
+        self.csvWriter = None  # lazy initialized, when csvAuto
         self.csvPersistenceRatio = csvPersistenceRatio
+        self.csvFlushInterval = csvFlushInterval
+        self.csvRotateBytes = csvRotateBytes
+        self.csvGzip = csvGzip
+        self.keepSamples = keepSamples
+        self.samples = SampleColumns() if keepSamples else None
+        self.count = 0
+        self.errors = 0
+        self.errorMsgs = [] if keepSamples else deque(maxlen=maxErrors)
+        self.timesToExecuted = StreamingStat()
+        self.executionTimes = StreamingStat()
+        self.timesWaiting = StreamingStat()
+        self.workersCounter = Counter()
+        self.returnCodesCounter = Counter()
 
     @staticmethod
     def csvFields():
         return csv_fields
 
+    @property
+    def msgs(self):
+        """ csv_fields of tracked msgs, rebuilt from samples, only with keepSamples.
+            O(n): prefer summary methods.
+        """
+        return list(self.samples.rows()) if self.samples else []
+
     def trackMsg(self, msg):
-        self.msgs.append(msg)
+        """ tracks a response msg. Batch responses are tracked as one msg per command.
+        """
+        if is_batch(msg):
+            for command_msg in unpack_responses(msg):
+                self.trackMsg(command_msg)
+            return
+        self.count += 1
+        if msg['returncode'] != 0:
+            self.errors += 1
+            self.errorMsgs.append(msg if self.keepSamples else get_error_summary(msg))
+        self.timesToExecuted.add(time_post_to_executed(msg))
+        self.executionTimes.add(time_executing(msg))
+        self.timesWaiting.add(time_waiting(msg))
+        self.workersCounter[msg['executor_name']] += 1
+        self.returnCodesCounter[msg['returncode']] += 1
+        if self.samples is not None:
+            self.samples.append(msg)
 
         if not self.firstMsgTs:
             self.firstMsgTs = currtimemillis()
-            if self.csvAuto:
-                self.writeCsvHeaders(filepath=self.csvFileName)
 
         if self.csvAuto:
-            self.writeCsvMessage(msg, filepath=self.csvFileName)
-
+            self.getCsvWriter().write(msg)
+
+    def merge(self, other):
+        """ adds the msgs tracked by other TaskStatistics to these.
+        """
+        self.count += other.count
+        self.errors += other.errors
+        self.errorMsgs.extend(other.errorMsgs if self.keepSamples else
+                              (get_error_summary(msg) for msg in other.errorMsgs))
+        self.timesToExecuted.merge(other.timesToExecuted)
+        self.executionTimes.merge(other.executionTimes)
+        self.timesWaiting.merge(other.timesWaiting)
+        self.workersCounter.update(other.workersCounter)
+        self.returnCodesCounter.update(other.returnCodesCounter)
+        if self.samples is not None and other.samples is not None:
+            self.samples.extend(other.samples)
+        if other.firstMsgTs and (not self.firstMsgTs or other.firstMsgTs < self.firstMsgTs):
+            self.firstMsgTs = other.firstMsgTs
+        return self
 
     def msgsNumber(self):
-        return len(self.msgs)
+        return self.count
 
     def allTimesToExecuted(self):
         return (time_post_to_executed(msg) for msg in self.msgs)
 
     def avgTimeToExecuted(self):
-        aggregated_time_to_executed = sum(self.allTimesToExecuted())
-        if aggregated_time_to_executed:
-            return aggregated_time_to_executed//len(self.msgs)
-        else:
-            return 0
+        return self.timesToExecuted.avg()
 
     def maxTimeToExecuted(self):
-        if self.allTimesToExecuted() is None or len(list(self.allTimesToExecuted())) is 0:
-            return 0
-        else:
-            return max(self.allTimesToExecuted())
+        return self.timesToExecuted.maximum()
+
+    def percentileTimeToExecuted(self, p):
+        return self.timesToExecuted.percentile(p)
 
     def allExecutionTimes(self):
         return (time_executing(msg) for msg in self.msgs)
 
     def avgExecutionTime(self):
-        aggregated_execution_time = sum(self.allExecutionTimes())
-        if aggregated_execution_time:
-            return aggregated_execution_time//len(self.msgs)
-        else:
-            return 0
+        return self.executionTimes.avg()
 
     def maxExecutionTime(self):
-        if self.allExecutionTimes() is None or len(list(self.allExecutionTimes())) is 0:
-            return 0
-        else:
-            return max(self.allExecutionTimes())
+        return self.executionTimes.maximum()
+
+    def percentileExecutionTime(self, p):
+        return self.executionTimes.percentile(p)
 
     def allTimesWaiting(self):
         return (time_waiting(msg) for msg in self.msgs)
 
     def avgTimeWaiting(self):
-        aggregated_time_waiting = sum(self.allTimesWaiting())
-        if aggregated_time_waiting:
-            return aggregated_time_waiting//len(self.msgs)
-        else:
-            return 0
+        return self.timesWaiting.avg()
+
+    def percentileTimeWaiting(self, p):
+        return self.timesWaiting.percentile(p)
 
     def allErrors(self):
-        return [msg for msg in self.msgs if msg['returncode'] != 0]
+        """ :return: tracked msgs with errors, whole with keepSamples. Else the last maxErrors,
+            summarized: correlation_id, returncode, executor_name, command and stderr tail.
+        """
+        return list(self.errorMsgs)
 
     def errorsNumber(self):
-        return len(self.allErrors())
+        return self.errors
 
     def okNumber(self):
         return self.msgsNumber() - self.errorsNumber()
 
     def getWorkersCounter(self):
-        return Counter((msg['executor_name'] for msg in self.msgs))
+        return Counter(self.workersCounter)
 
     def getReturnCodesCounter(self):
-        return Counter((msg['returncode'] for msg in self.msgs))
+        return Counter(self.returnCodesCounter)
 
     def getDuration(self):
         return currtimemillis() - self.firstMsgTs
 
     def sumaryToPrettyString(self):
+        def percentiles(stat):
+            return ' / '.join(str(stat.percentile(p)) for p in (50, 95, 99))
+
         return '\n'.join((
             "________________________________________________________________________________",
             "   Stats after {}ms running:".format(self.getDuration()),
             "        Messages        : {} ({} OK / {} errors)".format(self.msgsNumber(),
                                                                       self.okNumber(),
                                                                       self.errorsNumber()),
-            "        Execution time  : {} avg ({} max)".format(self.avgExecutionTime(),
-                                                               self.maxExecutionTime()),
-            "        Waiting times   : {} avg".format(self.avgTimeWaiting()),
-            "        Total task time : {} avg ({} max)".format(self.avgTimeToExecuted(),
-                                                               self.maxTimeToExecuted()),
+            "        Execution time  : {} avg ({} max) p50/p95/p99: {}".format(
+                self.avgExecutionTime(), self.maxExecutionTime(), percentiles(self.executionTimes)),
+            "        Waiting times   : {} avg p50/p95/p99: {}".format(
+                self.avgTimeWaiting(), percentiles(self.timesWaiting)),
+            "        Total task time : {} avg ({} max) p50/p95/p99: {}".format(
+                self.avgTimeToExecuted(), self.maxTimeToExecuted(),
+                percentiles(self.timesToExecuted)),
             "________________________________________________________________________________"
         ))
 
@@ -149,7 +371,26 @@ class TaskStatistics:
         self.csvFile = open(filepath, 'w')
         return self.csvFile
 
+    def getCsvWriter(self):
+        if not self.csvWriter:
+            self.csvWriter = CsvWriter(self.csvFileName, csv_fields,
+                                       flush_interval=self.csvFlushInterval,
+                                       rotate_bytes=self.csvRotateBytes,
+                                       gzip_output=self.csvGzip)
+        return self.csvWriter
+
+    def flushCsv(self, timeout=None):
+        """ blocks until msgs tracked so far are flushed to the csvAuto file.
+        """
+        if self.csvWriter:
+            return self.csvWriter.flush(timeout)
+        return True
+
     def closeCsvFile(self):
+        """ closes the csv files, once every msg tracked so far is written.
+        """
+        if self.csvWriter:
+            self.csvWriter.close()
         if self.csvFile:
             self.csvFile.close()
 
@@ -167,7 +408,66 @@ class TaskStatistics:
 
     def toCsv(self, csv_file=None):
         csv_file = csv_file if csv_file else self.csvFileName
-        self.writeCsvHeaders(csv_file)
+        writer = CsvWriter(csv_file, csv_fields, gzip_output=self.csvGzip)
         for msg in self.msgs:
-            self.writeCsvMessage(msg)
-        self.closeCsvFile()
+            writer.write(msg)
+        writer.close()
+
+
+class ShardedTaskStatistics:
+    """ TaskStatistics for msgs tracked from many threads: each thread tracks into its own
+        shard, merged on read. Shard locks are only contended by readers.
+        csvAuto rows of every shard go to a single (thread safe) CsvWriter.
+    """
+    def __init__(self, csvAuto=False, csvFileName=DEFAULT_CSV,
+                 csvFlushInterval=DEFAULT_FLUSH_INTERVAL, csvRotateBytes=None, csvGzip=False):
+        self.csvWriter = CsvWriter(csvFileName, csv_fields, flush_interval=csvFlushInterval,
+                                   rotate_bytes=csvRotateBytes,
+                                   gzip_output=csvGzip) if csvAuto else None
+        self._local = threading.local()
+        self._shards = []  # (lock, TaskStatistics)
+        self._shards_lock = threading.Lock()
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = (threading.Lock(), TaskStatistics())
+            with self._shards_lock:
+                self._shards.append(shard)
+            self._local.shard = shard
+        return shard
+
+    def trackMsg(self, msg):
+        lock, stats = self._shard()
+        with lock:
+            stats.trackMsg(msg)
+        if self.csvWriter:
+            for command_msg in unpack_responses(msg):
+                self.csvWriter.write(command_msg)
+
+    def merged(self):
+        """ :return: <TaskStatistics> with the msgs tracked so far by every thread.
+        """
+        merged = TaskStatistics()
+        with self._shards_lock:
+            shards = list(self._shards)
+        for lock, stats in shards:
+            with lock:
+                merged.merge(stats)
+        return merged
+
+    def shardsNumber(self):
+        return len(self._shards)
+
+    def msgsNumber(self):
+        return self.merged().msgsNumber()
+
+    def sumaryToPrettyString(self):
+        return self.merged().sumaryToPrettyString()
+
+    def sumaryPrettyPrint(self):
+        print(self.sumaryToPrettyString())
+
+    def closeCsvFile(self):
+        if self.csvWriter:
+            self.csvWriter.close()
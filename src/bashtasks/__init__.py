@@ -1,7 +1,10 @@
 from bashtasks.bashtasks_client import init
 from bashtasks.bashtasks_client import post_task
+from bashtasks.bashtasks_client import post_tasks
+from bashtasks.bashtasks_client import post_batch
 from bashtasks.bashtasks_client import reset
 from bashtasks.TaskStatistics import TaskStatistics
 from bashtasks.task_response_subscriber import init_subscriber
 
-__all__ = ['init', 'init_subscriber', 'post_task', 'reset', 'TaskStatistics']
+__all__ = ['init', 'init_subscriber', 'post_task', 'post_tasks', 'post_batch', 'reset',
+           'TaskStatistics']
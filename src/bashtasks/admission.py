@@ -0,0 +1,150 @@
+""" admission pauses task consumption while the host is overloaded.
+
+    Host load is read from /proc: 1 minute load average, available memory and the number of
+    running children of the executor (commands, or fork server children).
+    Tasks may declare their cost (request cost option: {'cpu': cores, 'mem_mb': MB}),
+    reserved while they run: a task is admitted if the host stays within thresholds with its
+    cost added. Tasks without cost are admitted while the host is within thresholds.
+    With no task running, a task is admitted while the host is within thresholds whatever its
+    cost: a cost the host can never fit would otherwise keep the task, and the tasks queued
+    behind it, waiting forever.
+
+    Executors give tasks not admitted back to their queue, for other executors, and stop
+    consuming until the host load admits tasks again.
+"""
+import os
+import threading
+import time
+
+CHECK_INTERVAL = 1.0  # secs a host load sample is reused
+
+
+def read_loadavg(proc_dir='/proc'):
+    with open(os.path.join(proc_dir, 'loadavg')) as f:
+        return float(f.read().split()[0])
+
+
+def read_mem_available_mb(proc_dir='/proc'):
+    with open(os.path.join(proc_dir, 'meminfo')) as f:
+        for line in f:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) // 1024
+    raise Exception('MemAvailable not in {}/meminfo'.format(proc_dir))
+
+
+def count_children(pids, proc_dir='/proc'):
+    """ :return: number of processes whose parent is one of pids, pids themselves excluded.
+    """
+    pids = set(pids)
+    children = 0
+    for entry in os.listdir(proc_dir):
+        if not entry.isdigit() or int(entry) in pids:
+            continue
+        try:
+            with open(os.path.join(proc_dir, entry, 'stat')) as f:
+                stat = f.read()
+        except (IOError, OSError):  # exited
+            continue
+        if int(stat.rsplit(')', 1)[1].split()[1]) in pids:  # pid (comm) state ppid ...
+            children += 1
+    return children
+
+
+def get_cost(cost):
+    """ :return: (cpu, mem_mb) of a task cost, 0 if not declared.
+    """
+    cost = cost or {}
+    return float(cost.get('cpu', 0)), int(cost.get('mem_mb', 0))
+
+
+class HostLoad:
+    def __init__(self, load, mem_available_mb, children):
+        self.load = load
+        self.mem_available_mb = mem_available_mb
+        self.children = children
+
+
+class AdmissionController:
+    def __init__(self, max_load=None, min_free_mem_mb=None, max_children=None, pids=None,
+                 proc_dir='/proc', check_interval=CHECK_INTERVAL):
+        """ max_load: max 1 minute load average, plus cpu cost of the task.
+            min_free_mem_mb: min available memory, minus mem_mb cost of running tasks and
+                             of the task.
+            max_children: max commands running, children of pids. Default: this process.
+            None thresholds are not checked.
+        """
+        self.max_load = max_load
+        self.min_free_mem_mb = min_free_mem_mb
+        self.max_children = max_children
+        self.pids = list(pids) if pids is not None else [os.getpid()]
+        self.proc_dir = proc_dir
+        self.check_interval = check_interval
+        self.rejected = 0
+        self._host_load = None
+        self._sampled_ts = 0
+        self._reserved_cpu = 0
+        self._reserved_mem_mb = 0
+        self._running = 0
+        self._lock = threading.Lock()
+
+    def watch(self, pid):
+        """ counts children of pid (eg: fork server) as running commands too.
+        """
+        self.pids.append(pid)
+
+    def host_load(self):
+        """ :return: HostLoad, sampled at most every check_interval secs.
+        """
+        with self._lock:
+            now = time.time()
+            if self._host_load is None or now - self._sampled_ts >= self.check_interval:
+                self._host_load = HostLoad(
+                    read_loadavg(self.proc_dir) if self.max_load is not None else 0,
+                    read_mem_available_mb(self.proc_dir)
+                    if self.min_free_mem_mb is not None else 0,
+                    count_children(self.pids, self.proc_dir)
+                    if self.max_children is not None else 0)
+                self._sampled_ts = now
+            return self._host_load
+
+    def _admits(self, host, cpu, mem_mb):
+        if not self._running:  # a task alone may use the whole host
+            cpu, mem_mb = 0, 0
+        load = max(host.load, self._reserved_cpu) + cpu  # load average lags behind
+        free_mem_mb = host.mem_available_mb - self._reserved_mem_mb - mem_mb
+        return (self.max_load is None or load <= self.max_load) and \
+            (self.min_free_mem_mb is None or free_mem_mb >= self.min_free_mem_mb) and \
+            (self.max_children is None or max(host.children, self._running) < self.max_children)
+
+    def admits(self, cost=None):
+        """ :return: True if the host admits a task with cost now, reserving nothing.
+        """
+        cpu, mem_mb = get_cost(cost)
+        host = self.host_load()
+        with self._lock:
+            return self._admits(host, cpu, mem_mb)
+
+    def admit(self, cost=None):
+        """ reserves cost if the host admits a task with it, until release(cost).
+            :return: True if admitted.
+        """
+        cpu, mem_mb = get_cost(cost)
+        host = self.host_load()
+        with self._lock:
+            if not self._admits(host, cpu, mem_mb):
+                self.rejected += 1
+                return False
+            self._reserved_cpu += cpu
+            self._reserved_mem_mb += mem_mb
+            self._running += 1
+            return True
+
+    def release(self, cost=None):
+        cpu, mem_mb = get_cost(cost)
+        with self._lock:
+            self._reserved_cpu -= cpu
+            self._reserved_mem_mb -= mem_mb
+            self._running -= 1
+
+    def running_nr(self):
+        return self._running
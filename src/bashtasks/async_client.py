@@ -0,0 +1,229 @@
+""" asyncio client for bashtasks. Requires python >= 3.5
+
+    AsyncBashTasks posts tasks and awaits their responses without blocking the event loop,
+    so one loop can have tens of thousands of tasks in flight.
+    Requests and responses are the same BashTasksMessage used by bashtasks_client:
+    executors serve both clients alike.
+
+    Transports:
+      - PikaAsyncTransport: RabbitMQ. Publishes from one dedicated thread owning the channel,
+        responses are consumed by a ResponseDemultiplexer and handed over to the event loop.
+      - InMemoryAsyncTransport: in process broker stand-in, for tests and local runs.
+"""
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import pika
+
+from bashtasks.constants import DestinationNames, TASK_REQUESTS_POOL, PERSISTENT
+from bashtasks.rabbit_util import connect_and_declare, close_channel_and_conn, get_task_route
+from bashtasks.response_demux import ResponseDemultiplexer
+from bashtasks import message
+
+DEFAULT_DESTINATION = DestinationNames.get_for(TASK_REQUESTS_POOL)
+IN_MEMORY_REPLY_QUEUE = 'bashtasks:inmemory:responses'
+
+
+class LoopResponse:
+    """ ResponseFuture stand-in: hands the response to callback in the event loop thread.
+    """
+    def __init__(self, loop, callback):
+        self.loop = loop
+        self.callback = callback
+
+    def set_response(self, response):
+        self.loop.call_soon_threadsafe(self.callback, response)
+
+
+class PikaAsyncTransport:
+    def __init__(self, host='127.0.0.1', port=5672, usr='guest', pas='guest', destinations=None):
+        self.host = host
+        self.port = port
+        self.usr = usr
+        self.pas = pas
+        self.destinations = destinations
+        self.reply_queue = None  # known once started
+        self._loop = None
+        self._channel = None
+        self._demux = None
+        self._publisher = ThreadPoolExecutor(max_workers=1)  # pika channels are not thread safe
+        self._props = {}  # (delivery_mode, priority) -> BasicProperties
+
+    async def start(self, loop):
+        self._loop = loop
+        await loop.run_in_executor(self._publisher, self._connect)
+        demux = ResponseDemultiplexer(host=self.host, port=self.port, usr=self.usr, pas=self.pas)
+        self._demux = await loop.run_in_executor(None, demux.start)
+        self.reply_queue = self._demux.queue
+
+    def _connect(self):
+        self._channel = connect_and_declare(host=self.host, port=self.port, usr=self.usr,
+                                            pas=self.pas, destinations=self.destinations)
+
+    def _publish(self, destination, body, priority, delivery_mode, routing_key):
+        key = (delivery_mode, priority)
+        if key not in self._props:
+            self._props[key] = pika.BasicProperties(delivery_mode=delivery_mode,
+                                                    priority=priority)
+        exchange, routing_key = get_task_route(self._channel, destination, routing_key)
+        self._channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body,
+                                    properties=self._props[key])
+
+    async def publish(self, destination, body, priority=None, delivery_mode=PERSISTENT,
+                      routing_key=None):
+        await self._loop.run_in_executor(self._publisher, self._publish, destination, body,
+                                         priority, delivery_mode, routing_key)
+
+    def expect(self, correlation_id, callback):
+        self._demux.expect(correlation_id, future=LoopResponse(self._loop, callback))
+
+    def forget(self, correlation_id):
+        self._demux.forget(correlation_id)
+
+    async def close(self):
+        if self._demux is not None:
+            self._demux.stop()
+        if self._channel is not None:
+            await self._loop.run_in_executor(self._publisher, close_channel_and_conn, self._channel)
+        self._publisher.shutdown()
+
+
+class InMemoryAsyncTransport:
+    """ broker stand-in living in the event loop.
+        executor: optional callable(request <dict>) -> response <dict>, run for every published
+        request as an executor would. Without executor, requests are kept in published
+        and responses can be delivered with reply().
+    """
+    def __init__(self, executor=None):
+        self.executor = executor
+        self.reply_queue = IN_MEMORY_REPLY_QUEUE
+        self.published = {}  # destination -> [body]
+        self._expected = {}  # correlation_id -> callback
+        self._loop = None
+
+    async def start(self, loop):
+        self._loop = loop
+
+    async def publish(self, destination, body, priority=None, delivery_mode=PERSISTENT,
+                      routing_key=None):
+        if self.executor is not None:
+            self._loop.call_soon(self._execute, body)
+        else:
+            self.published.setdefault(destination, []).append(body)
+
+    def _execute(self, body):
+        self.reply(json.dumps(self.executor(message.from_str(body))))
+
+    def reply(self, body):
+        """ delivers a response body to the client, as if sent by an executor.
+        """
+        response = message.from_str(body)
+        callback = self._expected.pop(response['correlation_id'], None)
+        if callback is not None:
+            callback(response)
+
+    def expect(self, correlation_id, callback):
+        self._expected[correlation_id] = callback
+
+    def forget(self, correlation_id):
+        self._expected.pop(correlation_id, None)
+
+    async def close(self):
+        self._expected.clear()
+
+
+class ResponsesIterator:
+    """ async iterator over responses of tasks posted with AsyncBashTasks.post_task.
+        stops once every task posted so far got its response.
+    """
+    def __init__(self, client):
+        self.client = client
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.client.pending_nr() and self.client._responses.empty():
+            raise StopAsyncIteration
+        response = await self.client._responses.get()
+        self.client._posted_pending -= 1
+        return response
+
+
+class AsyncBashTasks:
+    def __init__(self, transport, loop=None):
+        self.transport = transport
+        self.loop = loop or asyncio.get_event_loop()
+        self._responses = asyncio.Queue()  # responses of post_task tasks
+        self._posted_pending = 0
+
+    async def start(self):
+        await self.transport.start(self.loop)
+        return self
+
+    async def post_task(self, command, destination=DEFAULT_DESTINATION, max_retries=None,
+                        non_retriable=[], **options):
+        """ posts command to executors via destination. does NOT wait for response.
+            the response is available through responses().
+            options: optional task fields, see message.TASK_OPTIONS
+            :return: <dict> message created for the task.
+        """
+        msg = message.get_request(command, reply_to=self.transport.reply_queue,
+                                  max_retries=max_retries, non_retriable=non_retriable,
+                                  **options)
+        self.transport.expect(msg['correlation_id'], self._responses.put_nowait)
+        self._posted_pending += 1
+        await self.transport.publish(destination, msg.to_json(), priority=msg.get('priority'),
+                                     delivery_mode=message.get_delivery_mode(msg),
+                                     routing_key=msg.get('routing_key'))
+        return msg
+
+    async def execute_task(self, command, destination=DEFAULT_DESTINATION, timeout=10,
+                           max_retries=None, non_retriable=[], **options):
+        """ posts command to executors via destination and awaits its response.
+            options: optional task fields, see message.TASK_OPTIONS
+            :return: <dict> response message.
+        """
+        msg = message.get_request(command, reply_to=self.transport.reply_queue,
+                                  max_retries=max_retries, non_retriable=non_retriable,
+                                  **options)
+        response = self.loop.create_future()
+
+        def on_response(response_msg):
+            if not response.done():
+                response.set_result(response_msg)
+
+        self.transport.expect(msg['correlation_id'], on_response)
+        try:
+            await self.transport.publish(destination, msg.to_json(),
+                                         priority=msg.get('priority'),
+                                         delivery_mode=message.get_delivery_mode(msg),
+                                         routing_key=msg.get('routing_key'))
+            return await asyncio.wait_for(response, timeout)
+        except asyncio.TimeoutError:
+            raise Exception('Timeout ({}secs) waiting for response to msg: {} in queue: "{}"'
+                            .format(timeout, msg['correlation_id'], self.transport.reply_queue))
+        finally:
+            self.transport.forget(msg['correlation_id'])
+
+    def responses(self):
+        return ResponsesIterator(self)
+
+    def pending_nr(self):
+        """ :return: number of tasks posted with post_task still waiting for their response.
+        """
+        return self._posted_pending - self._responses.qsize()
+
+    async def close(self):
+        await self.transport.close()
+
+
+async def init(host='127.0.0.1', port=5672, usr='guest', pas='guest', destinations=None,
+               transport=None, loop=None):
+    """ :return: a started <AsyncBashTasks>. RabbitMQ transport unless transport is given.
+    """
+    if transport is None:
+        transport = PikaAsyncTransport(host=host, port=port, usr=usr, pas=pas,
+                                       destinations=destinations)
+    return await AsyncBashTasks(transport, loop=loop).start()
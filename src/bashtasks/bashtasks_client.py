@@ -1,17 +1,29 @@
 """bashtasks implementation module
 """
-import json
 import time
-from datetime import datetime
-import pika
+import threading
 
 from bashtasks.constants import TASK_RESPONSES_POOL, TASK_REQUESTS_POOL
 from bashtasks.constants import Destination, DestinationNames
-from bashtasks.rabbit_util import connect_and_declare, declare_and_bind, close_channel_and_conn
+from bashtasks.rabbit_util import declare_and_bind, close_channel_and_conn
+from bashtasks.rabbit_util import PipelinedPublisher, ConfirmTimeout, get_pool, get_task_route
+from bashtasks.response_demux import ResponseDemultiplexer
+from bashtasks.transport import MEMORY
 from bashtasks import message
+from bashtasks.codec import get_codec
 
-channel_inst = None
+channel_inst = None  # channel given to init, used instead of connection_pool
+connection_pool = None  # connections opened lazily, one per publishing thread
+transient_destinations = set()  # destinations whose tasks are not persistent by default
+connection_params = {}  # host, port, usr, pas, transport used by init. For response_demux
+response_demux = None  # lazy initialized by execute_task
+local_executors = None  # LocalExecutors started by init(local_workers=N)
+response_demux_lock = threading.Lock()
+publish_lock = threading.Lock()  # pika channels are not thread safe: guards channel_inst
+codec_inst = get_codec()  # wire format of posted tasks, responses come back with the same codec
 DEFAULT_DESTINATION = DestinationNames.get_for(TASK_REQUESTS_POOL)
+DEFAULT_CONFIRM_WINDOW = 1000  # post_tasks: max msgs published before waiting for confirms
+DEFAULT_CONFIRM_TIMEOUT = 30  # post_tasks: secs to wait for confirms
 
 
 def currtimemillis():
@@ -19,67 +31,243 @@ def currtimemillis():
 
 
 def post_task(command, destination=DEFAULT_DESTINATION, reply_to=Destination.responses_pool,
-              max_retries=None, non_retriable=[]):
+              max_retries=None, non_retriable=[], **options):
     """ posts command to executors via RabbitMQ destination
         does NOT wait for response.
+        options: optional task fields, see message.TASK_OPTIONS
         :return: <dict> message created for the task.
     """
-    msg = message.get_request(command, reply_to=Destination.responses_pool, max_retries=max_retries,
-                              non_retriable=non_retriable)
+    msg = message.get_request(command, reply_to=reply_to, max_retries=max_retries,
+                              non_retriable=non_retriable, **get_options(destination, options))
 
     if reply_to is Destination.responses_exclusive:
-        declare_and_bind(channel_inst, msg['reply_to'])
+        run_on_channel(lambda ch: declare_and_bind(ch, msg['reply_to']))
 
-    msg_str = msg.to_json()
-    props = pika.BasicProperties(
-                         delivery_mode=2,  # make message persistent
-                      )
-    channel_inst.basic_publish(exchange=destination, routing_key='', body=msg_str, properties=props)
+    publish(msg, destination)
     return msg
 
 
-def execute_task(command, destination=DEFAULT_DESTINATION, reply_to=Destination.responses_pool,
-                 timeout=10, max_retries=None, non_retriable=[]):
+def post_batch(commands, destination=DEFAULT_DESTINATION, reply_to=Destination.responses_pool,
+               max_retries=None, non_retriable=[], parallelism=1, **options):
+    """ posts commands to executors via RabbitMQ destination, all in a single message.
+        An executor runs them, up to parallelism at a time, and responds them in a single
+        response, see message.unpack_responses.
+        does NOT wait for response.
+        options: optional task fields, see message.TASK_OPTIONS
+        :return: <dict> message created for the batch.
+    """
+    msg = message.get_batch_request(commands, reply_to=reply_to, max_retries=max_retries,
+                                    non_retriable=non_retriable, parallelism=parallelism,
+                                    **get_options(destination, options))
+
+    if reply_to is Destination.responses_exclusive:
+        run_on_channel(lambda ch: declare_and_bind(ch, msg['reply_to']))
+
+    publish(msg, destination)
+    return msg
+
+
+def get_options(destination, options):
+    """ :return: task options, not persistent for transient_destinations unless set.
+    """
+    if destination in transient_destinations and options.get('persistent') is None:
+        return dict(options, persistent=False)
+    return options
+
+
+def run_on_channel(fn, retries=1):
+    """ :return: fn(channel), on the channel given to init or on a pooled one.
+        Pooled channels are reconnected and fn run again on connection errors, up to retries.
+    """
+    if channel_inst is not None:
+        with publish_lock:
+            return fn(channel_inst)
+    return connection_pool.run(fn, retries=retries)
+
+
+def publish(msg, destination=DEFAULT_DESTINATION):
+    body, content_encoding = codec_inst.encode(msg)
+    props = codec_inst.properties(content_encoding,
+                                  delivery_mode=message.get_delivery_mode(msg),
+                                  priority=msg.get('priority'))
+
+    def publish_on(ch):
+        exchange, routing_key = get_task_route(ch, destination, msg.get('routing_key'))
+        ch.basic_publish(exchange=exchange, routing_key=routing_key, body=body, properties=props)
+
+    run_on_channel(publish_on)
+
+
+def post_tasks(commands, destination=DEFAULT_DESTINATION, reply_to=Destination.responses_pool,
+               max_retries=None, non_retriable=[], confirm_window=DEFAULT_CONFIRM_WINDOW,
+               confirm_timeout=DEFAULT_CONFIRM_TIMEOUT, **options):
+    """ posts every command in commands to executors via RabbitMQ destination
+        commands can be any iterable (eg: a generator), it is consumed lazily.
+        Publishing is pipelined, broker confirms are awaited every confirm_window messages,
+        up to confirm_timeout secs.
+        Message properties are shared by all messages.
+        does NOT wait for responses.
+        options: optional task fields, see message.TASK_OPTIONS
+        :return: <dict> summary: count, first_correlation_id, last_correlation_id and
+                 failures (correlation_ids not confirmed by the broker).
+        :raises ConfirmTimeout: if the broker stops confirming (eg: memory alarm), with the
+                 summary of the commands posted so far in its summary attribute.
+    """
+    if reply_to is Destination.responses_exclusive:
+        run_on_channel(lambda ch: declare_and_bind(ch, DestinationNames.get_for(reply_to)))
+
+    options = get_options(destination, options)
+    summary = {'count': 0, 'first_correlation_id': None, 'last_correlation_id': None,
+               'failures': []}
+
+    def publish_all(ch):
+        exchange, routing_key = get_task_route(ch, destination, options.get('routing_key'))
+        publisher = PipelinedPublisher(ch.connection.channel(), window=confirm_window,
+                                       timeout=confirm_timeout)
+        try:
+            for command in commands:
+                msg = message.get_request(command, reply_to=reply_to, max_retries=max_retries,
+                                          non_retriable=non_retriable, **options)
+                body, content_encoding = codec_inst.encode(msg)
+                props = codec_inst.properties(content_encoding,
+                                              delivery_mode=message.get_delivery_mode(msg),
+                                              priority=msg.get('priority'))
+                publisher.publish(exchange, routing_key, body, props, key=msg['correlation_id'])
+
+                if summary['first_correlation_id'] is None:
+                    summary['first_correlation_id'] = msg['correlation_id']
+                summary['last_correlation_id'] = msg['correlation_id']
+                summary['count'] += 1
+
+            publisher.wait_for_confirms(timeout=confirm_timeout)
+        finally:
+            publisher.close()
+            summary['failures'] = publisher.failures
+
+    try:
+        run_on_channel(publish_all, retries=0)  # commands may be consumed: never published again
+    except ConfirmTimeout as e:
+        e.summary = summary
+        raise
+    return summary
+
+
+def get_response_demux():
+    global response_demux
+    with response_demux_lock:
+        if response_demux is None or not response_demux.is_running():
+            response_demux = ResponseDemultiplexer(**connection_params).start()
+    return response_demux
+
+
+def execute_task(command, destination=DEFAULT_DESTINATION, reply_to=None,
+                 timeout=10, max_retries=None, non_retriable=[], **options):
     """ posts command to executors via RabbitMQ destination
         synchronously waits for response.
+        The response is sent to this client's exclusive reply queue and routed to the caller
+        by correlation_id, so execute_task can be called concurrently from many threads.
+        reply_to is ignored, kept for backwards compatibility.
+        options: optional task fields, see message.TASK_OPTIONS
         :return: <dict> response message.
     """
-    task = post_task(command, destination=destination, reply_to=reply_to, max_retries=max_retries,
-                     non_retriable=non_retriable)
-    start_waiting = datetime.now()
-    while True:
-        method_frame, header_frame, body = channel_inst.basic_get(TASK_RESPONSES_POOL)
-        if body:
-            channel_inst.basic_ack(method_frame.delivery_tag)
-            return message.from_str(body.decode('utf-8'))
-        else:
-            if (datetime.now() - start_waiting).total_seconds() > timeout:
-                raise Exception('Timeout ({}secs) waiting for response to msg: {} in queue: "{}"'
-                                .format(timeout, task['correlation_id'], reply_to))
-            time.sleep(0.01)
+    demux = get_response_demux()
+    task = message.get_request(command, reply_to=demux.queue, max_retries=max_retries,
+                               non_retriable=non_retriable, **get_options(destination, options))
+    return wait_for_response(demux, task, destination, timeout)
+
+
+def execute_batch(commands, destination=DEFAULT_DESTINATION, timeout=10, max_retries=None,
+                  non_retriable=[], parallelism=1, **options):
+    """ posts commands to executors via RabbitMQ destination, all in a single message,
+        synchronously waits for their response. See post_batch.
+        options: optional task fields, see message.TASK_OPTIONS
+        :return: [<dict>] response of every command, in commands order.
+    """
+    demux = get_response_demux()
+    task = message.get_batch_request(commands, reply_to=demux.queue, max_retries=max_retries,
+                                     non_retriable=non_retriable, parallelism=parallelism,
+                                     **get_options(destination, options))
+    return message.unpack_responses(wait_for_response(demux, task, destination, timeout))
+
+
+def wait_for_response(demux, task, destination, timeout):
+    """ publishes task and waits for its response, routed by demux.
+        :return: <dict> response message.
+    """
+    future = demux.expect(task['correlation_id'])
+    try:
+        publish(task, destination)
+        if not future.wait(timeout):
+            raise Exception('Timeout ({}secs) waiting for response to msg: {} in queue: "{}"'
+                            .format(timeout, task['correlation_id'], demux.queue))
+        return future.response()
+    finally:
+        demux.forget(task['correlation_id'])
 
 
 class BashTasks:
     pass
 
 
-def init(host='127.0.0.1', port=5672, usr='guest', pas='guest', channel=None, destinations=None):
-    global channel_inst
+def init(host='127.0.0.1', port=5672, usr='guest', pas='guest', channel=None, destinations=None,
+         codec=None, transient=None, transport=None, local_workers=0, local_options=None):
+    """ codec: wire format of tasks and their responses, see bashtasks.codec. Default json.
+        transient: destinations (eg: of health probes) whose tasks are not persistent unless
+                   posted with persistent=True: faster, lost if the broker restarts.
+        transport: name or instance, see bashtasks.transport. Default: pika.
+                   'memory' exchanges tasks with executors of this process, in memory.
+        local_workers: runs tasks in local_workers executor threads of this process, on the
+                   'memory' transport, instead of posting them to the broker at host. Same
+                   responses as executors of a cluster, sent to reply_to in memory: consume
+                   them with init_subscriber(transport='memory'). See local_executor.
+        local_options: start_executor options of local workers (eg: slots, command_timeout).
+    """
+    global channel_inst, connection_pool, codec_inst, local_executors
+    if local_executors is not None:
+        local_executors.stop()
+        local_executors = None
+    if local_workers:
+        # imported on use: executor metrics are only registered by processes running tasks
+        from bashtasks.local_executor import LocalExecutors
+        transport = MEMORY
+        local_executors = LocalExecutors(local_workers, transport=transport,
+                                         **(local_options or {})).start()
+    connection_params.update(host=host, port=port, usr=usr, pas=pas, transport=transport)
+    codec_inst = get_codec(codec)
+    transient_destinations.clear()
+    transient_destinations.update(transient or [])
     if not channel:
-        # TODO should lazy init channel_inst
-        channel_inst = connect_and_declare(host=host, port=port, usr=usr, pas=pas, destinations=destinations)
+        # connections are opened, and destinations declared, on first publish
+        channel_inst = None
+        connection_pool = get_pool(host=host, port=port, usr=usr, pas=pas,
+                                   destinations=destinations or [TASK_REQUESTS_POOL,
+                                                                 TASK_RESPONSES_POOL],
+                                   transport=transport)
     else:
         channel_inst = channel
 
     bashtasks = BashTasks()
     bashtasks.post_task = post_task
+    bashtasks.post_tasks = post_tasks
+    bashtasks.post_batch = post_batch
     bashtasks.execute_task = execute_task
+    bashtasks.execute_batch = execute_batch
     return bashtasks
 
 
 def reset():
 
-    global channel_inst
+    global channel_inst, connection_pool, response_demux, local_executors
+    if local_executors is not None:
+        local_executors.stop()
+        local_executors = None
+    if response_demux is not None:
+        response_demux.stop()
+        response_demux = None
     if channel_inst is not None:
         close_channel_and_conn(channel_inst)
         channel_inst = None
+    if connection_pool is not None:
+        connection_pool.close()
+        connection_pool = None
+    transient_destinations.clear()
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+""" bench: end to end load generator of the bashtasks pipeline. Posts tasks with post_task at a
+    target rate, mixing commands (no-op true, sleep, big output), executes them in executors
+    running in this process and collects their responses in TaskStatistics.
+    Reports throughput, wait/exec/total latency percentiles and CPU per task (bench process:
+    client, executors and their commands; the RabbitMQ broker is not included).
+    --broker memory (default) needs no RabbitMQ, see transport.InMemoryTransport.
+    --broker rabbitmq uses the one at --host, on bench destinations deleted when done.
+    Usage sample: bashtasks-bench --tasks 5000 --rate 1000 --executors 2 --slots 4
+                  --mix true=8,sleep=1,big-output=1
+"""
+import argparse
+import random
+import resource
+import sys
+import threading
+import time
+
+import bashtasks
+from bashtasks import executor
+from bashtasks.logger import configure, LEVELS
+from bashtasks.memory_broker import MemoryBroker
+from bashtasks.rabbit_util import connect_and_declare, close_channel_and_conn
+from bashtasks.task_response_subscriber import TaskResponseSubscriber
+from bashtasks.transport import InMemoryTransport, PIKA
+
+MEMORY = 'memory'
+RABBITMQ = 'rabbitmq'
+BROKERS = (MEMORY, RABBITMQ)
+BENCH_REQUESTS = 'bashtasks:bench:requests'
+BENCH_RESPONSES = 'bashtasks:bench:responses'
+COMMAND_KINDS = ('true', 'sleep', 'big-output')
+PERCENTILES = (50, 95, 99)
+DEFAULT_MIX = 'true=1'
+RESPONSES_PREFETCH = 100
+
+
+def parse_mix(mix):
+    """ mix: comma separated kind=weight, eg: true=8,sleep=1,big-output=1
+        :return: [(kind, weight)]
+    """
+    weights = []
+    for item in mix.split(','):
+        kind, _, weight = item.partition('=')
+        if kind not in COMMAND_KINDS:
+            raise ValueError('Unknown command kind {} in mix {}, expected one of {}'
+                             .format(kind, mix, COMMAND_KINDS))
+        weights.append((kind, float(weight or 1)))
+    return weights
+
+
+def get_command(kind, sleep_ms=10, output_kb=64):
+    if kind == 'sleep':
+        return ['sleep', str(sleep_ms / 1000.)]
+    if kind == 'big-output':
+        return ['sh', '-c', 'yes bashtasks | head -c {}'.format(output_kb * 1024)]
+    return ['true']
+
+
+def get_commands(tasks, mix, sleep_ms=10, output_kb=64, seed=None):
+    """ :return: generator of tasks commands, their kinds drawn from mix weights.
+    """
+    rand = random.Random(seed)
+    weights = parse_mix(mix)
+    total = sum(weight for kind, weight in weights)
+    for i in range(tasks):
+        point = rand.random() * total
+        for kind, weight in weights:
+            point -= weight
+            if point < 0:
+                break
+        yield get_command(kind, sleep_ms=sleep_ms, output_kb=output_kb)
+
+
+def cpu_secs():
+    """ :return: user + system CPU secs of this process and its finished children.
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime + children.ru_utime + children.ru_stime
+
+
+class Broker:
+    """ channels to the broker benchmarked, each on its own connection.
+    """
+    def __init__(self, kind=MEMORY, host='127.0.0.1', port=5672, usr='guest', pas='guest'):
+        self.kind = kind
+        self.host = host
+        self.port = port
+        self.usr = usr
+        self.pas = pas
+        # a broker of its own per run: nothing is left over from previous runs
+        self.transport = InMemoryTransport(MemoryBroker()) if kind == MEMORY else PIKA
+        self.channels = []
+
+    def params(self):
+        return {'host': self.host, 'port': self.port, 'usr': self.usr, 'pas': self.pas,
+                'transport': self.transport}
+
+    def channel(self):
+        ch = connect_and_declare(destinations=[BENCH_REQUESTS, BENCH_RESPONSES], **self.params())
+        self.channels.append(ch)
+        return ch
+
+    def purge(self):
+        ch = self.channel()
+        for queue in (BENCH_REQUESTS, BENCH_RESPONSES):
+            ch.queue_purge(queue=queue)
+
+    def close(self, delete=False):
+        """ delete: deletes bench destinations.
+        """
+        if delete:
+            ch = self.channel()
+            for destination in (BENCH_REQUESTS, BENCH_RESPONSES):
+                ch.queue_delete(queue=destination)
+                ch.exchange_delete(exchange=destination)
+        for ch in self.channels:
+            connection = ch.connection
+            if ch.is_open:
+                close_channel_and_conn(ch)
+            if connection.is_open:
+                connection.close()
+
+
+def start_executors(broker, executors=1, slots=1):
+    """ starts executors consuming bench requests, in daemon threads.
+        :return: executor threads
+    """
+    executor.stop = False
+    del executor.channels[:]
+    threads = []
+    for i in range(executors):
+        kwargs = dict(broker.params(), queue=BENCH_REQUESTS, tasks_nr=-1, slots=slots)
+        thread = threading.Thread(target=executor.start_executor, kwargs=kwargs,
+                                  name=executor.get_thread_name(i))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    return threads
+
+
+def start_subscriber(broker, stats, tasks):
+    """ tracks bench responses in stats from a daemon thread.
+        :return: (subscriber, event set once tasks responses are tracked)
+    """
+    subscriber = TaskResponseSubscriber(channel=broker.channel(), prefetch=RESPONSES_PREFETCH)
+    done = threading.Event()
+
+    def track(msg):
+        stats.trackMsg(msg.decode())
+        msg.ack()
+        if stats.msgsNumber() >= tasks:
+            done.set()
+
+    thread = threading.Thread(target=subscriber.subscribe, args=(track, BENCH_RESPONSES),
+                              name='bench_responses_th')
+    thread.daemon = True
+    thread.start()
+    return subscriber, done
+
+
+def post_at_rate(commands, rate=0):
+    """ posts commands to bench requests, rate tasks/sec. 0: as fast as possible.
+        :return: tasks posted
+    """
+    posted = 0
+    start = time.time()
+    for command in commands:
+        if rate:
+            ahead = start + posted / float(rate) - time.time()
+            if ahead > 0:
+                time.sleep(ahead)
+        bashtasks.post_task(command, destination=BENCH_REQUESTS, reply_to=BENCH_RESPONSES)
+        posted += 1
+    return posted
+
+
+def run(broker=MEMORY, host='127.0.0.1', port=5672, usr='guest', pas='guest', executors=1,
+        slots=1, tasks=1000, rate=0, mix=DEFAULT_MIX, sleep_ms=10, output_kb=64, timeout=300,
+        seed=None):
+    """ runs a benchmark, see module doc.
+        :return: <dict> report: tasks, responses, errors, secs, throughput (responses/sec),
+                 cpu_ms_per_task, and wait_ms, exec_ms, total_ms: {percentile: ms}
+    """
+    commands = list(get_commands(tasks, mix, sleep_ms=sleep_ms, output_kb=output_kb, seed=seed))
+    target = Broker(broker, host=host, port=port, usr=usr, pas=pas)
+    stats = bashtasks.TaskStatistics()
+    executor_ths = []
+    subscriber = None
+    try:
+        target.purge()
+        executor_ths = start_executors(target, executors=executors, slots=slots)
+        subscriber, done = start_subscriber(target, stats, tasks)
+        bashtasks.init(destinations=[BENCH_REQUESTS, BENCH_RESPONSES], **target.params())
+
+        start_cpu = cpu_secs()
+        start = time.time()
+        post_at_rate(commands, rate=rate)
+        done.wait(timeout)
+        elapsed = time.time() - start
+        cpu = cpu_secs() - start_cpu
+    finally:
+        if subscriber is not None:
+            subscriber.stop()
+        executor.stop_and_exit()
+        for thread in executor_ths:
+            thread.join(executor.SLOTS_IDLE_POLL * 2)
+        bashtasks.reset()
+        target.close(delete=broker == RABBITMQ)
+
+    responses = stats.msgsNumber()
+    return {'broker': broker, 'tasks': tasks, 'responses': responses,
+            'errors': stats.errorsNumber(), 'secs': elapsed,
+            'throughput': responses / elapsed if elapsed else 0,
+            'cpu_ms_per_task': cpu * 1000 / responses if responses else 0,
+            'wait_ms': dict((p, stats.percentileTimeWaiting(p)) for p in PERCENTILES),
+            'exec_ms': dict((p, stats.percentileExecutionTime(p)) for p in PERCENTILES),
+            'total_ms': dict((p, stats.percentileTimeToExecuted(p)) for p in PERCENTILES)}
+
+
+def format_report(report):
+    def percentiles(values):
+        return ' '.join('p{}={:.1f}'.format(p, values[p] or 0) for p in PERCENTILES)
+
+    lines = ['broker: {broker} responses: {responses}/{tasks} errors: {errors} '
+             'secs: {secs:.2f}'.format(**report),
+             'throughput: {:.1f} tasks/sec'.format(report['throughput']),
+             'wait ms:  ' + percentiles(report['wait_ms']),
+             'exec ms:  ' + percentiles(report['exec_ms']),
+             'total ms: ' + percentiles(report['total_ms']),
+             'cpu ms per task: {:.3f}'.format(report['cpu_ms_per_task'])]
+    return '\n'.join(lines)
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser(description=globals()['__doc__'], add_help=True,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--broker', default=MEMORY, dest='broker', choices=BROKERS)
+    parser.add_argument('--host', default='127.0.0.1', dest='host')
+    parser.add_argument('--port', default=5672, dest='port', type=int)
+    parser.add_argument('--user', default='guest', dest='usr')
+    parser.add_argument('--pass', default='guest', dest='pas')
+    parser.add_argument('--executors', default=1, dest='executors', type=int)
+    parser.add_argument('--slots', default=1, dest='slots', type=int,
+                        metavar='tasks run at a time per executor')
+    parser.add_argument('--tasks', default=1000, dest='tasks', type=int)
+    parser.add_argument('--rate', default=0, dest='rate', type=float,
+                        metavar='tasks posted per sec, 0: as fast as possible')
+    parser.add_argument('--mix', default=DEFAULT_MIX, dest='mix',
+                        metavar='kind=weight,... of kinds: ' + ', '.join(COMMAND_KINDS))
+    parser.add_argument('--sleep-ms', default=10, dest='sleep_ms', type=int)
+    parser.add_argument('--output-kb', default=64, dest='output_kb', type=int)
+    parser.add_argument('--timeout', default=300, dest='timeout', type=float,
+                        metavar='secs waiting for responses')
+    parser.add_argument('--seed', default=None, dest='seed', type=int)
+    parser.add_argument('--log-level', default='WARNING', dest='log_level', choices=LEVELS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = get_args(argv)
+    configure(level=args.log_level)
+    report = run(broker=args.broker, host=args.host, port=args.port, usr=args.usr, pas=args.pas,
+                 executors=args.executors, slots=args.slots, tasks=args.tasks, rate=args.rate,
+                 mix=args.mix, sleep_ms=args.sleep_ms, output_kb=args.output_kb,
+                 timeout=args.timeout, seed=args.seed)
+    print(format_report(report))
+    return 0 if report['responses'] == report['tasks'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,142 @@
+""" codec: wire format of bashtasks request and response messages.
+
+    Codec names are <format>[+<compression>]: json (default), json+zlib, msgpack, msgpack+zlib,
+    json+zstd, msgpack+zstd. msgpack and zstd are optional: pip install msgpack zstandard
+    Compression is applied to bodies of at least compress_threshold bytes.
+
+    Bodies are described by the AMQP content_type and content_encoding properties, so decode
+    works for any codec. The codec name travels in the 'codec' header of requests: executors
+    reply with the codec of the request, falling back to json. Clients not choosing a codec
+    only ever send and receive plain JSON, as before.
+"""
+import json
+import zlib
+
+import pika
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+ZLIB = 'zlib'
+ZSTD = 'zstd'
+DEFAULT_CODEC = 'json'
+DEFAULT_COMPRESS_THRESHOLD = 2048  # bytes
+CODEC_HEADER = 'codec'
+
+formats = {'json': JSON, 'msgpack': MSGPACK}
+compressions = (ZLIB, ZSTD)
+
+
+def is_available(content_type=JSON, compression=None):
+    if content_type == MSGPACK and msgpack is None:
+        return False
+    if compression == ZSTD and zstandard is None:
+        return False
+    return True
+
+
+def compress(body, compression):
+    if compression == ZLIB:
+        return zlib.compress(body)
+    return zstandard.ZstdCompressor().compress(body)
+
+
+def decompress(body, content_encoding):
+    if content_encoding == ZLIB:
+        return zlib.decompress(body)
+    if content_encoding == ZSTD:
+        return zstandard.ZstdDecompressor().decompress(body)
+    raise ValueError('Unsupported content_encoding: {}'.format(content_encoding))
+
+
+def dumps(msg, content_type=JSON):
+    if content_type == MSGPACK:
+        return msgpack.packb(msg, use_bin_type=True)
+    return json.dumps(msg).encode('utf-8')
+
+
+def loads(body, content_type=JSON):
+    if content_type == MSGPACK:
+        return msgpack.unpackb(body, raw=False)
+    return json.loads(body.decode('utf-8'))
+
+
+def decode(body, properties=None):
+    """ :return: <dict> message in body, as described by AMQP properties (pika BasicProperties)
+        bodies without properties are JSON.
+    """
+    content_type = getattr(properties, 'content_type', None) or JSON
+    content_encoding = getattr(properties, 'content_encoding', None)
+    if content_encoding:
+        body = decompress(body, content_encoding)
+    return loads(body, content_type)
+
+
+class Codec:
+    def __init__(self, name=DEFAULT_CODEC, compress_threshold=DEFAULT_COMPRESS_THRESHOLD):
+        fmt, _, compression = name.partition('+')
+        if fmt not in formats or (compression and compression not in compressions):
+            raise ValueError('Unknown codec: {}'.format(name))
+        self.name = name
+        self.content_type = formats[fmt]
+        self.compression = compression or None
+        self.compress_threshold = compress_threshold
+        if not is_available(self.content_type, self.compression):
+            raise ImportError('Codec {} not available: missing optional dependency'.format(name))
+        self._properties = {}  # (content_encoding, delivery_mode, priority) -> BasicProperties
+
+    def encode(self, msg):
+        """ :return: (body, content_encoding). content_encoding is None if not compressed.
+        """
+        body = dumps(msg, self.content_type)
+        if self.compression and len(body) >= self.compress_threshold:
+            return compress(body, self.compression), self.compression
+        return body, None
+
+    def properties(self, content_encoding=None, delivery_mode=2, priority=None):
+        """ :return: BasicProperties describing bodies of this codec. Instances are reused.
+        """
+        key = (content_encoding, delivery_mode, priority)
+        if key not in self._properties:
+            self._properties[key] = pika.BasicProperties(
+                content_type=self.content_type,
+                content_encoding=content_encoding,
+                headers={CODEC_HEADER: self.name},
+                delivery_mode=delivery_mode,
+                priority=priority)
+        return self._properties[key]
+
+
+shared_codecs = {}  # name -> Codec, created by get_codec
+
+
+def get_codec(name=None):
+    """ :return: shared Codec instance for name, default json.
+    """
+    name = name or DEFAULT_CODEC
+    if name not in shared_codecs:
+        shared_codecs[name] = Codec(name)
+    return shared_codecs[name]
+
+
+def get_reply_codec(properties=None):
+    """ :return: Codec to reply to a request received with properties: the request codec if
+        available in this process, json otherwise.
+    """
+    headers = getattr(properties, 'headers', None) or {}
+    name = headers.get(CODEC_HEADER)
+    if isinstance(name, bytes) and not isinstance(name, str):  # python 3 pika header value
+        name = name.decode('utf-8')
+    try:
+        return get_codec(name)
+    except (ValueError, ImportError):
+        return get_codec(DEFAULT_CODEC)
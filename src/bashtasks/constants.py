@@ -10,13 +10,16 @@ TASK_RESPONSES_POOL = 'bashtasks:pool:responses'
 TASK_REQUESTS_POOL = 'bashtasks:pool:requests'
 RESPONSES = 'responses'
 REQUESTS = 'requests'
+MAX_PRIORITY = 10  # x-max-priority of bashtasks queues. Task priorities go from 0 to MAX_PRIORITY
+PERSISTENT = 2  # AMQP delivery_mode of persistent messages, the default
+TRANSIENT = 1  # AMQP delivery_mode of messages not written to disk by the broker
 
 
 class Destination(Enum):
     responses_pool = 1
     responses_exclusive = 2
     requests_pool = 3
-    requests_exclusive = 3
+    requests_exclusive = 4
 
 
 class DestinationNames:
@@ -25,8 +28,8 @@ class DestinationNames:
         Destination.responses_exclusive: lambda: ':'.join((BASHTASKS, str(getpid()),
                                                            gethostname(), RESPONSES)),
         Destination.requests_pool: lambda: TASK_REQUESTS_POOL,
-        Destination.responses_exclusive: lambda: ':'.join((BASHTASKS, str(getpid()),
-                                                           gethostname(), REQUESTS))
+        Destination.requests_exclusive: lambda: ':'.join((BASHTASKS, str(getpid()),
+                                                          gethostname(), REQUESTS))
     }
 
     @classmethod
@@ -0,0 +1,174 @@
+""" csv_writer writes CSV rows from a background thread, so disk I/O is off the thread
+    tracking messages (eg: the responses_recvr consumer, before it acks).
+
+    Rows are queued (bounded: write blocks while max_queue rows are pending), written in
+    batches and flushed every batch_size rows or flush_interval secs, whichever comes first.
+    So a row is in the OS page cache at most flush_interval secs after write returns
+    (on disk too with fsync=True), and close() returns only once every row is written.
+
+    Optional output:
+      - rotate_bytes: starts a new file, with headers, when the current one exceeds
+        rotate_bytes (uncompressed): stats.csv, stats.1.csv, stats.2.csv...
+      - gzip: files are gzip compressed, with .gz suffix.
+"""
+import gzip
+import os
+import threading
+import time
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+from bashtasks.logger import get_logger
+
+DEFAULT_BATCH_SIZE = 500  # rows
+DEFAULT_FLUSH_INTERVAL = 1.0  # secs
+DEFAULT_MAX_QUEUE = 10000  # rows
+SEPARATOR = ';'
+
+
+def curr_module_name():
+    return os.path.splitext(os.path.basename(__file__))[0]
+
+
+def get_segment_path(filepath, segment, gzip_output=False):
+    """ :return: path of the segment-th file of filepath: stats.csv, stats.1.csv...
+    """
+    if segment:
+        base, ext = os.path.splitext(filepath)
+        filepath = '{}.{}{}'.format(base, segment, ext)
+    return filepath + '.gz' if gzip_output else filepath
+
+
+class _Flush:
+    """ queue marker: set once every row queued before it is flushed.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class CsvWriter:
+    def __init__(self, filepath, fields, batch_size=DEFAULT_BATCH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, max_queue=DEFAULT_MAX_QUEUE,
+                 rotate_bytes=None, gzip_output=False, fsync=False):
+        self.filepath = filepath
+        self.fields = fields
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rotate_bytes = rotate_bytes
+        self.gzip_output = gzip_output
+        self.fsync = fsync
+        self.rows_written = 0
+        self.segment = 0
+        self._file = None
+        self._file_bytes = 0
+        self._closed = False
+        self._rows = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(target=self._write_loop, name='csv_writer_th')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, msg):
+        """ queues the fields of msg <dict> as a row. Blocks while the queue is full.
+        """
+        if self._closed:
+            raise ValueError('CsvWriter of {} is closed'.format(self.filepath))
+        self._rows.put(tuple(msg.get(field, '') for field in self.fields))
+
+    def flush(self, timeout=None):
+        """ blocks until rows written so far are flushed.
+            :return: False on timeout
+        """
+        marker = _Flush()
+        self._rows.put(marker)
+        return marker.done.wait(timeout)
+
+    def close(self, timeout=None):
+        """ writes all pending rows and closes the file.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._rows.put(None)
+        self._thread.join(timeout)
+
+    def current_path(self):
+        return get_segment_path(self.filepath, self.segment, self.gzip_output)
+
+    def _open(self):
+        path = self.current_path()
+        self._file = gzip.open(path, 'wb') if self.gzip_output else open(path, 'wb')
+        self._file_bytes = 0
+        self._write_lines([SEPARATOR.join(self.fields) + '\n'])
+
+    def _write_lines(self, lines):
+        data = ''.join(lines).encode('utf-8')
+        self._file.write(data)
+        self._file_bytes += len(data)
+
+    def _flush_file(self):
+        self._file.flush()
+        if self.fsync and not self.gzip_output:
+            os.fsync(self._file.fileno())
+
+    def _write_batch(self, rows):
+        if self._file is None:
+            self._open()
+        elif self.rotate_bytes and self._file_bytes >= self.rotate_bytes:
+            self._file.close()
+            self.segment += 1
+            self._open()
+        self._write_lines([SEPARATOR.join(str(value) for value in row) + '\n' for row in rows])
+        self.rows_written += len(rows)
+
+    def _next_items(self, timeout):
+        """ :return: items queued, waiting up to timeout secs for the first one
+            and taking the rest without blocking, up to batch_size.
+        """
+        try:
+            items = [self._rows.get(True, timeout)]
+        except queue.Empty:
+            return []
+        while len(items) < self.batch_size:
+            try:
+                items.append(self._rows.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def _write_loop(self):
+        logger = get_logger(name=curr_module_name())
+        unflushed = 0  # rows written since last flush
+        last_flush = time.time()
+        running = True
+        while running:
+            timeout = last_flush + self.flush_interval - time.time() if unflushed \
+                else self.flush_interval
+            items = self._next_items(max(0, timeout))
+            rows = [item for item in items if isinstance(item, tuple)]
+            markers = [item for item in items if isinstance(item, _Flush)]
+            running = None not in items
+            if rows:
+                try:
+                    self._write_batch(rows)
+                    unflushed += len(rows)
+                except Exception as e:
+                    logger.error('Exception writing %d rows to %s: %s', len(rows),
+                                 self.current_path(), repr(e))
+            if unflushed and (unflushed >= self.batch_size or markers or not running
+                              or time.time() - last_flush >= self.flush_interval):
+                try:
+                    self._flush_file()
+                except Exception as e:
+                    logger.error('Exception flushing %s: %s', self.current_path(), repr(e))
+                unflushed = 0
+            if not unflushed:
+                last_flush = time.time()
+            for marker in markers:
+                marker.done.set()
+
+        if self._file is None:  # no rows: headers only
+            self._open()
+        self._file.close()
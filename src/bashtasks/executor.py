@@ -3,26 +3,65 @@
 """
 import signal
 import argparse
-import subprocess
-import sys
-import json
 import time
 import os
 import threading
+import uuid
+from collections import deque
 from socket import gethostname
 from time import sleep
 import logging
-import pika
 
-from bashtasks.rabbit_util import connect_and_declare, close_channel_and_conn
+from bashtasks.rabbit_util import connect_and_declare, declare_destinations
+from bashtasks.rabbit_util import declare_routed_queue, get_task_route
 from bashtasks.constants import DestinationNames, TASK_REQUESTS_POOL, TASK_RESPONSES_POOL
-from bashtasks.logger import get_logger
+from bashtasks.logger import get_logger, log_fields
+from bashtasks.task_slots import TaskSlots
+from bashtasks.codec import decode, get_reply_codec
+from bashtasks.output_capture import TRUNCATE, FILE, CHUNKS, DEFAULT_CHUNK_SIZE, TIMEOUT_RETURNCODE
+from bashtasks.output_capture import HeadTailSink, FileSink, ChunkSink, get_chunk_msg
+from bashtasks.output_capture import spawn_process, capture_output
+from bashtasks.fork_server import ForkServer, DEFAULT_PATTERN
+from bashtasks.retry import EXPONENTIAL, DEFAULT_RETRY_DELAY, DEFAULT_RETRY_MAX_DELAY
+from bashtasks.retry import get_retry_delay, quantize_delay, declare_delay_queue
+from bashtasks.result_cache import ResultCache, InFlight, DEFAULT_MAX_ENTRIES
+from bashtasks.result_cache import is_cacheable, get_cache_key, get_result
+from bashtasks.message import is_batch, get_delivery_mode
+from bashtasks.admission import AdmissionController
+from bashtasks import metrics
 
 channels = []  # stores all executor thread channels.
 stop = False  # False until the executor is asked to stop
 MB_10 = 10485760
+SLOTS_BUSY_POLL = 0.01  # secs between checks for finished tasks while slots are busy
+SLOTS_IDLE_POLL = 1  # secs waiting for messages while slots are idle
 
 DEFAULT_DESTINATION = DestinationNames.get_for(TASK_REQUESTS_POOL)
+TASK_RECORD_FIELDS = ('correlation_id', 'command', 'returncode', 'retries', 'cached', 'timed_out',
+                      'pre_command_ts', 'spawned_ts', 'post_command_ts')
+
+tasks_consumed = metrics.registry.counter('bashtasks_executor_tasks_consumed_total',
+                                          'Task msgs received.')
+tasks_acked = metrics.registry.counter('bashtasks_executor_tasks_acked_total',
+                                       'Tasks responded and acked.')
+tasks_retried = metrics.registry.counter('bashtasks_executor_tasks_retried_total',
+                                         'Failed tasks published to be retried.')
+tasks_failed = metrics.registry.counter('bashtasks_executor_tasks_failed_total',
+                                        'Tasks with a returncode not ok.', ('returncode', ))
+tasks_requeued = metrics.registry.counter('bashtasks_executor_tasks_requeued_total',
+                                          'Tasks not admitted, given back to their queue.')
+tasks_in_flight = metrics.registry.gauge('bashtasks_executor_tasks_in_flight',
+                                         'Tasks received, not acked yet.')
+spawn_seconds = metrics.registry.histogram('bashtasks_executor_spawn_seconds',
+                                           'Secs starting command processes.')
+execution_seconds = metrics.registry.histogram('bashtasks_executor_execution_seconds',
+                                               'Secs running tasks, not cached.')
+queue_wait_seconds = metrics.registry.histogram('bashtasks_executor_queue_wait_seconds',
+                                                'Secs from request, or retry time, to run.')
+publish_seconds = metrics.registry.histogram('bashtasks_executor_publish_seconds',
+                                             'Secs publishing responses, retries and chunks.')
+output_bytes = metrics.registry.counter('bashtasks_executor_output_bytes_total',
+                                        'Bytes of output of commands.', ('stream', ))
 
 
 def curr_module_name():
@@ -41,9 +80,95 @@ def get_thread_name(worker):
     return 'worker_th_' + str(worker)
 
 
+def get_task_record(msg):
+    """ :return: <dict> fields of msg in the JSON log records of its task.
+    """
+    return dict((field, msg[field]) for field in TASK_RECORD_FIELDS if field in msg)
+
+
+def log_received(logger, worker_name, queue, msg):
+    if logger.isEnabledFor(logging.DEBUG):  # per task: nothing is formatted at INFO
+        logger.debug(">>>> msg received: %s from queue %s : correlation_id %d command: %s",
+                     worker_name, queue, msg['correlation_id'], msg['command'][:50],
+                     extra={'fields': get_task_record(msg)})
+
+
+def log_executed(logger, worker_name, response_msg, pending):
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("<<<< executed by: executor %s correlation_id: %d pending: %d",
+                     worker_name, response_msg['correlation_id'], pending,
+                     extra={'fields': get_task_record(response_msg)})
+
+
+def get_reply_route(reply_to):
+    """ :return: (exchange, routing_key) to publish a response to reply_to.
+        The responses pool is an exchange. Any other reply_to is a queue, reached through the
+        default exchange: exclusive reply queues of execute_task callers, or exclusive destinations.
+        If the queue no longer exists (its client is gone) the response is dropped by the broker.
+    """
+    if not reply_to or reply_to == TASK_RESPONSES_POOL:
+        return TASK_RESPONSES_POOL, ''
+    return '', reply_to
+
+
+def run_parallel(fn, items, parallelism=1):
+    """ calls fn(item) for every item, up to parallelism at a time. fn must not raise.
+        returns once every call is done.
+    """
+    if parallelism <= 1 or len(items) <= 1:
+        for item in items:
+            fn(item)
+        return
+    pending = iter(items)
+    pending_lock = threading.Lock()
+
+    def run_pending():
+        while True:
+            with pending_lock:
+                item = next(pending, None)
+            if item is None:
+                return
+            fn(item)
+
+    threads = [threading.Thread(target=run_pending) for _ in range(min(parallelism, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
 def start_executors(workers=1, host='127.0.0.1', port=5672, usr='guest', pas='guest',
                     queue=DEFAULT_DESTINATION, tasks_nr=1, max_retries=0, verbose=False,
-                    custom_callback=None, ok_returncodes=(0, )):
+                    custom_callback=None, ok_returncodes=(0, ), slots=1,
+                    output_policy=TRUNCATE, output_cap=MB_10, output_dir=None,
+                    chunk_size=DEFAULT_CHUNK_SIZE, passive_declare=False,
+                    retry_policy=EXPONENTIAL, retry_delay=DEFAULT_RETRY_DELAY,
+                    retry_max_delay=DEFAULT_RETRY_MAX_DELAY, cache_size=DEFAULT_MAX_ENTRIES,
+                    cache_dir=None, fork_server=False, fork_server_pattern=DEFAULT_PATTERN,
+                    fork_server_preload=(), command_timeout=None, routing_patterns=(),
+                    max_load=None, min_free_mem_mb=None, max_children=None,
+                    metrics_port=None, transport=None):
+    """ fork_server: run python commands matching fork_server_pattern in processes forked
+                   from an interpreter with fork_server_preload modules imported.
+                   See fork_server module.
+        max_load, min_free_mem_mb, max_children: host thresholds workers stop consuming at,
+                   until the host admits tasks again. See admission module.
+        metrics_port: serves metrics at http://<host>:<metrics_port>/metrics. See metrics module.
+        transport: name or instance, see transport module. Default: pika. Workers on 'memory'
+                   run the tasks of clients of this process.
+    """
+    if metrics_port is not None:
+        metrics.serve(metrics_port)
+    result_cache = ResultCache(max_entries=cache_size, store_dir=cache_dir)  # shared by workers
+    in_flight = InFlight()
+    fork_server = ForkServer(preload=fork_server_preload,
+                             pattern=fork_server_pattern) if fork_server else None
+    admission = None
+    if (max_load, min_free_mem_mb, max_children) != (None, None, None):
+        admission = AdmissionController(max_load=max_load, min_free_mem_mb=min_free_mem_mb,
+                                        max_children=max_children)
+        if fork_server:
+            admission.watch(fork_server.pid)
     worker_ths = []
     for worker in range(0, workers):
         worker_th = threading.Thread(target=start_executor,
@@ -51,7 +176,21 @@ def start_executors(workers=1, host='127.0.0.1', port=5672, usr='guest', pas='gu
                                               'queue': queue, 'tasks_nr': tasks_nr,
                                               'max_retries': max_retries, 'verbose': verbose,
                                               'custom_callback': custom_callback,
-                                              'ok_returncodes': ok_returncodes}),
+                                              'ok_returncodes': ok_returncodes,
+                                              'slots': slots, 'output_policy': output_policy,
+                                              'output_cap': output_cap, 'output_dir': output_dir,
+                                              'chunk_size': chunk_size,
+                                              'passive_declare': passive_declare,
+                                              'retry_policy': retry_policy,
+                                              'retry_delay': retry_delay,
+                                              'retry_max_delay': retry_max_delay,
+                                              'result_cache': result_cache,
+                                              'in_flight': in_flight,
+                                              'fork_server': fork_server,
+                                              'command_timeout': command_timeout,
+                                              'routing_patterns': routing_patterns,
+                                              'admission': admission,
+                                              'transport': transport}),
                                      name=get_thread_name(worker))
         worker_th.daemon = True
 
@@ -60,18 +199,59 @@ def start_executors(workers=1, host='127.0.0.1', port=5672, usr='guest', pas='gu
 
     while not stop:
         sleep(1)
+    if fork_server:
+        fork_server.stop()
 
 
 def start_executor(host='127.0.0.1', port=5672, usr='guest', pas='guest', queue=DEFAULT_DESTINATION,
                    tasks_nr=1, max_retries=0, verbose=False, custom_callback=None,
-                   ok_returncodes=(0, )):
+                   ok_returncodes=(0, ), slots=1, output_policy=TRUNCATE, output_cap=MB_10,
+                   output_dir=None, chunk_size=DEFAULT_CHUNK_SIZE, passive_declare=False,
+                   retry_policy=EXPONENTIAL, retry_delay=DEFAULT_RETRY_DELAY,
+                   retry_max_delay=DEFAULT_RETRY_MAX_DELAY, result_cache=None, in_flight=None,
+                   fork_server=None, command_timeout=None, routing_patterns=(),
+                   admission=None, channel=None, transport=None):
+    """ starts consuming tasks from queue, in the current thread.
+        slots: tasks executed concurrently over this executor's single connection.
+               slots=1 executes tasks one at a time in the consumer thread.
+        output_policy: default for tasks not setting it. One of output_capture.OUTPUT_POLICIES
+        output_cap: truncate policy default max bytes kept per stream.
+        output_dir: directory for file policy outputs. Without it, file policy truncates.
+        chunk_size: chunks policy bytes of output per chunk message.
+        passive_declare: verify the queue exists instead of declaring it, see declare_and_bind.
+        retry_policy, retry_delay, retry_max_delay: defaults for tasks not setting them.
+               Failed tasks are retried in queue once their delay expires, see retry module.
+        result_cache: ResultCache of cacheable tasks. Default: in memory, for this executor.
+        in_flight: InFlight cacheable tasks running, shared with the executors of result_cache.
+               Cacheable tasks received while the same command runs, in any of them, get its
+               result. Default: for this executor.
+        fork_server: ForkServer running the commands it handles, instead of a new process.
+        command_timeout: default secs commands may run, for tasks not setting it. None: forever.
+               Commands are then killed, with their process group, and responded with
+               TIMEOUT_RETURNCODE, timed_out and the output captured so far.
+        routing_patterns: topic patterns (eg: gpu.#) of the tasks with routing_key consumed
+               too, from their routed queues. See rabbit_util.declare_routed_queue.
+        admission: AdmissionController admitting tasks run. Tasks not admitted are requeued
+               and consumption paused until the host admits tasks again.
+        channel: consume from channel instead of connecting to host (eg: a
+               memory_broker channel). Its connection must be used by this thread only.
+        transport: name or instance connecting to host, see transport module. Default: pika.
+    """
     curr_th_name = threading.current_thread().name
     logger = get_logger(name=curr_module_name())
     logger.info(">> Starting executor %s connecting to rabbitmq: %s:%s@%s for executing %d tasks.",
                 curr_th_name, usr, pas, host, tasks_nr)
 
-    ch = connect_and_declare(host=host, port=port, usr=usr, pas=pas, destinations=queue)
-    ch.basic_qos(prefetch_count=1)  # consume msgs one at a time
+    if channel is None:
+        ch = connect_and_declare(host=host, port=port, usr=usr, pas=pas, destinations=queue,
+                                 passive=passive_declare, transport=transport)
+    else:
+        ch = declare_destinations(channel, [queue], passive=passive_declare)
+    queues = [queue] + [declare_routed_queue(ch, queue, pattern) for pattern in routing_patterns]
+    # consume as many msgs as tasks can be run at a time: tasks not started yet stay in the
+    # queue, where higher priority tasks overtake them. The limit is per channel if several
+    # queues are consumed.
+    ch.basic_qos(prefetch_count=slots, all_channels=len(queues) > 1)
 
     channels.append(ch)
 
@@ -95,21 +275,71 @@ def start_executor(host='127.0.0.1', port=5672, usr='guest', pas='guest', queue=
         retries_pending = current_retries < msg_max_retries
         return is_error and is_retriable and retries_pending
 
-    def send_response(response_msg):
+    def get_retry_route(response_msg):
+        """ :return: (exchange, routing_key) to publish a retry to, after its delay.
+            sets next_retry_ts of response_msg.
+        """
+        delay = quantize_delay(get_retry_delay(
+            response_msg.get('retry_policy', retry_policy), response_msg['retries'],
+            response_msg.get('retry_delay', retry_delay),
+            response_msg.get('retry_max_delay', retry_max_delay)))
+        response_msg['next_retry_ts'] = currtimemillis() + delay
+        if delay:
+            return '', declare_delay_queue(ch, queue, delay, response_msg.get('routing_key'))
+        return get_task_route(ch, queue, response_msg.get('routing_key'))
+
+    def send_response(response_msg, reply_codec):
         if should_retry(response_msg):
-            logger.debug('---- retrying msg correlation_id: %d current_retries: %d of %d',
-                         response_msg['correlation_id'], response_msg['retries'],
-                         response_msg['max_retries'])
-            tgt_exch = TASK_REQUESTS_POOL
+            tgt_exch, routing_key = get_retry_route(response_msg)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('---- retrying msg correlation_id: %d current_retries: %d of %d '
+                             'at: %d', response_msg['correlation_id'], response_msg['retries'],
+                             response_msg['max_retries'], response_msg['next_retry_ts'])
             response_msg['retries'] += 1
+            tasks_retried.inc()
         else:
-            tgt_exch = TASK_RESPONSES_POOL
-
-        response_str = json.dumps(response_msg)
-        props = pika.BasicProperties(
-                             delivery_mode=2,  # make message persistent
-                          )
-        ch.basic_publish(exchange=tgt_exch, routing_key='', body=response_str, properties=props)
+            tgt_exch, routing_key = get_reply_route(response_msg.get('reply_to'))
+
+        publish(tgt_exch, routing_key, response_msg, reply_codec, get_delivery_mode(response_msg))
+
+    def send_chunk(chunk_msg, msg, reply_codec):
+        tgt_exch, routing_key = get_reply_route(msg.get('reply_to'))
+        publish(tgt_exch, routing_key, chunk_msg, reply_codec, get_delivery_mode(msg))
+
+    def publish(tgt_exch, routing_key, msg, reply_codec, delivery_mode):
+        """ delivery_mode: of the task msg responded, responses are as persistent as requests.
+        """
+        body, content_encoding = reply_codec.encode(msg)
+        props = reply_codec.properties(content_encoding, delivery_mode=delivery_mode,
+                                       priority=msg.get('priority'))
+        start = time.time()
+        ch.basic_publish(exchange=tgt_exch, routing_key=routing_key, body=body,
+                         properties=props)
+        publish_seconds.observe(time.time() - start)
+
+    def in_channel_thread(fn, *args):
+        if task_slots:
+            task_slots.defer(fn, *args)
+        else:
+            fn(*args)
+
+    def get_output_sink(msg, reply_codec, stream, run_id):
+        """ run_id: unique id of this run, in file names: clients sharing output_dir may post
+                   tasks with the same correlation_id.
+        """
+        policy = msg.get('output_policy', output_policy)
+        if policy == FILE and output_dir:
+            filename = '{}.{}.{}.{}'.format(msg['correlation_id'], msg.get('retries', 0), run_id,
+                                            stream)
+            return FileSink(os.path.join(output_dir, filename))
+        if policy == CHUNKS:
+            executor_name = get_executor_name()
+
+            def emit(chunk_seq, data):
+                chunk_msg = get_chunk_msg(msg, stream, chunk_seq, data, executor_name)
+                in_channel_thread(send_chunk, chunk_msg, msg, reply_codec)
+            return ChunkSink(emit, chunk_size=chunk_size)
+        return HeadTailSink(msg.get('output_cap', output_cap))
 
     def tasks_nr_generator(tasks_nr):
         tasks_nr_gen = tasks_nr
@@ -118,35 +348,105 @@ def start_executor(host='127.0.0.1', port=5672, usr='guest', pas='guest', queue=
             yield tasks_nr_gen
 
     def trace_msg(msg, context_info=''):
-        logger.info(u'------------- MSG: %s', context_info)
-        for key, value in msg.items():
-            try:
-                logger.info(u'\t%s:-> %s', key, value)
-            except Exception as e:
-                logger.error('error in trace message::::', exc_info=True)
-                sys.exit(777)
-        logger.info('---------------------------------------------')
-
-    def execute_command(command):
-        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        o, e = p.communicate()
-
-        return p.returncode, o.decode('utf-8'), e.decode('utf-8')
-
-    def handle_message(ch, method, properties, body):
-        msg = json.loads(body.decode('utf-8'))
-        logger.debug(">>>> msg received: %s from queue %s : correlation_id %d command: %s",
-                     curr_th_name, queue, msg['correlation_id'], msg['command'][:50])
+        log_fields(logger, logging.INFO, u'------------- MSG: ' + context_info, msg)
+
+    def spawn(command, response_msg):
+        """ starts command, in the fork server if it handles it. sets spawned_ts of response_msg:
+            spawn time is spawned_ts - pre_command_ts, run time post_command_ts - spawned_ts.
+            :return: process running command
+        """
+        start = time.time()
+        if fork_server and fork_server.handles(command):
+            process = fork_server.spawn(command)
+        else:
+            process = spawn_process(command)
+        spawn_seconds.observe(time.time() - start)
+        response_msg['spawned_ts'] = currtimemillis()
+        return process
+
+    def observe_output(stdout_sink, stderr_sink):
+        output_bytes.inc(stdout_sink.total, labels=('stdout', ))
+        output_bytes.inc(stderr_sink.total, labels=('stderr', ))
+
+    def execute_command(msg, reply_codec, response_msg):
+        """ runs msg command, capturing its output as per the task output_policy.
+            :return: returncode
+        """
+        run_id = uuid.uuid4().hex
+        stdout_sink = get_output_sink(msg, reply_codec, 'stdout', run_id)
+        stderr_sink = get_output_sink(msg, reply_codec, 'stderr', run_id)
+        returncode = capture_output(spawn(msg['command'], response_msg), stdout_sink, stderr_sink,
+                                    timeout=msg.get('command_timeout', command_timeout))
+        if returncode == TIMEOUT_RETURNCODE:
+            response_msg['timed_out'] = True
+        observe_output(stdout_sink, stderr_sink)
+        stdout_sink.fill(response_msg, 'stdout')
+        stderr_sink.fill(response_msg, 'stderr')
+        return returncode
+
+    def run_batch_command(item, item_output_cap, item_timeout):
+        """ runs the command of a batch item, setting its result fields. Never raises.
+            Its output is truncated to item_output_cap bytes per stream, killed after
+            item_timeout secs.
+        """
+        item['pre_command_ts'] = currtimemillis()
+        try:
+            if custom_callback:
+                item['returncode'], item['stdout'], item['stderr'] = \
+                    custom_callback(item['command'])
+            else:
+                stdout_sink = HeadTailSink(item_output_cap)
+                stderr_sink = HeadTailSink(item_output_cap)
+                item['returncode'] = capture_output(spawn(item['command'], item),
+                                                    stdout_sink, stderr_sink, timeout=item_timeout)
+                if item['returncode'] == TIMEOUT_RETURNCODE:
+                    item['timed_out'] = True
+                observe_output(stdout_sink, stderr_sink)
+                stdout_sink.fill(item, 'stdout')
+                stderr_sink.fill(item, 'stderr')
+        except Exception as exc:
+            logger.error('**** Batch command execution error. Exception for : %s',
+                         item['command'], exc_info=True)
+            item['returncode'] = -3791
+            item['stdout'] = 'Exception trying to execute command.'
+            item['stderr'] = repr(exc)
+        item['post_command_ts'] = currtimemillis()
+
+    def execute_batch(msg, response_msg):
+        """ runs the batch commands not succeeded in previous tries, up to its batch_parallelism
+            at a time. Their results are set in the batch field of response_msg.
+            :return: returncode of the first failed command, 0 if none failed.
+        """
+        items = [dict(item) for item in msg['batch']]
+        response_msg['batch'] = items
+        batch_output_cap = msg.get('output_cap', output_cap)
+        batch_timeout = msg.get('command_timeout', command_timeout)
+        run_parallel(lambda item: run_batch_command(item, batch_output_cap, batch_timeout),
+                     [item for item in items if not is_ok_returncode(item.get('returncode'))],
+                     msg.get('batch_parallelism', 1))
+        failed = [item for item in items if not is_ok_returncode(item['returncode'])]
+        return failed[0]['returncode'] if failed else 0
+
+    def run_task(task):
+        """ executes the command of task: (msg, reply_codec). Never raises.
+            :return: response_msg
+        """
+        msg, reply_codec = task
+        response_msg = create_response_for(msg)
         try:
-            response_msg = create_response_for(msg)
             response_msg['pre_command_ts'] = currtimemillis()
 
-            returncode, out, err = command_callback(msg['command'])
+            if is_batch(msg):
+                returncode = execute_batch(msg, response_msg)
+            elif custom_callback:
+                returncode, out, err = custom_callback(msg['command'])
+                response_msg['stdout'] = out
+                response_msg['stderr'] = err
+            else:
+                returncode = execute_command(msg, reply_codec, response_msg)
 
             response_msg['post_command_ts'] = currtimemillis()
             response_msg['returncode'] = returncode
-            response_msg['stdout'] = out
-            response_msg['stderr'] = err
 
         except Exception as exc:
             logger.error('**** Command execution error. Exception for : correlation_id %d ',
@@ -155,32 +455,187 @@ def start_executor(host='127.0.0.1', port=5672, usr='guest', pas='guest', queue=
             response_msg['returncode'] = -3791
             response_msg['stdout'] = 'Exception trying to execute command.'
             response_msg['stderr'] = repr(exc)
-        finally:
+        return response_msg
+
+    def uses_cache(msg):
+        return is_cacheable(msg) and not is_batch(msg) and \
+            msg.get('output_policy', output_policy) != CHUNKS
+
+    def cache_key(msg):
+        return get_cache_key(msg, output_policy=output_policy, output_cap=output_cap)
+
+    def create_cached_response(msg, result):
+        response_msg = create_response_for(msg)
+        response_msg.update(result)
+        response_msg['pre_command_ts'] = response_msg['post_command_ts'] = currtimemillis()
+        response_msg['cached'] = True
+        return response_msg
+
+    def serve_from_cache(method, task):
+        """ responds task with a cached result, or with the result of the same command
+            running now, once done.
+            :return: False if task has to be run.
+        """
+        msg = task[0]
+        key = cache_key(msg)
+        if in_flight.wait_for(key, answered, (method, task)):
+            consumers['waiting'] += 1
+            return True
+        result = result_cache.get(key)
+        if result is not None:  # cached once checked for running
+            complete_task(method, task, create_cached_response(msg, result))
+            in_flight.done(key, result)
+            return True
+        return False
+
+    def cache_result(msg, response_msg):
+        """ caches the result of an executed cacheable task and answers the tasks waiting for it,
+            in this or other executors. On error they are run on their own.
+        """
+        result = None
+        if is_ok_returncode(response_msg['returncode']):
+            result = get_result(response_msg)
+            result_cache.put(cache_key(msg), result, msg.get('cache_ttl'))
+        in_flight.done(cache_key(msg), result)
+
+    def complete_answered():
+        """ completes the tasks of this executor answered by the cacheable task they waited
+            for: with its result, or run on their own if it failed.
+        """
+        while answered:
+            (method, task), result = answered.popleft()
+            consumers['waiting'] -= 1
+            if result is None:
+                dispatch(method, task)
+            else:
+                complete_task(method, task, create_cached_response(task[0], result))
+
+    def observe_task(msg, response_msg):
+        if not is_ok_returncode(response_msg['returncode']):
+            tasks_failed.inc(labels=(response_msg['returncode'], ))
+        if response_msg.get('cached'):
+            return
+        queued_ts = msg.get('next_retry_ts', msg.get('request_ts'))
+        if queued_ts:
+            queue_wait_seconds.observe(max(0, response_msg['pre_command_ts'] - queued_ts) / 1000.)
+        execution_seconds.observe(
+            (response_msg['post_command_ts'] - response_msg['pre_command_ts']) / 1000.)
+
+    def complete_task(method, task, response_msg):
+        """ responds and acks an executed task. Must run in the channel thread.
+        """
+        msg, reply_codec = task
+        try:
             if verbose or not is_ok_returncode(response_msg['returncode']):
                 trace_msg(msg, context_info='Request msg: '+str(msg['correlation_id']))
                 resp_header = 'Response msg: '+str(response_msg['correlation_id']) + \
                               ' returncode: '+str(response_msg['returncode'])
                 trace_msg(response_msg, context_info=resp_header)
-            send_response(response_msg)
+        finally:
+            send_response(response_msg, reply_codec)
             ch.basic_ack(method.delivery_tag)
+            tasks_acked.inc()
+            tasks_in_flight.dec()
+        observe_task(msg, response_msg)
+
+        if admission and not response_msg.get('cached'):
+            admission.release(msg.get('cost'))
+        if uses_cache(msg) and not response_msg.get('cached'):
+            cache_result(msg, response_msg)
 
         tasks_nr_new_elem = next(tasks_nr_gen)
 
-        logger.debug("<<<< executed by: executor %s correlation_id: %d pending: %d",
-                     curr_th_name, response_msg['correlation_id'], tasks_nr_new_elem)
+        log_executed(logger, curr_th_name, response_msg, tasks_nr_new_elem)
 
         if tasks_nr_new_elem == 0:
             logger.info('==== no more tasks to execute. Exiting.')
             stop_and_exit()
 
-    tasks_nr_gen = tasks_nr_generator(tasks_nr)
+    def requeue(method, task):
+        """ gives a task not admitted back to its queue and pauses consumption. The tasks waiting
+            for its result are run on their own, if admitted.
+        """
+        if uses_cache(task[0]):
+            in_flight.done(cache_key(task[0]), None)
+        ch.basic_nack(method.delivery_tag, requeue=True)
+        tasks_requeued.inc()
+        tasks_in_flight.dec()
+        consumers['pause'] = True
+        consumers['cost'] = task[0].get('cost')
+
+    def dispatch(method, task):
+        if uses_cache(task[0]) and serve_from_cache(method, task):
+            return
+        if admission and not admission.admit(task[0].get('cost')):
+            requeue(method, task)
+            return
+        if task_slots:
+            task_slots.submit(method, task)
+        else:
+            complete_task(method, task, run_task(task))
 
-    command_callback = custom_callback if custom_callback else execute_command
+    def handle_message(ch, method, properties, body):
+        msg = decode(body, properties)
+        log_received(logger, curr_th_name, queue, msg)
+        tasks_consumed.inc()
+        tasks_in_flight.inc()
+        dispatch(method, (msg, get_reply_codec(properties)))
+        complete_answered()
+
+    def consume_queues():
+        consumers['tags'] = [ch.basic_consume(handle_message, queue=consumed, no_ack=False)
+                             for consumed in queues]
+
+    def regulate_consuming():
+        """ pauses consuming once a task is not admitted: msgs prefetched are requeued.
+            Resumes once the host admits the task not admitted: it is likely redelivered first.
+        """
+        if consumers['tags'] and consumers['pause']:
+            for tag in consumers['tags']:
+                ch.basic_cancel(tag)
+            consumers['tags'] = []
+            logger.info('---- executor %s paused, host overloaded. rejected: %d',
+                        curr_th_name, admission.rejected)
+        elif not consumers['tags'] and admission.admits(consumers['cost']):
+            consumers['pause'] = False
+            consume_queues()
+            logger.info('---- executor %s resumed', curr_th_name)
+
+    def consume_polling():
+        """ consumer loop of an executor with slots, admission or in_flight shared: dispatches
+            received msgs, responds and acks tasks finished in slots, or answered by other
+            executors, as soon as each one is done.
+        """
+        try:
+            while ch.is_open and not stop:
+                busy = (task_slots.busy_nr() if task_slots else 0) + consumers['waiting']
+                ch.connection.process_data_events(time_limit=SLOTS_BUSY_POLL if busy
+                                                  else SLOTS_IDLE_POLL)
+                if task_slots:
+                    task_slots.drain(complete_task)
+                complete_answered()
+                if admission:
+                    regulate_consuming()
+        finally:
+            if task_slots:
+                task_slots.stop()
 
-    ch.basic_consume(handle_message, queue=queue, no_ack=False)
-    logger.info("<< Ready: executor %s connected to rabbitmq: %s:%s@%s",
-                curr_th_name, usr, pas, host)
-    ch.start_consuming()
+    tasks_nr_gen = tasks_nr_generator(tasks_nr)
+    result_cache = result_cache or ResultCache()
+    shared_in_flight = in_flight is not None
+    in_flight = in_flight if shared_in_flight else InFlight()
+    answered = deque()  # ((method, task), result) of tasks waiting, once their result is done
+
+    task_slots = TaskSlots(slots, run_task, name=curr_th_name) if slots > 1 else None
+    consumers = {'tags': [], 'pause': False, 'cost': None, 'waiting': 0}
+
+    consume_queues()
+    logger.info("<< Ready: executor %s connected to rabbitmq: %s:%s@%s slots: %d queues: %s",
+                curr_th_name, usr, pas, host, slots, queues)
+    if task_slots or admission or shared_in_flight:
+        consume_polling()
+    else:
+        ch.start_consuming()
 
 
 def stop_ampq_channels():
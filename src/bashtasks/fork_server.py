@@ -0,0 +1,308 @@
+""" fork_server runs python commands in processes forked from a pre-warmed interpreter,
+    saving the interpreter startup and imports of every task.
+
+    The server is a process started by the executor, importing its preload modules once.
+    For every command it forks a child running the script (python script.py args) or module
+    (python -m module args) of the command as __main__. Its stdout and stderr go to named
+    pipes read by the executor, as the output of any other command.
+    Children run in the interpreter of the server (the executor one) and inherit its state:
+    the preloaded modules are already imported. So the default pattern only matches commands
+    naming that interpreter: its path, its name or python<major>.<minor> of its version.
+    Commands naming another python (eg: python3 on a python 2.7 executor) run as usual.
+
+    Protocol, one unix socket connection per command, JSON lines:
+      executor -> server: {command, stdout, stderr}  (paths of the named pipes)
+      child -> executor: {pid, spawned_ts} once its output goes to the pipes
+      server -> executor: {returncode} once the child exits
+"""
+import errno
+import fcntl
+import importlib
+import itertools
+import json
+import os
+import re
+import runpy
+import select
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+READY_TIMEOUT = 30  # secs waiting for the server to listen
+
+
+def get_interpreter_pattern(executable=sys.executable, version=sys.version_info):
+    """ :return: regex of commands run by the interpreter executable of version: its path,
+        its name (eg: python, as on PATH) or python<major>.<minor>, at any path.
+    """
+    versioned = r'(\S*/)?' + re.escape('python{}.{}'.format(version[0], version[1]))
+    names = [re.escape(executable), re.escape(os.path.basename(executable)), versioned]
+    return r'^({})\s'.format('|'.join(names))
+
+
+DEFAULT_PATTERN = get_interpreter_pattern()  # python2.7 script.py, /usr/bin/python2.7 -m module
+
+
+def currtimemillis():
+    return int(round(time.time() * 1000))
+
+
+def send(conn, msg):
+    conn.sendall((json.dumps(msg) + '\n').encode('utf-8'))
+
+
+def read_line(conn_file):
+    line = conn_file.readline()
+    return json.loads(line.decode('utf-8')) if line else {}
+
+
+def get_returncode(status):
+    """ :return: returncode of a waitpid status, negative signal number if killed, as Popen.
+    """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def run_main(command):
+    """ runs the script or module of python command as __main__.
+        :return: its exit code
+    """
+    try:
+        if command[1] == '-m':
+            sys.argv = command[2:]
+            runpy.run_module(str(command[2]),  # python 2: unicode names can't be imported
+                             run_name='__main__', alter_sys=True)
+        else:
+            sys.argv = command[1:]
+            sys.path[0] = os.path.dirname(os.path.abspath(command[1]))
+            runpy.run_path(command[1], run_name='__main__')
+        return 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        sys.stderr.write('{}\n'.format(e.code))
+        return 1
+    except BaseException:
+        traceback.print_exc()
+        return 1
+    finally:
+        for stream in (sys.stdout, sys.stderr):
+            try:
+                stream.flush()
+            except Exception:
+                pass
+
+
+def run_child(conn, request, server_fds):
+    """ runs request command in a forked child, never returns.
+        Its process group is its own, so the whole command can be killed.
+    """
+    returncode = 1
+    try:
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        for fd in server_fds:
+            os.close(fd)
+        os.setpgid(0, 0)
+        for fd, path, flags in ((0, os.devnull, os.O_RDONLY), (1, request['stdout'], os.O_WRONLY),
+                                (2, request['stderr'], os.O_WRONLY)):
+            opened = os.open(path, flags)
+            os.dup2(opened, fd)
+            os.close(opened)  # else output stays open once the command closes fd
+        send(conn, {'pid': os.getpid(), 'spawned_ts': currtimemillis()})
+        conn.close()
+        returncode = run_main(request['command'])
+    finally:
+        os._exit(returncode)
+
+
+def reap(children):
+    """ answers the returncode of exited children: pid -> connection, and forgets them.
+    """
+    while children:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError:  # no children left
+            return
+        if not pid:
+            return
+        conn = children.pop(pid, None)
+        if conn is None:
+            continue
+        try:
+            send(conn, {'returncode': get_returncode(status)})
+        except socket.error:  # executor gone
+            pass
+        conn.close()
+
+
+def serve(socket_path, preload=()):
+    """ forks a child for every command requested through socket_path, until stdin is closed.
+    """
+    for module in preload:
+        try:
+            importlib.import_module(module)
+        except Exception:
+            traceback.print_exc()
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path + '.tmp')
+    listener.listen(128)
+    os.rename(socket_path + '.tmp', socket_path)  # connectable once it exists
+
+    wakeup_r, wakeup_w = os.pipe()  # written on SIGCHLD
+    fcntl.fcntl(wakeup_w, fcntl.F_SETFL, fcntl.fcntl(wakeup_w, fcntl.F_GETFL) | os.O_NONBLOCK)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    signal.set_wakeup_fd(wakeup_w)
+
+    children = {}  # pid -> connection waiting for its returncode
+    stdin = sys.stdin.fileno()
+    while True:
+        try:
+            readable = select.select([listener, wakeup_r, stdin], [], [])[0]
+        except (select.error, OSError) as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        if stdin in readable and not os.read(stdin, 1024):  # executor gone
+            break
+        if wakeup_r in readable:
+            os.read(wakeup_r, 1024)
+        reap(children)
+        if listener in readable:
+            conn, _ = listener.accept()
+            request = read_line(conn.makefile('rb'))
+            if not request:
+                conn.close()
+                continue
+            pid = os.fork()
+            if pid == 0:
+                server_fds = [listener.fileno(), wakeup_r, wakeup_w] + \
+                             [child_conn.fileno() for child_conn in children.values()]
+                run_child(conn, request, server_fds)
+            children[pid] = conn
+
+    listener.close()
+    os.remove(socket_path)
+
+
+class ForkedProcess:
+    """ command run by the fork server, with the stdout, stderr, pid, poll() and wait() of a
+        Popen.
+    """
+    def __init__(self, pid, stdout_fd, stderr_fd, conn, conn_file):
+        self.pid = pid
+        self.stdout = os.fdopen(stdout_fd, 'rb', 0)
+        self.stderr = os.fdopen(stderr_fd, 'rb', 0)
+        self.returncode = None
+        self._conn = conn
+        self._conn_file = conn_file
+
+    def poll(self):
+        """ :return: returncode, None while the command runs. Never blocks.
+        """
+        if self.returncode is None and select.select([self._conn], [], [], 0)[0]:
+            self.wait()
+        return self.returncode
+
+    def wait(self):
+        if self.returncode is None:
+            try:
+                reply = read_line(self._conn_file)
+            finally:
+                self._conn_file.close()
+                self._conn.close()
+            if 'returncode' not in reply:
+                raise Exception('Fork server exited before command pid: {}'.format(self.pid))
+            self.returncode = reply['returncode']
+        return self.returncode
+
+
+class ForkServer:
+    def __init__(self, preload=(), pattern=DEFAULT_PATTERN):
+        """ starts the fork server process, importing the preload modules.
+            pattern: regex matched against commands (argv joined by spaces) run by the server.
+        """
+        self.pattern = re.compile(pattern)
+        self.preload = preload
+        self.dir = tempfile.mkdtemp(prefix='bashtasks_fork_server_')
+        self.socket_path = os.path.join(self.dir, 'server.sock')
+        self._pipes_ids = itertools.count()
+        env = dict(os.environ)
+        package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env['PYTHONPATH'] = os.pathsep.join(path for path in (package_dir,
+                                                              env.get('PYTHONPATH')) if path)
+        self._process = subprocess.Popen([sys.executable, '-m', 'bashtasks.fork_server',
+                                          self.socket_path] + list(preload),
+                                         stdin=subprocess.PIPE, env=env)
+        self._wait_ready()
+
+    def _wait_ready(self):
+        deadline = time.time() + READY_TIMEOUT
+        while not os.path.exists(self.socket_path):
+            if self._process.poll() is not None or time.time() > deadline:
+                self.stop()
+                raise Exception('Fork server not started, preload: {}'.format(self.preload))
+            time.sleep(0.01)
+
+    @property
+    def pid(self):
+        return self._process.pid
+
+    def handles(self, command):
+        """ :return: True if command is a python script or module run, matching the pattern.
+        """
+        if not isinstance(command, list) or len(command) < 2:
+            return False
+        if command[1] == '-m':
+            if len(command) < 3:
+                return False
+        elif command[1].startswith('-'):  # interpreter options: run by the interpreter
+            return False
+        return self.pattern.match(' '.join(command)) is not None
+
+    def spawn(self, command):
+        """ :return: ForkedProcess running command, once started.
+        """
+        pipes_id = next(self._pipes_ids)
+        paths = [os.path.join(self.dir, '{}.{}'.format(pipes_id, stream))
+                 for stream in ('stdout', 'stderr')]
+        fds = []
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn_file = conn.makefile('rb', 0)  # unbuffered: poll selects on conn
+        try:
+            for path in paths:  # read ends opened first: the child opens the write ends
+                os.mkfifo(path)
+                fds.append(os.open(path, os.O_RDONLY | os.O_NONBLOCK))
+            conn.connect(self.socket_path)
+            send(conn, {'command': command, 'stdout': paths[0], 'stderr': paths[1]})
+            started = read_line(conn_file)
+            if 'pid' not in started:
+                raise Exception('Fork server could not start command: {}'.format(command))
+            return ForkedProcess(started['pid'], fds[0], fds[1], conn, conn_file)
+        except Exception:
+            for fd in fds:
+                os.close(fd)
+            conn_file.close()
+            conn.close()
+            raise
+        finally:
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def stop(self):
+        if self._process.poll() is None:
+            self._process.stdin.close()
+            self._process.wait()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    serve(sys.argv[1], preload=sys.argv[2:])
@@ -0,0 +1,81 @@
+""" local_executor: executors running in threads of the client process, on the in-memory
+    transport: tasks posted by the client reach them without a broker, TCP or disk.
+    They run the executor code path of start_executor, so responses are identical to those of
+    executors of a cluster (timestamps, executor_name, retries, output policies...) and
+    TaskStatistics works the same on them.
+    Started by bashtasks.init(local_workers=N), see bashtasks_client.
+"""
+import threading
+import time
+
+from bashtasks import executor
+from bashtasks.rabbit_util import connect_with_retries, close_channel_and_conn
+from bashtasks.result_cache import ResultCache, InFlight
+from bashtasks.transport import get_transport, MEMORY
+
+START_TIMEOUT = 10  # secs waiting for workers to consume
+STOP_TIMEOUT = 5  # secs waiting for each worker to finish its current task on stop
+READY_POLL = 0.01  # secs between checks of workers consuming
+
+
+def get_thread_name(worker):
+    return 'local_worker_th_' + str(worker)
+
+
+class LocalExecutors:
+    def __init__(self, workers=1, transport=MEMORY, **options):
+        """ transport: 'memory' or an InMemoryTransport.
+            options: start_executor options (eg: queue, slots, command_timeout, output_policy)
+        """
+        self.workers = workers
+        self.transport = transport
+        self.queue = options.get('queue', executor.DEFAULT_DESTINATION)
+        self.options = options
+        self._channels = []
+        self._threads = []
+
+    def start(self, timeout=START_TIMEOUT):
+        """ starts workers consuming tasks, each in its own thread and connection. Returns once
+            all of them consume. Workers share a ResultCache and InFlight, as the workers of
+            start_executors.
+        """
+        broker = get_transport(self.transport).broker
+        consumers = broker.consumers.get(self.queue, 0) + self.workers  # once all consume
+        options = dict(self.options, tasks_nr=-1, transport=self.transport)
+        options.setdefault('result_cache', ResultCache())
+        options.setdefault('in_flight', InFlight())
+        executor.stop = False  # set by a previous stop_and_exit of this process
+        for worker in range(self.workers):
+            ch = connect_with_retries(transport=self.transport)
+            self._channels.append(ch)
+            worker_th = threading.Thread(target=executor.start_executor,
+                                         kwargs=dict(options, channel=ch),
+                                         name=get_thread_name(worker))
+            worker_th.daemon = True
+            worker_th.start()
+            self._threads.append(worker_th)
+        deadline = time.time() + timeout
+        while broker.consumers.get(self.queue, 0) < consumers:
+            if time.time() > deadline or not self.is_running():
+                raise Exception('Timeout ({}secs) waiting for local workers to consume {}'
+                                .format(timeout, self.queue))
+            time.sleep(READY_POLL)
+        return self
+
+    def is_running(self):
+        return any(worker_th.is_alive() for worker_th in self._threads)
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        """ stops workers: tasks not acked yet go back to their queue.
+        """
+        for ch in self._channels:
+            connection = ch.connection
+            if ch.is_open:
+                close_channel_and_conn(ch)
+            if connection.is_open:
+                connection.close()
+        for worker_th in self._threads:
+            if worker_th is not threading.current_thread():
+                worker_th.join(timeout)
+        del self._channels[:]
+        del self._threads[:]
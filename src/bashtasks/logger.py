@@ -1,5 +1,77 @@
+""" logger: loggers of bashtasks modules, all writing through the same handler.
+
+    configure() sets, for loggers already created and to be created:
+      - level: DEBUG by default. At INFO and above, per task records are not even formatted.
+      - queued: records are written to stderr by a background thread (QueueListener),
+                not by the thread logging them (eg: the consumer thread of an executor).
+      - json: single line JSON records, with the fields of tasks logged by log_fields.
+"""
+import atexit
+import json
 import logging
 
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+try:
+    from logging.handlers import QueueHandler, QueueListener
+except ImportError:  # python 2
+    import threading
+
+    class QueueHandler(logging.Handler):
+        def __init__(self, records):
+            logging.Handler.__init__(self)
+            self.queue = records
+
+        def prepare(self, record):
+            record.msg = self.format(record)  # args and exc_info merged, as python 3 does
+            record.args = None
+            record.exc_info = None
+            return record
+
+        def emit(self, record):
+            try:
+                self.queue.put_nowait(self.prepare(record))
+            except Exception:
+                self.handleError(record)
+
+    class QueueListener:
+        def __init__(self, records, *handlers):
+            self.queue = records
+            self.handlers = handlers
+            self._thread = None
+
+        def start(self):
+            self._thread = threading.Thread(target=self._monitor, name='log_th')
+            self._thread.daemon = True
+            self._thread.start()
+
+        def _monitor(self):
+            while True:
+                record = self.queue.get()
+                if record is None:
+                    return
+                for handler in self.handlers:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+
+        def stop(self):
+            self.queue.put_nowait(None)
+            self._thread.join()
+            self._thread = None
+
+FORMAT = '%(asctime)s;%(name)s;%(threadName)s;%(levelname)s;%(message)s'
+DATE_FORMAT = '%Y-%m-%d;%H:%M:%S'
+LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+
+settings = {'level': logging.DEBUG, 'queued': False, 'json': False}
+loggers = []  # created by get_logger
+handler = None  # shared by loggers, created on first use
+listener = None  # QueueListener writing records, if queued
+
+
 def hasHandlers(logger):
     """returns True if logger has handlers.
        py2 and py3 compatible implementation
@@ -9,17 +81,94 @@ def hasHandlers(logger):
     else:
         return len(logger.handlers) > 0
 
+
+class JsonFormatter(logging.Formatter):
+    """ formats records as single line JSON objects, with the fields given by log_fields.
+    """
+    def format(self, record):
+        fields = dict(getattr(record, 'fields', {}))
+        fields.update(ts=self.formatTime(record, DATE_FORMAT), logger=record.name,
+                      thread=record.threadName, level=record.levelname, msg=record.getMessage())
+        if record.exc_info:
+            fields['exc'] = self.formatException(record.exc_info)
+        return json.dumps(fields, default=str)
+
+
+def get_formatter():
+    if settings['json']:
+        return JsonFormatter()
+    return logging.Formatter(FORMAT, datefmt=DATE_FORMAT)
+
+
+def get_handler():
+    """ :return: the handler of bashtasks loggers, as per settings.
+    """
+    global handler, listener
+    if handler is None:
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(get_formatter())
+        if settings['queued']:
+            records = queue.Queue()
+            listener = QueueListener(records, stream_handler)
+            listener.start()
+            handler = QueueHandler(records)
+        else:
+            handler = stream_handler
+    return handler
+
+
+def stop_listener():
+    """ writes records queued and stops the background writer, if any.
+    """
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+
+atexit.register(stop_listener)
+
+
+def configure(level=None, queued=None, json_records=None):
+    """ level: <int> or name in LEVELS. None arguments keep their setting.
+    """
+    global handler
+    if level is not None:
+        settings['level'] = logging.getLevelName(level) if level in LEVELS else level
+    if queued is not None:
+        settings['queued'] = queued
+    if json_records is not None:
+        settings['json'] = json_records
+    old_handler = handler
+    stop_listener()
+    handler = None
+    for logger in loggers:
+        if old_handler is not None:
+            logger.removeHandler(old_handler)
+        logger.setLevel(settings['level'])
+        logger.addHandler(get_handler())
+
+
 def get_logger(name=None):
     name = name or __name__
     logger = logging.getLogger(name)
     if hasHandlers(logger):
         return logger
 
-    logger.setLevel(logging.DEBUG)
-    formatter = logging.Formatter('%(asctime)s;%(name)s;%(threadName)s;%(levelname)s;%(message)s',
-                                  datefmt='%Y-%m-%d;%H:%M:%S')
-    ch = logging.StreamHandler()
-    ch.setFormatter(formatter)
-    ch.setLevel(logging.DEBUG)
-    logger.addHandler(ch)
+    logger.setLevel(settings['level'])
+    logger.addHandler(get_handler())
+    loggers.append(logger)
     return logger
+
+
+def log_fields(logger, level, message, fields):
+    """ logs fields (eg: a task msg) in a single record: a JSON record with them, or message
+        followed by a line per field. Nothing is formatted below the logger level.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    if settings['json']:
+        logger.log(level, message, extra={'fields': fields})
+    else:
+        logger.log(level, u'%s\n%s', message,
+                   u'\n'.join(u'\t{}:-> {}'.format(key, value) for key, value in fields.items()))
@@ -0,0 +1,551 @@
+""" memory_broker: in process stand-in of a RabbitMQ broker, for benchmarks, tests and runs where
+    clients and executors share a process: tasks are exchanged at memory speed, with no
+    serialization to a socket, no TCP round-trip and no persistence.
+
+    Used through transport.InMemoryTransport, or directly: MemoryConnection and MemoryChannel
+    have the methods of the pika BlockingConnection and BlockingChannel used by bashtasks, so
+    they can be given wherever a channel is (eg: bashtasks.init(channel=...),
+    start_executor(channel=...), init_subscriber(channel=...)).
+    Semantics kept: topic and default exchanges, alternate-exchange, priority queues
+    (x-max-priority, PRECONDITION_FAILED if redeclared with another one), per queue message TTL
+    and dead lettering (x-message-ttl, x-dead-letter-exchange, x-dead-letter-routing-key),
+    prefetch, ack/nack/reject with requeue,
+    unacked msgs requeued when their channel closes, publisher confirms, exclusive queues
+    deleted with their connection. Not kept: durability, mandatory, flow control.
+
+    Channels are used by one thread at a time, as pika ones. Consumer callbacks run in the
+    thread calling process_data_events or start_consuming of their connection.
+"""
+import heapq
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+import pika
+
+WAIT_INTERVAL = 0.05  # secs max between checks for expired msgs while waiting for events
+UNLIMITED_PREFETCH_BATCH = 100  # msgs delivered per consumer per round without prefetch limit
+
+
+def topic_matches(pattern, routing_key):
+    """ :return: True if the topic binding pattern matches routing_key: dot separated words,
+        '*' matches a word, '#' zero or more.
+    """
+    return words_match(pattern.split('.'), routing_key.split('.'))
+
+
+def words_match(pattern, words):
+    if not pattern:
+        return not words
+    if pattern[0] == '#':
+        return any(words_match(pattern[1:], words[i:]) for i in range(len(words) + 1))
+    if not words:
+        return False
+    return pattern[0] in ('*', words[0]) and words_match(pattern[1:], words[1:])
+
+
+def to_bytes(body):
+    return body if isinstance(body, bytes) else body.encode('utf-8')
+
+
+def not_found(kind, name):
+    return pika.exceptions.ChannelClosed(404, "NOT_FOUND - no {} '{}'".format(kind, name))
+
+
+class Message:
+    def __init__(self, seq, exchange, routing_key, body, properties, expires_ts=None):
+        self.seq = seq
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.body = body
+        self.properties = properties
+        self.expires_ts = expires_ts
+        self.redelivered = False
+
+
+class Exchange:
+    def __init__(self, name, type, arguments=None):
+        self.name = name
+        self.type = type
+        self.arguments = arguments or {}
+        self.bindings = []  # (queue name, binding key)
+
+
+class Queue:
+    def __init__(self, name, arguments=None, exclusive_to=None):
+        arguments = arguments or {}
+        self.name = name
+        self.max_priority = arguments.get('x-max-priority')
+        self.ttl = arguments.get('x-message-ttl')  # ms
+        self.dead_letter_exchange = arguments.get('x-dead-letter-exchange')
+        self.dead_letter_routing_key = arguments.get('x-dead-letter-routing-key')
+        self.exclusive_to = exclusive_to  # connection
+        self._heap = []  # (-priority, seq, msg): highest priority first, then oldest
+
+    def put(self, msg):
+        priority = 0
+        if self.max_priority and msg.properties is not None and msg.properties.priority:
+            priority = min(msg.properties.priority, self.max_priority)
+        heapq.heappush(self._heap, (-priority, msg.seq, msg))
+
+    def get(self):
+        return heapq.heappop(self._heap)[2] if self._heap else None
+
+    def pop_expired(self, now):
+        """ :return: msgs expired at the head of the queue, as RabbitMQ expires them.
+        """
+        expired = []
+        while self._heap and self._heap[0][2].expires_ts is not None and \
+                self._heap[0][2].expires_ts <= now:
+            expired.append(heapq.heappop(self._heap)[2])
+        return expired
+
+    def purge(self):
+        count = len(self._heap)
+        self._heap = []
+        return count
+
+    def size(self):
+        return len(self._heap)
+
+
+class MemoryBroker:
+    """ exchanges and queues shared by the connections of a process, see connect().
+    """
+    def __init__(self):
+        self.exchanges = {'': Exchange('', 'direct')}
+        self.queues = {}
+        self.consumers = {}  # queue name -> consumers nr
+        self.lock = threading.Condition()  # guards the broker state, notified on publish
+        self._seq = itertools.count()
+        self._queue_ids = itertools.count(1)
+        self._ttl_queues = []
+
+    def connect(self):
+        return MemoryConnection(self)
+
+    def exchange_declare(self, name, type, passive=False, arguments=None):
+        with self.lock:
+            if name not in self.exchanges:
+                if passive:
+                    raise not_found('exchange', name)
+                self.exchanges[name] = Exchange(name, type, arguments)
+
+    def queue_declare(self, name, passive=False, arguments=None, exclusive_to=None):
+        """ :return: (queue name, generated if empty, msgs ready, consumers)
+        """
+        with self.lock:
+            if not name:
+                name = 'amq.gen-memory-{}'.format(next(self._queue_ids))
+            if name not in self.queues:
+                if passive:
+                    raise not_found('queue', name)
+                self.queues[name] = Queue(name, arguments, exclusive_to)
+                if self.queues[name].ttl is not None:
+                    self._ttl_queues.append(self.queues[name])
+            elif not passive and (arguments or {}).get('x-max-priority') != \
+                    self.queues[name].max_priority:
+                raise pika.exceptions.ChannelClosed(
+                    406, "PRECONDITION_FAILED - inequivalent arg 'x-max-priority' for queue "
+                         "'{}'".format(name))
+            return name, self.queues[name].size(), self.consumers.get(name, 0)
+
+    def queue_bind(self, queue, exchange, routing_key=''):
+        with self.lock:
+            if exchange not in self.exchanges:
+                raise not_found('exchange', exchange)
+            if queue not in self.queues:
+                raise not_found('queue', queue)
+            binding = (queue, routing_key or '')
+            if binding not in self.exchanges[exchange].bindings:
+                self.exchanges[exchange].bindings.append(binding)
+
+    def queue_purge(self, queue):
+        with self.lock:
+            if queue not in self.queues:
+                raise not_found('queue', queue)
+            return self.queues[queue].purge()
+
+    def queue_delete(self, queue):
+        with self.lock:
+            deleted = self.queues.pop(queue, None)
+            if deleted is None:
+                return 0
+            if deleted in self._ttl_queues:
+                self._ttl_queues.remove(deleted)
+            for exchange in self.exchanges.values():
+                exchange.bindings = [binding for binding in exchange.bindings
+                                     if binding[0] != queue]
+            return deleted.size()
+
+    def exchange_delete(self, exchange):
+        with self.lock:
+            if exchange:
+                self.exchanges.pop(exchange, None)
+
+    def route(self, exchange, routing_key, visited=()):
+        """ :return: names of the queues a msg published to exchange with routing_key goes to.
+            Must hold lock.
+        """
+        if exchange == '':
+            return [routing_key] if routing_key in self.queues else []
+        target = self.exchanges.get(exchange)
+        if target is None or exchange in visited:
+            return []
+        if target.type == 'topic':
+            queues = [queue for queue, key in target.bindings if topic_matches(key, routing_key)]
+        elif target.type == 'fanout':
+            queues = [queue for queue, key in target.bindings]
+        else:
+            queues = [queue for queue, key in target.bindings if key == routing_key]
+        alternate = target.arguments.get('alternate-exchange')
+        if not queues and alternate:
+            return self.route(alternate, routing_key, visited + (exchange, ))
+        return list(OrderedDict.fromkeys(queues))
+
+    def publish(self, exchange, routing_key, body, properties=None):
+        """ :return: nr of queues the msg was routed to.
+        """
+        with self.lock:
+            if exchange not in self.exchanges:
+                raise not_found('exchange', exchange)
+            routed = self._enqueue(exchange, routing_key, to_bytes(body), properties)
+            if routed:
+                self.lock.notify_all()
+            return routed
+
+    def _enqueue(self, exchange, routing_key, body, properties):
+        queues = self.route(exchange, routing_key)
+        now = time.time()
+        for name in queues:
+            queue = self.queues[name]
+            expires_ts = now + queue.ttl / 1000. if queue.ttl is not None else None
+            queue.put(Message(next(self._seq), exchange, routing_key, body, properties,
+                              expires_ts))
+        return len(queues)
+
+    def dead_letter_expired(self):
+        """ moves expired msgs to the dead letter exchange of their queue. Must hold lock.
+        """
+        now = time.time()
+        for queue in list(self._ttl_queues):
+            for msg in queue.pop_expired(now):
+                if queue.dead_letter_exchange is not None:
+                    routing_key = queue.dead_letter_routing_key or msg.routing_key
+                    if self._enqueue(queue.dead_letter_exchange, routing_key, msg.body,
+                                     msg.properties):
+                        self.lock.notify_all()
+
+    def get(self, queue):
+        """ :return: next msg of queue, None if empty or deleted. Must hold lock.
+        """
+        target = self.queues.get(queue)
+        return target.get() if target is not None else None
+
+    def requeue(self, queue, msg):
+        """ puts back a delivered msg, in its original position. Must hold lock.
+        """
+        target = self.queues.get(queue)
+        if target is not None:
+            msg.redelivered = True
+            target.put(msg)
+            self.lock.notify_all()
+
+
+class Consumer:
+    def __init__(self, tag, queue, callback, no_ack):
+        self.tag = tag
+        self.queue = queue
+        self.callback = callback
+        self.no_ack = no_ack
+
+
+class MemoryChannel:
+    def __init__(self, connection, channel_number):
+        self.connection = connection
+        self.channel_number = channel_number
+        self.broker = connection.broker
+        self.is_open = True
+        self._consumers = OrderedDict()  # consumer tag -> Consumer
+        self._unacked = OrderedDict()  # delivery tag -> (queue name, msg)
+        self._delivery_tags = itertools.count(1)
+        self._consumer_tags = itertools.count(1)
+        self._prefetch_count = 0
+        self._confirm_callback = None  # asynchronous confirms, pika Channel style
+        self._confirms = []  # delivery tags published, not yet confirmed to _confirm_callback
+        self._publish_tags = itertools.count(1)
+
+    @property
+    def _impl(self):
+        """ the channel itself: rabbit_util reaches the asynchronous pika channel wrapped by a
+            BlockingChannel (confirms, close) through _impl.
+        """
+        return self
+
+    @property
+    def is_closed(self):
+        return not self.is_open
+
+    def _check_open(self):
+        if not self.is_open:
+            raise pika.exceptions.ChannelClosed(504, 'CHANNEL_ERROR - channel is closed')
+
+    def _fail(self, error):
+        """ closes the channel on a broker error, as RabbitMQ does, and raises it.
+        """
+        self.close()
+        raise error
+
+    def exchange_declare(self, exchange=None, type='direct', passive=False, durable=False,
+                         auto_delete=False, internal=False, arguments=None, exchange_type=None):
+        self._check_open()
+        try:
+            self.broker.exchange_declare(exchange, exchange_type or type, passive=passive,
+                                         arguments=arguments)
+        except pika.exceptions.ChannelClosed as e:
+            self._fail(e)
+        return pika.frame.Method(self.channel_number, pika.spec.Exchange.DeclareOk())
+
+    def queue_declare(self, queue='', passive=False, durable=False, exclusive=False,
+                      auto_delete=False, arguments=None):
+        self._check_open()
+        try:
+            name, message_count, consumer_count = self.broker.queue_declare(
+                queue, passive=passive, arguments=arguments,
+                exclusive_to=self.connection if exclusive else None)
+        except pika.exceptions.ChannelClosed as e:
+            self._fail(e)
+        if exclusive:
+            self.connection.exclusive_queues.append(name)
+        return pika.frame.Method(self.channel_number, pika.spec.Queue.DeclareOk(
+            queue=name, message_count=message_count, consumer_count=consumer_count))
+
+    def queue_bind(self, queue, exchange, routing_key=None, arguments=None):
+        self._check_open()
+        try:
+            self.broker.queue_bind(queue, exchange, routing_key)
+        except pika.exceptions.ChannelClosed as e:
+            self._fail(e)
+        return pika.frame.Method(self.channel_number, pika.spec.Queue.BindOk())
+
+    def queue_purge(self, queue=''):
+        self._check_open()
+        try:
+            message_count = self.broker.queue_purge(queue)
+        except pika.exceptions.ChannelClosed as e:
+            self._fail(e)
+        return pika.frame.Method(self.channel_number,
+                                 pika.spec.Queue.PurgeOk(message_count=message_count))
+
+    def queue_delete(self, queue='', if_unused=False, if_empty=False):
+        self._check_open()
+        message_count = self.broker.queue_delete(queue)
+        return pika.frame.Method(self.channel_number,
+                                 pika.spec.Queue.DeleteOk(message_count=message_count))
+
+    def exchange_delete(self, exchange=None, if_unused=False):
+        self._check_open()
+        self.broker.exchange_delete(exchange)
+        return pika.frame.Method(self.channel_number, pika.spec.Exchange.DeleteOk())
+
+    def basic_qos(self, prefetch_size=0, prefetch_count=0, all_channels=False):
+        """ prefetch_count: unacked msgs delivered to the channel consumers, 0 unlimited.
+            all_channels makes no difference: a channel is used by a single thread.
+        """
+        self._check_open()
+        self._prefetch_count = prefetch_count
+
+    def basic_consume(self, consumer_callback, queue='', no_ack=False, exclusive=False,
+                      consumer_tag=None, arguments=None):
+        self._check_open()
+        with self.broker.lock:
+            if queue not in self.broker.queues:
+                self._fail(not_found('queue', queue))
+            consumer_tag = consumer_tag or 'ctag{}.{}'.format(self.channel_number,
+                                                            next(self._consumer_tags))
+            self._consumers[consumer_tag] = Consumer(consumer_tag, queue, consumer_callback,
+                                                     no_ack)
+            self.broker.consumers[queue] = self.broker.consumers.get(queue, 0) + 1
+        return consumer_tag
+
+    def basic_cancel(self, consumer_tag='', nowait=False):
+        """ msgs delivered, not acked, stay unacked as in RabbitMQ: none are prefetched here.
+            :return: [] msgs prefetched, for pika compatibility.
+        """
+        with self.broker.lock:
+            consumer = self._consumers.pop(consumer_tag, None)
+            if consumer is not None:
+                self.broker.consumers[consumer.queue] -= 1
+        return []
+
+    def stop_consuming(self, consumer_tag=None):
+        for tag in list(self._consumers):
+            if consumer_tag is None or tag == consumer_tag:
+                self.basic_cancel(tag)
+
+    def start_consuming(self):
+        """ processes events until every consumer is cancelled or the channel closed.
+        """
+        while self._consumers and self.is_open:
+            self.connection.process_data_events(time_limit=None)
+
+    def confirm_delivery(self, callback=None, nowait=False):
+        """ callback(method_frame) is called with an Ack of every msg published from now on,
+            by process_data_events. Publishing in memory can't fail: without callback,
+            confirms are not reported.
+        """
+        self._confirm_callback = callback
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False,
+                      immediate=False):
+        self._check_open()
+        try:
+            self.broker.publish(exchange, routing_key, body, properties)
+        except pika.exceptions.ChannelClosed as e:
+            self._fail(e)
+        if self._confirm_callback is not None:
+            self._confirms.append(next(self._publish_tags))
+        return True
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self._pop_unacked(delivery_tag, multiple)
+
+    def basic_nack(self, delivery_tag=None, multiple=False, requeue=True):
+        for queue, msg in self._pop_unacked(delivery_tag, multiple):
+            if requeue:
+                with self.broker.lock:
+                    self.broker.requeue(queue, msg)
+
+    def basic_reject(self, delivery_tag=None, requeue=True):
+        self.basic_nack(delivery_tag, requeue=requeue)
+
+    def _pop_unacked(self, delivery_tag, multiple):
+        """ :return: [(queue name, msg)] unacked up to delivery_tag if multiple (0: all).
+        """
+        if multiple:
+            tags = [tag for tag in self._unacked if not delivery_tag or tag <= delivery_tag]
+        else:
+            if delivery_tag not in self._unacked:
+                self._fail(pika.exceptions.ChannelClosed(
+                    406, 'PRECONDITION_FAILED - unknown delivery tag {}'.format(delivery_tag)))
+            tags = [delivery_tag]
+        return [self._unacked.pop(tag) for tag in tags]
+
+    def close(self, reply_code=0, reply_text='Normal shutdown'):
+        """ requeues msgs delivered, not acked.
+        """
+        if not self.is_open:
+            return
+        self.stop_consuming()
+        self.is_open = False
+        with self.broker.lock:
+            for queue, msg in reversed(list(self._unacked.values())):
+                self.broker.requeue(queue, msg)
+        self._unacked.clear()
+
+    def deliveries(self):
+        """ takes the msgs the channel consumers can receive now, as per prefetch.
+            Must hold broker lock.
+            :return: [(consumer, delivery tag, msg)]
+        """
+        deliveries = []
+        for consumer in list(self._consumers.values()):
+            while True:
+                if self._prefetch_count:
+                    if len(self._unacked) >= self._prefetch_count:
+                        return deliveries
+                elif len([d for d in deliveries if d[0] is consumer]) >= \
+                        UNLIMITED_PREFETCH_BATCH:
+                    break
+                msg = self.broker.get(consumer.queue)
+                if msg is None:
+                    break
+                tag = next(self._delivery_tags)
+                if not consumer.no_ack:
+                    self._unacked[tag] = (consumer.queue, msg)
+                deliveries.append((consumer, tag, msg))
+        return deliveries
+
+    def dispatch(self, deliveries):
+        """ calls consumer callbacks of deliveries and confirm callback. Without broker lock.
+        """
+        if self._confirms and self._confirm_callback is not None:
+            confirmed, self._confirms = self._confirms[-1], []
+            self._confirm_callback(pika.frame.Method(self.channel_number, pika.spec.Basic.Ack(
+                delivery_tag=confirmed, multiple=True)))
+        for consumer, tag, msg in deliveries:
+            if consumer.tag not in self._consumers or not self.is_open:  # cancelled meanwhile
+                if not consumer.no_ack and tag in self._unacked:
+                    self.basic_nack(tag)
+                continue
+            method = pika.spec.Basic.Deliver(consumer_tag=consumer.tag, delivery_tag=tag,
+                                             redelivered=msg.redelivered,
+                                             exchange=msg.exchange, routing_key=msg.routing_key)
+            consumer.callback(self, method, msg.properties, msg.body)
+
+
+class MemoryConnection:
+    def __init__(self, broker):
+        self.broker = broker
+        self.is_open = True
+        self.channels = []
+        self.exclusive_queues = []
+
+    @property
+    def is_closed(self):
+        return not self.is_open
+
+    def channel(self, channel_number=None):
+        if not self.is_open:
+            raise pika.exceptions.ConnectionClosed(320, 'CONNECTION_FORCED - connection closed')
+        self.channels = [ch for ch in self.channels if ch.is_open]
+        ch = MemoryChannel(self, channel_number or len(self.channels) + 1)
+        self.channels.append(ch)
+        return ch
+
+    def process_data_events(self, time_limit=0):
+        """ delivers msgs to the consumers of the connection channels, calling their callbacks
+            in this thread, and publisher confirms. Waits for msgs up to time_limit secs,
+            None: until some are delivered.
+        """
+        deadline = time.time() + time_limit if time_limit is not None else None
+        while True:
+            with self.broker.lock:
+                self.broker.dead_letter_expired()
+                deliveries = [(ch, ch.deliveries()) for ch in self.channels if ch.is_open]
+                if not any(ch_deliveries or ch._confirms for ch, ch_deliveries in deliveries):
+                    if deadline is None:
+                        if not any(ch._consumers for ch in self.channels if ch.is_open):
+                            return  # nothing to wait for
+                        remaining = WAIT_INTERVAL
+                    else:
+                        remaining = deadline - time.time()
+                    if remaining <= 0 or not self.is_open:
+                        return
+                    self.broker.lock.wait(min(remaining, WAIT_INTERVAL))
+                    continue
+            for ch, ch_deliveries in deliveries:
+                ch.dispatch(ch_deliveries)
+            return
+
+    def sleep(self, duration):
+        self.process_data_events(time_limit=duration)
+
+    def close(self, reply_code=200, reply_text='Normal shutdown'):
+        if not self.is_open:
+            return
+        for ch in self.channels:
+            ch.close()
+        for queue in self.exclusive_queues:
+            self.broker.queue_delete(queue)
+        self.is_open = False
+
+
+broker = MemoryBroker()  # process wide
+
+
+def connect(target_broker=None):
+    """ :return: MemoryConnection to target_broker, default: the process one.
+    """
+    return (target_broker or broker).connect()
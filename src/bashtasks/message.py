@@ -1,12 +1,53 @@
 import time
 import json
-from bashtasks.constants import Destination, DestinationNames
+import threading
+from bashtasks.constants import Destination, DestinationNames, MAX_PRIORITY
+from bashtasks.constants import PERSISTENT, TRANSIENT
+from bashtasks import codec
+
+
+# optional request fields, set through **options of get_request and the clients post/execute
+TASK_OPTIONS = (
+    'output_policy',  # how the executor returns stdout/stderr: truncate, file or chunks
+    'output_cap',  # truncate output_policy: max bytes kept per stream
+    'priority',  # 0 (default) to MAX_PRIORITY. Higher priority tasks are consumed first
+    'retry_policy',  # delay between retries: fixed, exponential or jitter. See retry module
+    'retry_delay',  # ms, base delay of retry_policy
+    'retry_max_delay',  # ms, max delay between retries
+    'cacheable',  # True: executors may reply with the result of a previous run of the command
+    'cache_ttl',  # secs the result of a cacheable task is reused
+    'fingerprint',  # cacheable: identifies the command inputs, part of the result cache key
+    'persistent',  # False: task and response msgs are transient, lost if the broker restarts
+    'command_timeout',  # secs the command may run before it is killed, with its children
+    'cost',  # {'cpu': cores, 'mem_mb': MB} reserved while it runs. See admission module
+    'routing_key',  # dot separated tags (eg: gpu.none.mem.high) routing it to capable executors
+    'job_id',  # job the task is part of, responses are folded per job. See reducer module
+)
+TASK_COST_FIELDS = ('cpu', 'mem_mb')
+
+# batch requests carry several commands in their batch field, run by a single executor and
+# responded together. command is just a description of the batch.
+BATCH_COMMAND = 'batch'
+
+_correlation_id_lock = threading.Lock()
+_last_correlation_id = [0]
 
 
 def currtimemillis():
     return int(round(time.time() * 1000))
 
 
+def next_correlation_id():
+    """ returns a correlation_id unique within this process.
+        ids are time millis, bumped by one when several messages are created in the same milli,
+        so responses can be routed back to their caller by correlation_id.
+    """
+    with _correlation_id_lock:
+        correlation_id = max(currtimemillis(), _last_correlation_id[0] + 1)
+        _last_correlation_id[0] = correlation_id
+        return correlation_id
+
+
 class BashTasksMessage(dict):
     def __init__(self, command=None, reply_to=Destination.responses_pool,
                  max_retries=None, non_retriable=[], **kwargs):
@@ -16,7 +57,8 @@ class BashTasksMessage(dict):
             self['reply_to'] = DestinationNames.get_for(reply_to)
         if kwargs:
             self.update(kwargs)
-        self.lazy_init_ts('correlation_id')
+        if 'correlation_id' not in self:
+            self['correlation_id'] = next_correlation_id()
         self.lazy_init_ts('request_ts')
         if max_retries:
             self['max_retries'] = max_retries
@@ -24,15 +66,89 @@ class BashTasksMessage(dict):
     def to_json(self):
         return json.dumps(self)
 
+    def encode(self, codec_name=None):
+        """ :return: (body, content_encoding) of this message with codec codec_name (default json)
+        """
+        return codec.get_codec(codec_name).encode(self)
+
     def lazy_init_ts(self, ts_name):
         if not ts_name in self:
             self[ts_name] = currtimemillis()
 
 
-def get_request(command, reply_to=Destination.responses_pool, max_retries=None, non_retriable=[]):
-    return BashTasksMessage(command=command, reply_to=reply_to, max_retries=max_retries, non_retriable=non_retriable)
+def get_task_fields(options):
+    """ :return: <dict> request fields of options, one of TASK_OPTIONS. None values are not set.
+    """
+    for option in options:
+        if option not in TASK_OPTIONS:
+            raise TypeError("unexpected task option '{}'".format(option))
+    priority = options.get('priority')
+    if priority is not None and priority not in range(0, MAX_PRIORITY + 1):
+        raise ValueError('priority must be an int from 0 to {}: {}'.format(MAX_PRIORITY, priority))
+    cost = options.get('cost')
+    if cost is not None and not set(cost) <= set(TASK_COST_FIELDS):
+        raise ValueError('cost fields must be some of {}: {}'.format(TASK_COST_FIELDS, cost))
+    return dict((option, value) for option, value in options.items() if value is not None)
+
+
+def get_request(command, reply_to=Destination.responses_pool, max_retries=None, non_retriable=[],
+                **options):
+    """ options: optional request fields, one of TASK_OPTIONS. None values are not set.
+    """
+    return BashTasksMessage(command=command, reply_to=reply_to, max_retries=max_retries,
+                            non_retriable=non_retriable, **get_task_fields(options))
+
+
+def get_batch_request(commands, reply_to=Destination.responses_pool, max_retries=None,
+                      non_retriable=[], parallelism=1, **options):
+    """ :return: request running every command in commands, up to parallelism at a time,
+            in a single executor and responded in a single response. See unpack_responses.
+            The batch returncode is the one of its first failed command, 0 if none failed.
+            Retries run again the failed commands only.
+        options: optional request fields, one of TASK_OPTIONS, applying to every command.
+            Batches are never cacheable, and their output_policy is always truncate.
+    """
+    batch = [{'command': command} for command in commands]
+    if not batch:
+        raise ValueError('batch requests need at least one command')
+    return BashTasksMessage(command=[BATCH_COMMAND, str(len(batch))], reply_to=reply_to,
+                            max_retries=max_retries, non_retriable=non_retriable, batch=batch,
+                            batch_parallelism=parallelism, **get_task_fields(options))
+
+
+def get_delivery_mode(msg):
+    """ :return: AMQP delivery_mode of msg, and of its response: TRANSIENT if persistent is False.
+    """
+    return TRANSIENT if msg.get('persistent') is False else PERSISTENT
+
+
+def is_batch(msg):
+    return 'batch' in msg
+
+
+def unpack_responses(response_msg):
+    """ :return: [<dict>] one response per command of response_msg: the batch response fields,
+            with the command and result fields of the command, and its batch_index.
+            [response_msg] if it is not a batch.
+    """
+    if not is_batch(response_msg):
+        return [response_msg]
+    responses = []
+    for batch_index, item in enumerate(response_msg['batch']):
+        response = dict((field, value) for field, value in response_msg.items()
+                        if field != 'batch')
+        response.update(item)
+        response['batch_index'] = batch_index
+        responses.append(response)
+    return responses
 
 
 def from_str(json_str):
     d = json.loads(json_str)
     return BashTasksMessage(**d)
+
+
+def from_body(body, properties=None):
+    """ :return: BashTasksMessage in an AMQP body, any codec, as described by its properties.
+    """
+    return BashTasksMessage(**codec.decode(body, properties))
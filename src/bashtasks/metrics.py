@@ -0,0 +1,202 @@
+""" metrics: counters, gauges and histograms of executors and response receivers, served in the
+    Prometheus text format by serve(port): GET http://host:port/metrics
+
+    Metrics are process wide, in registry, shared by every worker thread. Labels are given by
+    value, in the order of the metric labelnames: tasks_failed.inc(labels=(returncode, )).
+"""
+import threading
+from collections import OrderedDict
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+def format_value(value):
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def format_labels(labelnames, labels):
+    if not labelnames:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, escape_label_value(value))
+                          for name, value in zip(labelnames, labels)) + '}'
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = OrderedDict()  # labels tuple -> value
+        self._lock = threading.Lock()
+        if not self.labelnames:  # exposed from the start, as 0
+            self._values[()] = self.zero()
+
+    def zero(self):
+        return 0
+
+    def get(self, labels=()):
+        with self._lock:
+            return self._values.get(tuple(labels), 0)
+
+    def samples(self):
+        """ :return: [(name, labelnames, labels, value)] in the exposition order.
+        """
+        with self._lock:
+            return [(self.name, self.labelnames, labels, value)
+                    for labels, value in self._values.items()]
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} {}'.format(self.name, self.type)]
+        for name, labelnames, labels, value in self.samples():
+            lines.append('{}{} {}'.format(name, format_labels(labelnames, labels),
+                                          format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, labels=()):
+        labels = tuple(labels)
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, labels=()):
+        with self._lock:
+            self._values[tuple(labels)] = value
+
+    def inc(self, amount=1, labels=()):
+        labels = tuple(labels)
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=SECONDS_BUCKETS):
+        self.buckets = tuple(sorted(buckets)) + (float('inf'), )
+        Metric.__init__(self, name, help, labelnames)
+
+    def zero(self):
+        return [0] * len(self.buckets), 0
+
+    def observe(self, value, labels=()):
+        labels = tuple(labels)
+        with self._lock:
+            counts, total = self._values.get(labels) or self.zero()
+            for i, upper in enumerate(self.buckets):
+                if value <= upper:
+                    counts[i] += 1
+                    break
+            self._values[labels] = (counts, total + value)
+
+    def get(self, labels=()):
+        """ :return: (count, sum) of the values observed with labels.
+        """
+        with self._lock:
+            counts, total = self._values.get(tuple(labels)) or ([0], 0)
+            return sum(counts), total
+
+    def samples(self):
+        with self._lock:
+            values = [(labels, list(counts), total) for labels, (counts, total)
+                      in self._values.items()]
+        samples = []
+        for labels, counts, total in values:
+            cumulative = 0
+            for upper, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append((self.name + '_bucket', self.labelnames + ('le', ),
+                                labels + (format_value(float(upper)), ), cumulative))
+            samples.append((self.name + '_sum', self.labelnames, labels, total))
+            samples.append((self.name + '_count', self.labelnames, labels, cumulative))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, metric_class, name, *args, **kwargs):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = metric_class(name, *args, **kwargs)
+            return self._metrics[name]
+
+    def counter(self, name, help, labelnames=()):
+        return self._get_or_create(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        return self._get_or_create(Gauge, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=SECONDS_BUCKETS):
+        return self._get_or_create(Histogram, name, help, labelnames, buckets=buckets)
+
+    def render(self):
+        """ :return: <str> every metric in the Prometheus text format.
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return ''.join(metric.render() + '\n' for metric in metrics)
+
+
+registry = Registry()  # process wide
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(port, host='', registry=registry):
+    """ serves registry metrics at http://host:port/metrics from a daemon thread.
+        port 0 picks a free port: server.server_address[1]
+        :return: the HTTPServer, server.shutdown() stops it.
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):  # scrapes are not logged
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server_th = threading.Thread(target=server.serve_forever, name='metrics_th')
+    server_th.daemon = True
+    server_th.start()
+    return server
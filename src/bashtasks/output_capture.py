@@ -0,0 +1,238 @@
+""" output_capture reads the stdout and stderr of a command while it runs, into sinks that
+    bound the memory used per task regardless of the output size.
+
+    Output policies, set per task (request output_policy) or as executor default:
+      - truncate: keeps up to output_cap bytes per stream: its head and its tail.
+      - file: streams output to files in the executor output_dir. Response has their paths.
+      - chunks: sends output as sequenced chunk messages to the reply destination,
+                ahead of the response.
+"""
+import codecs
+import os
+import select
+import signal
+import subprocess
+import sys
+import time
+
+TRUNCATE = 'truncate'
+FILE = 'file'
+CHUNKS = 'chunks'
+OUTPUT_POLICIES = (TRUNCATE, FILE, CHUNKS)
+
+READ_SIZE = 65536  # bytes read from a pipe at a time
+DEFAULT_CHUNK_SIZE = 1048576  # bytes of output per chunk message
+TIMEOUT_RETURNCODE = -3792  # returncode of commands killed on timeout
+KILL_GRACE = 1  # secs reading output of killed commands, held by processes out of their group
+WAIT_POLL = 0.01  # secs between checks of commands done, once their output is closed
+# new process group for every command. preexec_fn is not thread safe in python 3
+NEW_PROCESS_GROUP = {'start_new_session': True} if sys.version_info[0] >= 3 \
+    else {'preexec_fn': os.setpgrp}
+
+
+def decode(data):
+    return bytes(data).decode('utf-8', 'replace')
+
+
+class HeadTailSink:
+    """ keeps the first and last cap/2 bytes of a stream.
+    """
+    def __init__(self, cap):
+        self.tail_cap = cap // 2
+        self.head_cap = cap - self.tail_cap
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total = 0
+
+    def write(self, data):
+        self.total += len(data)
+        room = self.head_cap - len(self.head)
+        if room > 0:
+            self.head.extend(data[:room])
+            data = data[room:]
+        if data and self.tail_cap:
+            self.tail.extend(data)
+            if len(self.tail) > self.tail_cap:
+                del self.tail[:len(self.tail) - self.tail_cap]
+
+    def close(self):
+        pass
+
+    def fill(self, response_msg, stream):
+        truncated = self.total - len(self.head) - len(self.tail)
+        if truncated > 0:
+            response_msg[stream] = decode(self.head) + \
+                '\n[... {} bytes truncated ...]\n'.format(truncated) + decode(self.tail)
+            response_msg[stream + '_truncated'] = truncated
+        else:
+            response_msg[stream] = decode(self.head + self.tail)
+
+
+class FileSink:
+    def __init__(self, path):
+        self.path = path
+        self.total = 0
+        self._file = open(path, 'wb')
+
+    def write(self, data):
+        self.total += len(data)
+        self._file.write(data)
+
+    def close(self):
+        self._file.close()
+
+    def fill(self, response_msg, stream):
+        response_msg[stream] = ''
+        response_msg[stream + '_file'] = self.path
+        response_msg[stream + '_bytes'] = self.total
+
+
+class ChunkSink:
+    """ calls emit(chunk_seq, text) every chunk_size bytes of output, and for the remainder.
+    """
+    def __init__(self, emit, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.emit = emit
+        self.chunk_size = chunk_size
+        self.total = 0
+        self.chunks = 0
+        self._buffer = bytearray()
+        self._decoder = codecs.getincrementaldecoder('utf-8')('replace')
+
+    def write(self, data):
+        self.total += len(data)
+        self._buffer.extend(data)
+        while len(self._buffer) >= self.chunk_size:
+            self._emit(self._buffer[:self.chunk_size])
+            del self._buffer[:self.chunk_size]
+
+    def close(self):
+        if self._buffer:
+            self._emit(self._buffer, final=True)
+            del self._buffer[:]
+
+    def _emit(self, data, final=False):
+        self.emit(self.chunks, self._decoder.decode(bytes(data), final))
+        self.chunks += 1
+
+    def fill(self, response_msg, stream):
+        response_msg[stream] = ''
+        response_msg[stream + '_chunks'] = self.chunks
+        response_msg[stream + '_bytes'] = self.total
+
+
+def is_chunk(msg):
+    return bool(msg.get('chunk'))
+
+
+def get_chunk_msg(msg, stream, chunk_seq, data, executor_name):
+    return {'chunk': True,
+            'correlation_id': msg['correlation_id'],
+            'retries': msg.get('retries', 0),
+            'stream': stream,
+            'chunk_seq': chunk_seq,
+            'data': data,
+            'executor_name': executor_name}
+
+
+class ChunksCollector:
+    """ collects chunk messages of tasks with chunks output_policy, to rebuild their output
+        into the response. Chunks of previous (retried) executions are ignored.
+    """
+    def __init__(self):
+        self._chunks = {}  # correlation_id -> {(retries, stream): {chunk_seq: data}}
+
+    def add(self, chunk_msg):
+        task_chunks = self._chunks.setdefault(chunk_msg['correlation_id'], {})
+        stream_chunks = task_chunks.setdefault((chunk_msg['retries'], chunk_msg['stream']), {})
+        stream_chunks[chunk_msg['chunk_seq']] = chunk_msg['data']
+
+    def complete(self, response_msg):
+        """ sets stdout/stderr of response_msg from its chunks.
+        """
+        task_chunks = self._chunks.pop(response_msg['correlation_id'], {})
+        for stream in ('stdout', 'stderr'):
+            if stream + '_chunks' not in response_msg:
+                continue
+            stream_chunks = task_chunks.get((response_msg.get('retries', 0), stream), {})
+            response_msg[stream] = ''.join(stream_chunks[seq] for seq in sorted(stream_chunks))
+        return response_msg
+
+    def forget(self, correlation_id):
+        self._chunks.pop(correlation_id, None)
+
+
+def spawn_process(command):
+    """ :return: Popen of command, in its own process group: killed with its children.
+    """
+    return subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            **NEW_PROCESS_GROUP)
+
+
+def kill_process_group(p):
+    try:
+        os.killpg(p.pid, signal.SIGKILL)
+    except OSError:  # already gone
+        pass
+
+
+def poll_until(p, deadline):
+    """ :return: returncode of p, None if still running at deadline.
+    """
+    while True:
+        returncode = p.poll()
+        if returncode is not None or time.time() >= deadline:
+            return returncode
+        time.sleep(max(0, min(WAIT_POLL, deadline - time.time())))
+
+
+def run_command(command, stdout_sink, stderr_sink, read_size=READ_SIZE, timeout=None):
+    """ runs command, writing its output to the sinks as it is produced.
+        :return: returncode
+    """
+    return capture_output(spawn_process(command), stdout_sink, stderr_sink, read_size, timeout)
+
+
+def capture_output(p, stdout_sink, stderr_sink, read_size=READ_SIZE, timeout=None):
+    """ writes the output of process p to the sinks as it is produced, until it is done.
+        p: Popen, or alike (eg: fork_server.ForkedProcess), leading its process group.
+        timeout: secs p may run, with its output open or not. Then its process group is
+                 killed and the output read so far kept in the sinks.
+        :return: returncode, TIMEOUT_RETURNCODE if killed on timeout.
+    """
+    sinks = {p.stdout.fileno(): stdout_sink, p.stderr.fileno(): stderr_sink}
+    deadline = time.time() + timeout if timeout else None
+    killed = False
+    try:
+        while sinks:
+            wait = None
+            if deadline is not None:
+                wait = deadline - time.time()
+                if wait <= 0 and killed:  # output still held by processes out of the group
+                    break
+                if wait <= 0:
+                    kill_process_group(p)
+                    killed = True
+                    deadline = time.time() + KILL_GRACE
+                    wait = KILL_GRACE
+            readable, _, _ = select.select(list(sinks), [], [], wait)
+            for fd in readable:
+                data = os.read(fd, read_size)
+                if data:
+                    sinks[fd].write(data)
+                else:
+                    del sinks[fd]
+    finally:
+        p.stdout.close()
+        p.stderr.close()
+        stdout_sink.close()
+        stderr_sink.close()
+    if deadline is None:
+        return p.wait()
+    if not killed:
+        returncode = poll_until(p, deadline)
+        if returncode is not None:
+            return returncode
+        kill_process_group(p)  # its output closed or redirected, but still running
+        deadline = time.time() + KILL_GRACE
+    poll_until(p, deadline)
+    return TIMEOUT_RETURNCODE
@@ -1,37 +1,56 @@
-from pika import BlockingConnection, ConnectionParameters, BasicProperties, PlainCredentials
+from contextlib import contextmanager
 import pika
-from bashtasks.constants import TASK_REQUESTS_POOL, TASK_RESPONSES_POOL
+from bashtasks.constants import TASK_REQUESTS_POOL, TASK_RESPONSES_POOL, MAX_PRIORITY
 from bashtasks.logger import get_logger
+from bashtasks.transport import get_transport
 import os
+import threading
 import time
+import weakref
+
+try:
+    string_types = basestring
+except NameError:  # python 3
+    string_types = str
 
 
 MAX_RECONNECT_RETRIES = 6
+DEFAULT_HEARTBEAT = 60  # secs, heartbeat interval of pooled connections
+CONNECTION_ERRORS = (pika.exceptions.AMQPConnectionError, pika.exceptions.ChannelClosed)
+PRECONDITION_FAILED = 406
+non_priority_queues = set()  # queues found declared without x-max-priority, by older versions
 
 
 def curr_module_name():
     return os.path.splitext(os.path.basename(__file__))[0]
 
 
-def connect(host='localhost', port=5672, usr='guest', pas='guest'):
+def connect(host='localhost', port=5672, usr='guest', pas='guest', heartbeat=None,
+            transport=None):
+    """ heartbeat: secs, None negotiates the broker default.
+        transport: name or instance, see transport module. Default: pika.
+    """
     logger = get_logger(name=curr_module_name())
     try:
         logger.info('Connecting to rabbit: %s:%s@%s', usr, pas, host)
-        credentials = PlainCredentials(usr, pas)
-        parameters = ConnectionParameters(host, port, '/', credentials)
-        conn = BlockingConnection(parameters)
+        conn = get_transport(transport).connect(host=host, port=port, usr=usr, pas=pas,
+                                                heartbeat=heartbeat)
     except Exception as e:
         logger.error('Exception connecting to rabbit: %s:%s@%s', usr, pas, host, exc_info=True)
         conn = None
     return conn
 
 
-def connect_with_retries(host='localhost', port=5672, usr='guest', pas='guest'):
+def connect_with_retries(host='localhost', port=5672, usr='guest', pas='guest', heartbeat=None,
+                         transport=None):
+    """ :return: channel of a new connection. Retries with exponential backoff.
+    """
     delay = 0.5
     retries = 0
     while retries < MAX_RECONNECT_RETRIES:
         try:
-            conn = connect(host=host, port=port, usr=usr, pas=pas)
+            conn = connect(host=host, port=port, usr=usr, pas=pas, heartbeat=heartbeat,
+                           transport=transport)
             ch = conn.channel()
             if conn and conn.is_open:
                 return ch
@@ -53,35 +72,455 @@ def close_channel_and_conn(ch):
         ch._impl.close()
 
 
-def declare_and_bind(ch, name, routing_key=''):
-    ch.exchange_declare(exchange=name, type='topic')
-    ch.queue_declare(queue=name)
-    ch.queue_bind(exchange=name, queue=name, routing_key=routing_key)
+class DeclarationCache:
+    """ exchanges, queues and bindings declared on every connection of the process.
+        Declarations are idempotent for a connection lifetime: once done, they are skipped.
+        Entries go with their connection, so a reconnect declares the topology again.
+    """
+    def __init__(self):
+        self._declared = weakref.WeakKeyDictionary()  # connection -> set of declarations
+        self._lock = threading.Lock()
+        self.declares_sent = 0
+        self.declares_skipped = 0
+
+    def declare(self, ch, declaration, fn):
+        """ calls fn() to declare declaration (hashable) unless done already on ch connection.
+            :return: True if fn was called.
+        """
+        with self._lock:
+            declared = self._declared.setdefault(ch.connection, set())
+            if declaration in declared:
+                self.declares_skipped += 1
+                return False
+        fn()
+        with self._lock:
+            declared.add(declaration)
+            self.declares_sent += 1
+        return True
+
+    def invalidate(self, connection):
+        with self._lock:
+            self._declared.pop(connection, None)
+
+    def clear(self):
+        with self._lock:
+            self._declared.clear()
+            self.declares_sent = 0
+            self.declares_skipped = 0
+
+    def stats(self):
+        """ :return: <dict> declares_sent and declares_skipped (found in cache).
+        """
+        return {'declares_sent': self.declares_sent, 'declares_skipped': self.declares_skipped}
+
+
+declaration_cache = DeclarationCache()
+
+
+def is_priority_mismatch(error):
+    """ :return: True if ChannelClosed error is the broker refusing x-max-priority for a queue
+        existing without it (or with another one).
+    """
+    return len(error.args) > 1 and error.args[0] == PRECONDITION_FAILED and \
+        'x-max-priority' in str(error.args[1])
+
+
+def declare_priority_queue(ch, name, durable=False):
+    """ declares queue name as a priority queue, up to MAX_PRIORITY. Once per connection.
+        A queue existing without x-max-priority (eg: declared by older versions) can't be
+        redeclared with it: it is used as it is, logging an error, and priorities are ignored
+        in it until it is deleted and declared again.
+        :return: ch, or a new channel of its connection if the broker closed ch.
+    """
+    if name in non_priority_queues:
+        arguments = {}
+    else:
+        arguments = {'x-max-priority': MAX_PRIORITY}
+    try:
+        declaration_cache.declare(ch, ('queue', name), lambda: ch.queue_declare(
+            queue=name, durable=durable, arguments=arguments))
+    except pika.exceptions.ChannelClosed as e:
+        if not is_priority_mismatch(e):
+            raise
+        non_priority_queues.add(name)
+        logger = get_logger(name=curr_module_name())
+        logger.error('Queue %s exists without x-max-priority: task priorities are IGNORED in it. '
+                     'Delete it to declare it again as a priority queue. Broker: %s',
+                     name, e.args[1])
+        ch = ch.connection.channel()  # only the channel is closed: reuse the connection
+        declaration_cache.declare(ch, ('queue', name),
+                                  lambda: ch.queue_declare(queue=name, durable=durable))
+    return ch
+
+
+def declare_and_bind(ch, name, routing_key='', passive=False, durable=False):
+    """ declares exchange and queue name, bound with routing_key. Once per connection.
+        Queues are priority queues, see declare_priority_queue.
+        passive: only verifies exchange and queue exist, declaring them if not.
+        durable: exchange and queue survive broker restarts. Only persistent msgs in durable
+                 queues are written to disk by the broker.
+        :return: ch, or a new channel of its connection if a declare closed ch.
+    """
+    if passive:
+        try:
+            declaration_cache.declare(
+                ch, ('exchange', name),
+                lambda: ch.exchange_declare(exchange=name, type='topic', passive=True))
+            declaration_cache.declare(
+                ch, ('queue', name), lambda: ch.queue_declare(queue=name, passive=True))
+        except pika.exceptions.ChannelClosed:  # 404: not found, closes the channel
+            ch = ch.connection.channel()
+    declaration_cache.declare(ch, ('exchange', name),
+                              lambda: ch.exchange_declare(exchange=name, type='topic',
+                                                          durable=durable))
+    ch = declare_priority_queue(ch, name, durable=durable)
+    declaration_cache.declare(ch, ('binding', name, name, routing_key),
+                              lambda: ch.queue_bind(exchange=name, queue=name,
+                                                    routing_key=routing_key))
+    return ch
+
 
+def get_routed_exchange(destination):
+    return destination + ':routed'
+
+
+def get_routed_queue(destination, pattern):
+    return '{}:routed:{}'.format(destination, pattern)
+
+
+def declare_routed_exchange(ch, destination):
+    """ declares the exchange routing tasks of destination by their routing_key (dot separated
+        tags, eg: gpu.none.mem.high) to the queues of executors bound with matching patterns.
+        Tasks matching no pattern go to destination. Once per connection.
+        :return: exchange name
+    """
+    exchange = get_routed_exchange(destination)
+    declaration_cache.declare(ch, ('exchange', exchange), lambda: ch.exchange_declare(
+        exchange=exchange, type='topic', arguments={'alternate-exchange': destination}))
+    return exchange
 
-def connect_and_declare(host='localhost', port=5672, usr='guest', pas='guest', destinations=None):
+
+def declare_routed_queue(ch, destination, pattern):
+    """ declares the queue of tasks of destination with a routing_key matching pattern
+        (topic binding key, eg: gpu.*.mem.#), shared by executors consuming pattern.
+        Tasks matching the patterns of several queues go to each of them: patterns of
+        executors of a destination shouldn't overlap. Once per connection.
+        :return: queue name
+    """
+    exchange = declare_routed_exchange(ch, destination)
+    name = get_routed_queue(destination, pattern)
+    declaration_cache.declare(ch, ('queue', name), lambda: ch.queue_declare(
+        queue=name, arguments={'x-max-priority': MAX_PRIORITY}))
+    declaration_cache.declare(ch, ('binding', exchange, name, pattern), lambda: ch.queue_bind(
+        exchange=exchange, queue=name, routing_key=pattern))
+    return name
+
+
+def get_task_route(ch, destination, routing_key=None):
+    """ :return: (exchange, routing_key) to publish a task of destination to.
+        Tasks with routing_key go through the routed exchange of destination.
+    """
+    if routing_key:
+        return declare_routed_exchange(ch, destination), routing_key
+    return destination, ''
+
+
+def connect_and_declare(host='localhost', port=5672, usr='guest', pas='guest', destinations=None,
+                        passive=False, transport=None):
     """ connects to RabbitMQ and does queue/exchange declarations
         destinations: name(s) of destinations, can be str or list
+        passive: verify destinations exist, see declare_and_bind
+        transport: name or instance, see transport module. Default: pika.
     """
     if not destinations:
         destinations = [TASK_REQUESTS_POOL, TASK_RESPONSES_POOL]
-    elif isinstance(destinations, basestring):
+    elif isinstance(destinations, string_types):
         destinations = [destinations]
 
-    ch = connect_with_retries(host=host, port=port, usr=usr, pas=pas)
+    ch = connect_with_retries(host=host, port=port, usr=usr, pas=pas, transport=transport)
+    return declare_destinations(ch, destinations, passive=passive)
+
 
+def declare_destinations(ch, destinations, passive=False):
+    """ declares and binds destinations.
+        :return: ch, or a new channel of its connection if the broker closed ch.
+    """
     for destination in destinations:
         try:
-            declare_and_bind(ch, destination, routing_key='#')
+            ch = declare_and_bind(ch, destination, routing_key='#', passive=passive)
         except pika.exceptions.ChannelClosed as e:
             logger = get_logger(name=curr_module_name())
             logger.warning('Destination with name=%s already exists, error. Skipping',
                            destination, exc_info=True)
-            ch = connect_with_retries(host=host, port=port, usr=usr, pas=pas)
+            ch = ch.connection.channel()  # only the channel is closed: reuse the connection
 
     return ch
 
 
+class ConnectionPool:
+    """ connections to a RabbitMQ, opened lazily and reused by threads.
+        pika connections are not thread safe: a thread checks out a channel (each on its own
+        connection) for its exclusive use and checks it in when done.
+        Channels idle for longer than half the heartbeat are health checked on checkout.
+        Broken channels are discarded and replaced by new connections (connect_with_retries
+        backs off), declaring again the pool destinations.
+    """
+    def __init__(self, host='localhost', port=5672, usr='guest', pas='guest', destinations=None,
+                 max_size=None, heartbeat=DEFAULT_HEARTBEAT, transport=None):
+        """ max_size: max connections, checkout blocks while all are checked out. None: no limit
+            transport: name or instance, see transport module. Default: pika.
+        """
+        self.host = host
+        self.port = port
+        self.usr = usr
+        self.pas = pas
+        self.destinations = []
+        self.max_size = max_size
+        self.heartbeat = heartbeat
+        self.transport = transport
+        self.connections_opened = 0
+        self._idle = []  # (channel, last used ts), most recently used last
+        self._size = 0  # channels open, idle or checked out
+        self._closed = False
+        self._available = threading.Condition(threading.Lock())
+        self.add_destinations(destinations)
+
+    def add_destinations(self, destinations):
+        """ destinations are declared on connections opened from now on.
+        """
+        if isinstance(destinations, string_types):
+            destinations = [destinations]
+        with self._available:
+            for destination in destinations or []:
+                if destination not in self.destinations:
+                    self.destinations.append(destination)
+
+    def checkout(self, timeout=None):
+        """ :return: channel for the exclusive use of the caller, until checkin.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._available:
+            while True:
+                if self._closed:
+                    raise Exception('ConnectionPool to {} is closed'.format(self.host))
+                if self._idle:
+                    ch, last_used = self._idle.pop()
+                    break
+                if self.max_size is None or self._size < self.max_size:
+                    self._size += 1
+                    ch, last_used = None, None
+                    break
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    raise Exception('Timeout ({}secs) waiting for a pooled channel to {}'
+                                    .format(timeout, self.host))
+                self._available.wait(remaining)
+
+        if ch is not None and self.is_healthy(ch, last_used):
+            return ch
+        if ch is not None:
+            self._close(ch)
+        try:
+            return self._open()
+        except Exception:
+            self._release_slot()
+            raise
+
+    def checkin(self, ch):
+        with self._available:
+            if not self._closed and ch.is_open and ch.connection.is_open:
+                self._idle.append((ch, time.time()))
+                self._available.notify()
+                return
+        self.discard(ch)
+
+    def discard(self, ch):
+        """ closes ch, checked out, instead of checking it in. Eg: after a connection error.
+        """
+        self._close(ch)
+        self._release_slot()
+
+    @contextmanager
+    def channel(self, timeout=None):
+        """ checks out a channel for a with block. Discarded on connection errors.
+        """
+        ch = self.checkout(timeout)
+        try:
+            yield ch
+        except CONNECTION_ERRORS:
+            self.discard(ch)
+            raise
+        except Exception:
+            self.checkin(ch)
+            raise
+        self.checkin(ch)
+
+    def run(self, fn, retries=1):
+        """ :return: fn(channel), run on a checked out channel. On connection errors, fn is run
+            again on a new connection, up to retries times.
+        """
+        attempt = 0
+        while True:
+            try:
+                with self.channel() as ch:
+                    return fn(ch)
+            except CONNECTION_ERRORS:
+                if attempt >= retries:
+                    raise
+                attempt += 1
+                logger = get_logger(name=curr_module_name())
+                logger.warning('Connection to %s lost, reconnecting. Retry %d/%d',
+                               self.host, attempt, retries, exc_info=True)
+
+    def is_healthy(self, ch, last_used):
+        if not (ch.is_open and ch.connection.is_open):
+            return False
+        if self.heartbeat and time.time() - last_used > self.heartbeat / 2.0:
+            try:  # sends pending heartbeats, fails if the broker dropped the connection
+                ch.connection.process_data_events(time_limit=0)
+            except CONNECTION_ERRORS:
+                return False
+            return ch.is_open and ch.connection.is_open
+        return True
+
+    def size(self):
+        return self._size
+
+    def idle_nr(self):
+        return len(self._idle)
+
+    def close(self):
+        """ closes idle connections, and checked out ones on checkin.
+        """
+        with self._available:
+            self._closed = True
+            idle = [ch for ch, _ in self._idle]
+            del self._idle[:]
+            self._size -= len(idle)
+            self._available.notify_all()
+        for ch in idle:
+            self._close(ch)
+
+    def is_closed(self):
+        return self._closed
+
+    def _open(self):
+        ch = connect_with_retries(host=self.host, port=self.port, usr=self.usr, pas=self.pas,
+                                  heartbeat=self.heartbeat, transport=self.transport)
+        self.connections_opened += 1
+        return declare_destinations(ch, list(self.destinations))
+
+    def _close(self, ch):
+        declaration_cache.invalidate(ch.connection)
+        try:
+            close_channel_and_conn(ch)
+            if ch.connection.is_open:
+                ch.connection.close()
+        except Exception:
+            logger = get_logger(name=curr_module_name())
+            logger.warning('Exception closing pooled connection to %s', self.host, exc_info=True)
+
+    def _release_slot(self):
+        with self._available:
+            self._size -= 1
+            self._available.notify()
+
+
+shared_pools = {}  # (host, port, usr, pas, transport) -> ConnectionPool, created by get_pool
+shared_pools_lock = threading.Lock()
+
+
+def get_pool(host='localhost', port=5672, usr='guest', pas='guest', destinations=None,
+             transport=None):
+    """ :return: process wide ConnectionPool for host, port, user and transport. destinations
+        are added to its destinations.
+    """
+    key = (host, port, usr, pas, get_transport(transport))
+    with shared_pools_lock:
+        pool = shared_pools.get(key)
+        if pool is None or pool.is_closed():
+            pool = shared_pools[key] = ConnectionPool(host=host, port=port, usr=usr, pas=pas,
+                                                      transport=transport)
+    pool.add_destinations(destinations)
+    return pool
+
+
+class ConfirmTimeout(Exception):
+    """ the broker didn't confirm published messages in time (eg: under a memory alarm).
+    """
+
+
+class PipelinedPublisher:
+    """ publishes with publisher confirms, without waiting for each confirm.
+        Messages are written through the asynchronous channel wrapped by a BlockingChannel and
+        confirms are awaited once up to window messages are unconfirmed, so the broker round-trip
+        is paid once per window instead of once per message.
+        Messages nacked by the broker, or not confirmed in time, are reported in failures.
+    """
+    def __init__(self, ch, window=1000, timeout=None):
+        """ timeout: secs publish waits for confirms once window messages are unconfirmed.
+                 Then they are moved to failures and ConfirmTimeout raised. None: forever.
+        """
+        self._ch = ch
+        self._impl = ch._impl
+        self._connection = ch.connection
+        self.window = window
+        self.timeout = timeout
+        self.failures = []  # keys of messages nacked or not confirmed
+        self._unconfirmed = {}  # delivery_tag -> key
+        self._last_tag = 0
+        self._lowest_unconfirmed_tag = 1
+        self._impl.confirm_delivery(callback=self._on_confirm)
+
+    def publish(self, exchange, routing_key, body, properties=None, key=None):
+        self._last_tag += 1
+        self._unconfirmed[self._last_tag] = key
+        self._impl.basic_publish(exchange, routing_key, body, properties)
+        if len(self._unconfirmed) >= self.window and \
+                not self.wait_for_confirms(max_unconfirmed=self.window // 2, timeout=self.timeout):
+            raise ConfirmTimeout('No confirms from the broker for {} secs, {} msgs failed'
+                                 .format(self.timeout, len(self.failures)))
+
+    def unconfirmed_nr(self):
+        return len(self._unconfirmed)
+
+    def wait_for_confirms(self, max_unconfirmed=0, timeout=None):
+        """ processes broker confirms until max_unconfirmed messages are pending.
+            On timeout (secs) the messages still pending are moved to failures.
+            :return: False on timeout.
+        """
+        start = time.time()
+        while len(self._unconfirmed) > max_unconfirmed:
+            if timeout is not None and time.time() - start > timeout:
+                self.failures.extend(self._unconfirmed[tag] for tag in sorted(self._unconfirmed))
+                self._unconfirmed.clear()
+                return False
+            self._connection.process_data_events(time_limit=0.1)
+        return True
+
+    def close(self):
+        if self._ch.is_open:
+            self._ch.close()
+
+    def _on_confirm(self, method_frame):
+        method = method_frame.method
+        is_nack = isinstance(method, pika.spec.Basic.Nack)
+        if method.multiple:
+            tags = range(self._lowest_unconfirmed_tag, method.delivery_tag + 1)
+        else:
+            tags = (method.delivery_tag,)
+
+        for tag in tags:
+            if tag in self._unconfirmed:
+                key = self._unconfirmed.pop(tag)
+                if is_nack:
+                    self.failures.append(key)
+
+        while self._lowest_unconfirmed_tag <= self._last_tag and \
+                self._lowest_unconfirmed_tag not in self._unconfirmed:
+            self._lowest_unconfirmed_tag += 1
+
+
 def purge(host='localhost', port=5672, usr='guest', pas='guest'):
     conn = connect(host=host, port=port, usr=usr, pas=pas)
     ch = conn.channel()
@@ -0,0 +1,99 @@
+""" reducer: folds task responses into a result per job, as they are received, instead of
+    keeping them: memory grows with the number of jobs, not of responses.
+
+    Tasks are posted with a job_id option: post_task(cmd, job_id='nightly-42').
+    fold(result, response) -> result is called for every response of a job, starting with
+    initial(). Batch responses are folded once per command, as TaskStatistics tracks them.
+    Responses (all, or those matching spill_filter) can be spilled to a SpillWriter.
+    Fed by TaskResponseSubscriber.reduce, which acks responses once folded and spilled.
+"""
+from bashtasks.message import unpack_responses
+from bashtasks.output_capture import is_chunk
+
+NO_JOB = None  # job_id of responses of tasks posted without job_id
+
+
+def get_job_id(response):
+    return response.get('job_id', NO_JOB)
+
+
+def new_summary():
+    return {'count': 0, 'errors': 0, 'returncodes': {}, 'first_request_ts': None,
+            'last_post_command_ts': None, 'max_execution_ms': 0}
+
+
+def fold_summary(summary, response):
+    """ default fold: nr of responses and errors, returncodes counts, first request and last
+        response timestamps and max execution ms of the job.
+    """
+    summary['count'] += 1
+    returncode = response['returncode']
+    if returncode != 0:
+        summary['errors'] += 1
+    summary['returncodes'][returncode] = summary['returncodes'].get(returncode, 0) + 1
+    request_ts = response.get('request_ts')
+    if request_ts is not None and (summary['first_request_ts'] is None or
+                                   request_ts < summary['first_request_ts']):
+        summary['first_request_ts'] = request_ts
+    post_command_ts = response.get('post_command_ts')
+    if post_command_ts is not None:
+        summary['last_post_command_ts'] = max(summary['last_post_command_ts'] or 0,
+                                              post_command_ts)
+        summary['max_execution_ms'] = max(summary['max_execution_ms'],
+                                          post_command_ts - response.get('pre_command_ts',
+                                                                         post_command_ts))
+    return summary
+
+
+def is_error(response):
+    return response['returncode'] != 0
+
+
+class StreamingReducer:
+    def __init__(self, fold=fold_summary, initial=new_summary, key=get_job_id, spill=None,
+                 spill_filter=None):
+        """ initial: callable returning the result of a job before its first response.
+            key: callable returning the job of a response.
+            spill: SpillWriter responses are appended to. spill_filter(response): spills only
+                   the responses it returns True for (eg: is_error). Default: all.
+        """
+        self.fold = fold
+        self.initial = initial
+        self.key = key
+        self.spill = spill
+        self.spill_filter = spill_filter
+        self.responses_nr = 0
+        self._results = {}  # job_id -> result
+
+    def add(self, response):
+        """ folds response <dict> into the result of its job. Output chunks are skipped.
+        """
+        if is_chunk(response):
+            return
+        for command_response in unpack_responses(response):
+            job_id = self.key(command_response)
+            result = self._results[job_id] if job_id in self._results else self.initial()
+            self._results[job_id] = self.fold(result, command_response)
+            self.responses_nr += 1
+            if self.spill is not None and (self.spill_filter is None or
+                                           self.spill_filter(command_response)):
+                self.spill.write(command_response)
+
+    def result(self, job_id):
+        return self._results.get(job_id)
+
+    def results(self):
+        """ :return: <dict> job_id -> result
+        """
+        return dict(self._results)
+
+    def pop(self, job_id):
+        """ :return: result of job_id, forgotten by the reducer (eg: once the job is done).
+        """
+        return self._results.pop(job_id, None)
+
+    def flush(self):
+        """ spilled responses are written. Called before acking the responses added.
+        """
+        if self.spill is not None:
+            self.spill.flush()
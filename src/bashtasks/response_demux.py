@@ -0,0 +1,163 @@
+""" response_demux routes task responses to the callers waiting for them.
+
+    A single consumer, running in its own thread and connection, listens on an exclusive
+    reply queue owned by this client. Every response is handed to the ResponseFuture
+    registered for its correlation_id, so any number of concurrent synchronous callers
+    share one consumer and never see each other's responses.
+"""
+import os
+import threading
+
+from bashtasks.rabbit_util import connect_with_retries, close_channel_and_conn
+from bashtasks.logger import get_logger
+from bashtasks.output_capture import ChunksCollector, is_chunk
+from bashtasks import message
+
+
+def curr_module_name():
+    return os.path.splitext(os.path.basename(__file__))[0]
+
+
+class ResponseFuture:
+    """ the pending response of a posted task, identified by its correlation_id
+    """
+    def __init__(self, correlation_id):
+        self.correlation_id = correlation_id
+        self._response = None
+        self._done = threading.Event()
+
+    def set_response(self, response):
+        self._response = response
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """ blocks until the response arrives or timeout (secs) expires.
+            :return: True if the response arrived.
+        """
+        return self._done.wait(timeout)
+
+    def response(self):
+        return self._response
+
+
+class ResponseDemultiplexer:
+    def __init__(self, host='127.0.0.1', port=5672, usr='guest', pas='guest', poll_interval=0.5,
+                 transport=None):
+        self.host = host
+        self.port = port
+        self.usr = usr
+        self.pas = pas
+        self.transport = transport  # see transport module
+        self.poll_interval = poll_interval  # max secs between checks of stop()
+        self.queue = None  # broker named, known once started
+        self._pending = {}  # correlation_id -> ResponseFuture
+        self._chunks = ChunksCollector()  # output chunks of pending tasks
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._stopping = False
+        self._start_error = None
+        self._thread = None
+
+    def start(self, timeout=10):
+        """ starts the consumer thread, returns once the reply queue is declared and consumed.
+        """
+        self._thread = threading.Thread(target=self._consume, name='response_demux_th')
+        self._thread.daemon = True
+        self._thread.start()
+
+        if not self._ready.wait(timeout):
+            raise Exception('Timeout ({}secs) starting response consumer'.format(timeout))
+        if self._start_error is not None:
+            raise self._start_error
+        return self
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive() and not self._stopping
+
+    def stop(self, timeout=None):
+        self._stopping = True
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout if timeout is not None else self.poll_interval * 4)
+
+    def expect(self, correlation_id, future=None):
+        """ registers a caller waiting for correlation_id.
+            must be called before the task is published, so an early response is not lost.
+            future: optional object with set_response(response), defaults to a ResponseFuture.
+            :return: <ResponseFuture> or future
+        """
+        future = future if future is not None else ResponseFuture(correlation_id)
+        with self._lock:
+            self._pending[correlation_id] = future
+        return future
+
+    def forget(self, correlation_id):
+        with self._lock:
+            self._pending.pop(correlation_id, None)
+            self._chunks.forget(correlation_id)
+
+    def pending_nr(self):
+        with self._lock:
+            return len(self._pending)
+
+    def dispatch(self, response):
+        """ hands response to the caller waiting for its correlation_id.
+            output chunks are kept until their response arrives.
+            :return: True if there was a caller waiting for it.
+        """
+        with self._lock:
+            if is_chunk(response):
+                if response['correlation_id'] in self._pending:
+                    self._chunks.add(response)
+                    return True
+                future = None
+            else:
+                future = self._pending.pop(response.get('correlation_id'), None)
+                if future is not None:
+                    self._chunks.complete(response)
+
+        if future is None:
+            logger = get_logger(name=curr_module_name())
+            logger.warning('Discarding response nobody is waiting for: correlation_id %s',
+                           response.get('correlation_id'))
+            return False
+
+        future.set_response(response)
+        return True
+
+    def _on_message(self, ch, method, properties, body):
+        try:
+            self.dispatch(message.from_body(body, properties))
+        except Exception:
+            logger = get_logger(name=curr_module_name())
+            logger.error('Discarding malformed response in queue %s', self.queue, exc_info=True)
+
+    def _consume(self):
+        logger = get_logger(name=curr_module_name())
+        try:
+            ch = connect_with_retries(host=self.host, port=self.port, usr=self.usr, pas=self.pas,
+                                      transport=self.transport)
+            declare_ok = ch.queue_declare(queue='', exclusive=True, auto_delete=True)
+            self.queue = declare_ok.method.queue
+            ch.basic_consume(self._on_message, queue=self.queue, no_ack=True, exclusive=True)
+        except Exception as e:
+            logger.error('Exception starting response consumer', exc_info=True)
+            self._start_error = e
+            self._ready.set()
+            return
+
+        logger.info('Consuming responses from exclusive queue: %s', self.queue)
+        self._ready.set()
+        try:
+            while not self._stopping:
+                ch.connection.process_data_events(time_limit=self.poll_interval)
+        except Exception:
+            logger.error('Response consumer stopped by exception', exc_info=True)
+        finally:
+            self._stopping = True
+            try:
+                close_channel_and_conn(ch)
+            except Exception:
+                logger.warning('Exception closing response consumer connection', exc_info=True)
@@ -0,0 +1,164 @@
+""" result_cache keeps results of cacheable tasks, so executors reply to repeated commands
+    without running them again.
+
+    Tasks opt in with the cacheable request option. Results are keyed by the command argv,
+    the task fingerprint option, if any (eg: a hash or mtime of the command input files), and
+    the output policy and cap the output was captured with. They are kept cache_ttl secs
+    (request option, or cache default). Only successful results are kept.
+
+    Entries are evicted least recently used first, beyond max_entries, or once expired.
+    With store_dir, results are also stored on disk, one file per key, surviving executor
+    restarts and shared by executors on the same host.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from bashtasks.logger import get_logger
+
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_TTL = 3600  # secs
+RESULT_FIELDS = ('returncode', 'stdout', 'stderr')
+RESULT_FIELD_PREFIXES = ('stdout_', 'stderr_')  # eg: stdout_truncated, stderr_file
+
+
+def curr_module_name():
+    return os.path.splitext(os.path.basename(__file__))[0]
+
+
+def is_cacheable(msg):
+    return bool(msg.get('cacheable'))
+
+
+def get_cache_key(msg, output_policy=None, output_cap=None):
+    """ output_policy, output_cap: executor defaults, for msg not setting them.
+        :return: <str> key of the result of msg: hash of its command, fingerprint, output
+                 policy and output cap (eg: a truncated output doesn't answer a file one).
+    """
+    key_src = json.dumps([msg['command'], msg.get('fingerprint'),
+                          msg.get('output_policy', output_policy),
+                          msg.get('output_cap', output_cap)], sort_keys=True)
+    return hashlib.sha1(key_src.encode('utf-8')).hexdigest()
+
+
+def get_result(response_msg):
+    """ :return: <dict> the fields of response_msg produced by running its command.
+    """
+    return dict((field, value) for field, value in response_msg.items()
+                if field in RESULT_FIELDS or field.startswith(RESULT_FIELD_PREFIXES))
+
+
+class ResultCache:
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL, store_dir=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.store_dir = store_dir
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (expires_ts, result), least recently used first
+        self._lock = threading.Lock()
+        if store_dir and not os.path.isdir(store_dir):
+            os.makedirs(store_dir)
+
+    def get(self, key):
+        """ :return: <dict> result stored for key, None if not cached or expired.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[0] > now:
+                self._entries[key] = entry  # most recently used
+                self.hits += 1
+                return dict(entry[1])
+        entry = self._load(key, now)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self._add(key, entry)
+            self.hits += 1
+            return dict(entry[1])
+
+    def put(self, key, result, ttl=None):
+        entry = (time.time() + (ttl if ttl is not None else self.ttl), dict(result))
+        with self._lock:
+            self._entries.pop(key, None)
+            self._add(key, entry)
+        self._store(key, entry)
+
+    def size(self):
+        return len(self._entries)
+
+    def _add(self, key, entry):
+        self._entries[key] = entry
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.store_dir, key + '.json')
+
+    def _load(self, key, now):
+        if not self.store_dir or not os.path.isfile(self._path(key)):
+            return None
+        try:
+            with open(self._path(key), 'r') as f:
+                expires_ts, result = json.load(f)
+            if expires_ts > now:
+                return expires_ts, result
+            os.remove(self._path(key))
+        except Exception:
+            logger = get_logger(name=curr_module_name())
+            logger.warning('Discarding unreadable cached result: %s', self._path(key),
+                           exc_info=True)
+        return None
+
+    def _store(self, key, entry):
+        if not self.store_dir:
+            return
+        tmp_path = '{}.{}.{}.tmp'.format(self._path(key), os.getpid(),
+                                         threading.current_thread().ident)
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(entry, f)
+            os.rename(tmp_path, self._path(key))  # atomic: readers never see partial files
+        except Exception:
+            logger = get_logger(name=curr_module_name())
+            logger.warning('Exception storing cached result: %s', self._path(key), exc_info=True)
+
+
+class InFlight:
+    """ cacheable tasks running, by cache key. Shared by the workers of an executor, as their
+        ResultCache: a task for a command already running, in any worker, waits for its result
+        instead of running it again.
+        Waiters are deques of their worker: answers are appended to them, to be completed by
+        the worker thread owning the task channel.
+    """
+    def __init__(self):
+        self._waiting = {}  # key -> [(waiter, item)]
+        self._lock = threading.Lock()
+
+    def wait_for(self, key, waiter, item):
+        """ :return: True if item waits for the task of key, running. False if none runs: the
+                 caller runs it, and answers the items waiting meanwhile with done(key).
+        """
+        with self._lock:
+            if key in self._waiting:
+                self._waiting[key].append((waiter, item))
+                return True
+            self._waiting[key] = []
+            return False
+
+    def done(self, key, result):
+        """ answers the items waiting for the task of key: waiter gets (item, result).
+            result None: they are run on their own.
+        """
+        with self._lock:
+            waiting = self._waiting.pop(key, [])
+        for waiter, item in waiting:
+            waiter.append((item, result))
+
+    def running_nr(self):
+        return len(self._waiting)
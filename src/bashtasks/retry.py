@@ -0,0 +1,71 @@
+""" retry schedules retries of failed tasks after a delay, as per their retry policy.
+
+    Retry policies, set per task (request retry_policy, retry_delay, retry_max_delay) or as
+    executor default:
+      - fixed: waits retry_delay ms before every retry.
+      - exponential: waits retry_delay * 2^retries ms, up to retry_max_delay.
+      - jitter: waits a random time between 0 and the exponential delay ("full jitter"),
+                so tasks failing together don't retry together.
+    retry_delay 0 retries immediately.
+
+    Delayed retries wait in the broker, not in the executor: they are published to a delay
+    queue whose messages expire (x-message-ttl) into the task queue (x-dead-letter-exchange).
+    Delays are rounded up to one significant digit (eg: 1234ms -> 2000ms) so a few delay
+    queues per destination serve every delay. Tasks with routing_key have their own delay
+    queues, expiring into the routed exchange of the destination.
+"""
+import math
+import random
+
+from bashtasks.rabbit_util import declaration_cache, declare_routed_exchange
+
+FIXED = 'fixed'
+EXPONENTIAL = 'exponential'
+JITTER = 'jitter'
+RETRY_POLICIES = (FIXED, EXPONENTIAL, JITTER)
+
+DEFAULT_RETRY_DELAY = 1000  # ms
+DEFAULT_RETRY_MAX_DELAY = 300000  # ms
+
+
+def get_retry_delay(policy, retries, retry_delay=DEFAULT_RETRY_DELAY,
+                    retry_max_delay=DEFAULT_RETRY_MAX_DELAY, rand=random.random):
+    """ retries: retries done so far.
+        :return: ms to wait before next retry.
+    """
+    if policy == FIXED:
+        delay = retry_delay
+    else:
+        delay = retry_delay * 2 ** min(retries, 32)
+        if policy == JITTER:
+            delay = int(rand() * delay)
+    return min(delay, retry_max_delay)
+
+
+def quantize_delay(delay):
+    """ :return: delay rounded up to one significant digit.
+    """
+    if delay <= 0:
+        return 0
+    magnitude = 10 ** int(math.floor(math.log10(delay)))
+    return int(math.ceil(float(delay) / magnitude) * magnitude)
+
+
+def get_delay_queue(destination, delay, routing_key=None):
+    name = '{}:retry:{}ms'.format(destination, delay)
+    return name + ':' + routing_key if routing_key else name
+
+
+def declare_delay_queue(ch, destination, delay, routing_key=None):
+    """ declares the queue delaying msgs delay ms before dead lettering them to destination,
+        or to its routed exchange with routing_key. Once per connection.
+        :return: delay queue name
+    """
+    name = get_delay_queue(destination, delay, routing_key)
+    arguments = {'x-message-ttl': delay, 'x-dead-letter-exchange': destination}
+    if routing_key:
+        arguments.update({'x-dead-letter-exchange': declare_routed_exchange(ch, destination),
+                          'x-dead-letter-routing-key': routing_key})
+    declaration_cache.declare(ch, ('queue', name), lambda: ch.queue_declare(
+        queue=name, arguments=arguments))
+    return name
@@ -0,0 +1,99 @@
+""" spill: append-only segmented files of JSON records (eg: task responses), instead of a file
+    per record: with millions of responses, files (and inodes) grow by segment_bytes, not by
+    record.
+
+    Records are JSON lines, in segments named <prefix>.<segment>.jsonl, segment 0, 1, 2...
+    A new segment starts once the current one exceeds segment_bytes. Segments are never
+    rewritten: a SpillWriter on a directory with segments of prefix starts after the last one.
+    read_spill(directory, prefix) yields the records back, in the order they were written.
+"""
+import json
+import os
+import re
+import threading
+
+DEFAULT_SEGMENT_BYTES = 64 * 1048576
+SUFFIX = '.jsonl'
+
+
+def get_segment_path(directory, prefix, segment):
+    return os.path.join(directory, '{}.{:06d}{}'.format(prefix, segment, SUFFIX))
+
+
+def get_segments(directory, prefix):
+    """ :return: [(segment, path)] of the segments of prefix in directory, in order.
+    """
+    pattern = re.compile(r'^{}\.(\d+){}$'.format(re.escape(prefix), re.escape(SUFFIX)))
+    segments = []
+    for filename in os.listdir(directory):
+        match = pattern.match(filename)
+        if match:
+            segments.append((int(match.group(1)), os.path.join(directory, filename)))
+    return sorted(segments)
+
+
+def read_spill(directory, prefix):
+    """ :return: generator of the records of every segment of prefix in directory.
+    """
+    for segment, path in get_segments(directory, prefix):
+        with open(path, 'rb') as segment_file:
+            for line in segment_file:
+                if line.strip():
+                    yield json.loads(line.decode('utf-8'))
+
+
+class SpillWriter:
+    """ appends records to the segments of prefix in directory. Thread safe: records of many
+        threads (eg: responses_recvr workers) go to the same segments.
+    """
+    def __init__(self, directory, prefix='responses', segment_bytes=DEFAULT_SEGMENT_BYTES,
+                 fsync=False):
+        """ fsync: flush writes segments to disk, not only to the OS page cache.
+        """
+        self.directory = directory
+        self.prefix = prefix
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.records_written = 0
+        segments = get_segments(directory, prefix)
+        self.segment = segments[-1][0] + 1 if segments else 0
+        self._file = None
+        self._file_bytes = 0
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        """ appends record <dict>, buffered until flush.
+        """
+        data = (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8')
+        with self._lock:
+            if self._file is None:
+                self._open()
+            elif self._file_bytes >= self.segment_bytes:
+                self._file.close()
+                self.segment += 1
+                self._open()
+            self._file.write(data)
+            self._file_bytes += len(data)
+            self.records_written += 1
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                if self.fsync:
+                    os.fsync(self._file.fileno())
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+                self.segment += 1  # closed segments are not appended to
+
+    def current_path(self):
+        return get_segment_path(self.directory, self.prefix, self.segment)
+
+    def _open(self):
+        self._file = open(self.current_path(), 'ab')
+        self._file_bytes = 0
@@ -1,8 +1,11 @@
+import time
+
 from bashtasks.rabbit_util import connect_and_declare, declare_and_bind, close_channel_and_conn
 from bashtasks.constants import TASK_RESPONSES_POOL
+from bashtasks.codec import decode
 
-#TODO: should be removed. rabbit_util should have conn factory, with singleton option
-channel_inst = None
+POLL_INTERVAL = 0.5  # secs between checks of stop() while consuming
+DEFAULT_ACK_INTERVAL = 1.0  # reduce: max secs responses folded stay unacked
 
 
 class ResponseMsg:
@@ -30,40 +33,117 @@ class MessageAmqpPika:
     def ack(self):
         self._channel.basic_ack(self._method.delivery_tag)
 
+    def decode(self):
+        """ :return: <dict> response message in body, whatever its codec.
+        """
+        return decode(self.body, self.properties)
+
     def requeue(self):
-        raise Exception('MessageAmqpPika.requeue not yet implemented')
+        """ gives the response back to its queue, to be received again.
+        """
+        self._channel.basic_nack(self._method.delivery_tag, requeue=True)
 
     def discard(self):
-        raise Exception('MessageAmqpPika.discard not yet implemented')
+        """ drops the response, dead lettered if its queue has a dead letter exchange.
+        """
+        self._channel.basic_nack(self._method.delivery_tag, requeue=False)
 
 
 class TaskResponseSubscriber:
-    def __init__(self, host='127.0.0.1', port=5672, usr='guest', pas='guest'):
+    """ consumes responses on its own channel (and connection, unless given a channel):
+        pika channels are not thread safe, run one subscriber per consuming thread.
+    """
+    def __init__(self, host='127.0.0.1', port=5672, usr='guest', pas='guest', channel=None,
+                 prefetch=1, transport=None):
+        """ transport: name or instance, see transport module. Default: pika.
+        """
         self.host = host
         self.port = port
         self.usr = usr
         self.pas = pas
+        self.channel = channel
+        self.prefetch = prefetch
+        self.transport = transport
+        self._stopping = False
 
     def subscribe(self, callback, queue=TASK_RESPONSES_POOL):
+        """ calls callback(MessageAmqpPika) for every response in queue, until stop().
+            the channel and connection created by subscribe are closed on return.
+        """
         def pika_event_to_bashtasks_msg(ch, method, properties, body):
             msg = MessageAmqpPika(ch, method, properties, body)
             callback(msg)
 
-        global channel_inst
-        if not channel_inst:
-            channel_inst = connect_and_declare(host=self.host, port=self.port, usr=self.usr, pas=self.pas)
-
-        channel_inst.basic_qos(prefetch_count=1)  # consume msgs one at a time
-
-        channel_inst.basic_consume(pika_event_to_bashtasks_msg, queue=queue, no_ack=False)
-
-        channel_inst.start_consuming()
-
-
-def init_subscriber(host='127.0.0.1', port=5672, usr='guest', pas='guest', channel=None):
-    if channel:
-        global channel_inst
-        channel_inst = channel
-
-    resp_subs = TaskResponseSubscriber(host=host, port=port, usr=usr, pas=pas)
-    return resp_subs
+        self._consume(pika_event_to_bashtasks_msg, queue)
+
+    def reduce(self, reducer, queue=TASK_RESPONSES_POOL, ack_every=None,
+               ack_interval=DEFAULT_ACK_INTERVAL):
+        """ folds every response in queue into reducer (StreamingReducer), until stop().
+            Responses are acked in batches (multiple=True) once folded and spilled: every
+            ack_every responses (default: half the prefetch) or ack_interval secs. Use a high
+            prefetch, eg: init_subscriber(prefetch=1000). If reducer raises, responses not
+            acked are requeued: they may be folded again by the next reduce.
+            :return: reducer
+        """
+        ack_every = ack_every or max(1, self.prefetch // 2)
+        unacked = {'delivery_tag': None, 'nr': 0, 'ts': time.time()}
+
+        def ack_reduced(ch):
+            if unacked['nr']:
+                reducer.flush()
+                ch.basic_ack(unacked['delivery_tag'], multiple=True)
+            unacked.update(nr=0, ts=time.time())
+
+        def on_response(ch, method, properties, body):
+            reducer.add(decode(body, properties))
+            unacked['delivery_tag'] = method.delivery_tag
+            unacked['nr'] += 1
+            if unacked['nr'] >= ack_every:
+                ack_reduced(ch)
+
+        def on_poll(ch):
+            if time.time() - unacked['ts'] >= ack_interval:
+                ack_reduced(ch)
+
+        self._consume(on_response, queue, on_poll=on_poll, on_stop=ack_reduced)
+        return reducer
+
+    def _consume(self, on_message, queue, on_poll=None, on_stop=None):
+        """ calls on_message(ch, method, properties, body) for every msg in queue until stop(),
+            on_poll(ch) after every poll for msgs and on_stop(ch) once stopped.
+        """
+        own_channel = not self.channel
+        if own_channel:
+            self.channel = connect_and_declare(host=self.host, port=self.port, usr=self.usr,
+                                               pas=self.pas, transport=self.transport)
+
+        self.channel.basic_qos(prefetch_count=self.prefetch)
+
+        self.channel.basic_consume(on_message, queue=queue, no_ack=False)
+
+        try:
+            while not self._stopping:
+                self.channel.connection.process_data_events(time_limit=POLL_INTERVAL)
+                if on_poll is not None:
+                    on_poll(self.channel)
+            if on_stop is not None:
+                on_stop(self.channel)
+        finally:
+            if own_channel:
+                connection = self.channel.connection
+                close_channel_and_conn(self.channel)
+                if connection.is_open:
+                    connection.close()
+                self.channel = None
+
+    def stop(self):
+        """ makes subscribe (or reduce) return, within POLL_INTERVAL secs. Can be called from any
+            thread. unacked msgs are requeued.
+        """
+        self._stopping = True
+
+
+def init_subscriber(host='127.0.0.1', port=5672, usr='guest', pas='guest', channel=None,
+                    prefetch=1, transport=None):
+    return TaskResponseSubscriber(host=host, port=port, usr=usr, pas=pas, channel=channel,
+                                  prefetch=prefetch, transport=transport)
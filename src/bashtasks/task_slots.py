@@ -0,0 +1,93 @@
+""" task_slots runs up to N tasks concurrently for a single AMQP channel.
+
+    pika channels are not thread safe: messages are received, acked and responded in the
+    connection thread. Slots only run tasks, and hand results back through a done queue
+    the connection thread drains between process_data_events calls.
+    Slots can also defer calls to the connection thread (eg: publishing output chunks),
+    they are run in order with the results.
+"""
+import threading
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+
+class TaskSlots:
+    def __init__(self, slots, run, name='slots', max_deferred=None):
+        """ slots: number of tasks run concurrently.
+            run: callable(msg) -> result, called in a slot thread. Must not raise.
+            max_deferred: deferred calls pending to be drained before defer blocks.
+        """
+        self.slots = slots
+        self.run = run
+        self._todo = queue.Queue()
+        self._done = queue.Queue()
+        self._busy = 0
+        self._busy_lock = threading.Lock()
+        self._deferred = threading.BoundedSemaphore(max_deferred or slots * 4)
+        self._threads = []
+        for slot in range(0, slots):
+            slot_th = threading.Thread(target=self._run_slot, name='{}_slot_{}'.format(name, slot))
+            slot_th.daemon = True
+            slot_th.start()
+            self._threads.append(slot_th)
+
+    def submit(self, context, msg):
+        """ queues msg to be run in a free slot. context is handed back with its result.
+        """
+        with self._busy_lock:
+            self._busy += 1
+        self._todo.put((context, msg))
+
+    def defer(self, fn, *args):
+        """ fn(*args) will be called by the connection thread, on drain.
+            blocks while max_deferred calls are pending: memory stays bounded when the
+            connection thread is slower than the slots.
+        """
+        self._deferred.acquire()
+        self._done.put((fn, args))
+
+    def busy_nr(self):
+        """ :return: tasks submitted whose result has not been drained yet.
+        """
+        with self._busy_lock:
+            return self._busy
+
+    def drain(self, complete, timeout=0):
+        """ calls complete(context, msg, result) for every finished task,
+            and the deferred calls, in the order they were produced.
+            timeout: secs to wait for a first result when none is available.
+            :return: number of tasks completed.
+        """
+        completed = 0
+        block = timeout > 0
+        while True:
+            try:
+                done = self._done.get(block, timeout) if block else self._done.get_nowait()
+            except queue.Empty:
+                return completed
+            block = False
+            if len(done) == 2:  # deferred call
+                fn, args = done
+                self._deferred.release()
+                fn(*args)
+                continue
+            context, msg, result = done
+            with self._busy_lock:
+                self._busy -= 1
+            complete(context, msg, result)
+            completed += 1
+
+    def stop(self):
+        for _ in self._threads:
+            self._todo.put(None)
+
+    def _run_slot(self):
+        while True:
+            task = self._todo.get()
+            if task is None:
+                return
+            context, msg = task
+            self._done.put((context, msg, self.run(msg)))
@@ -0,0 +1,59 @@
+""" transport: how bashtasks connects to its broker. Transports open connections with the pika
+    BlockingConnection API, every module (rabbit_util, bashtasks_client, executor,
+    task_response_subscriber, response_demux) works the same over any of them:
+      - PikaTransport ('pika', the default): RabbitMQ at host:port.
+      - InMemoryTransport ('memory'): memory_broker of this process, host and credentials are
+        ignored. Clients, executors and subscribers of a process exchange tasks at memory
+        speed, with ack/requeue semantics but no persistence: single node batch runs, tests,
+        benchmarks.
+    Given by name or instance: bashtasks.init(transport='memory'),
+    start_executors(transport='memory'), init_subscriber(transport='memory')
+"""
+from pika import BlockingConnection, ConnectionParameters, PlainCredentials
+
+from bashtasks import memory_broker
+
+PIKA = 'pika'
+MEMORY = 'memory'
+TRANSPORTS = (PIKA, MEMORY)
+
+
+class PikaTransport:
+    name = PIKA
+
+    def connect(self, host='localhost', port=5672, usr='guest', pas='guest', heartbeat=None):
+        """ :return: pika BlockingConnection. Raises AMQPConnectionError if unreachable.
+        """
+        credentials = PlainCredentials(usr, pas)
+        parameters = ConnectionParameters(host, port, '/', credentials,
+                                          heartbeat_interval=heartbeat)
+        return BlockingConnection(parameters)
+
+
+class InMemoryTransport:
+    name = MEMORY
+
+    def __init__(self, broker=None):
+        """ broker: MemoryBroker, default the process wide memory_broker.broker
+        """
+        self.broker = broker or memory_broker.broker
+
+    def connect(self, host=None, port=None, usr=None, pas=None, heartbeat=None):
+        """ :return: MemoryConnection to broker.
+        """
+        return self.broker.connect()
+
+
+transports = {PIKA: PikaTransport(), MEMORY: InMemoryTransport()}
+
+
+def get_transport(transport=None):
+    """ transport: name in TRANSPORTS or transport instance. None: pika.
+    """
+    if transport is None:
+        return transports[PIKA]
+    if transport in TRANSPORTS:
+        return transports[transport]
+    if hasattr(transport, 'connect'):
+        return transport
+    raise ValueError('Unknown transport {}, expected one of {}'.format(transport, TRANSPORTS))
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+""" bench_codec measures encode/decode cost and message size of every available codec,
+    for responses with stdout of several sizes. Does not need a RabbitMQ.
+    Usage sample: python benchmarks/bench_codec.py --iterations 2000
+"""
+import argparse
+import os
+import time
+import base64
+
+from bashtasks.codec import Codec, decode
+from bashtasks.message import get_request
+
+CODECS = ('json', 'json+zlib', 'json+zstd', 'msgpack', 'msgpack+zlib', 'msgpack+zstd')
+STDOUT_SIZES = (100, 10000, 1000000)
+
+
+def get_response(stdout_size):
+    response = get_request(['md5sum', '/data/input/file.bin'], max_retries=3)
+    # half compressible text, half random
+    text = ('line of log output {}\n' * (stdout_size // 40)).format(*range(stdout_size // 40))
+    noise = base64.b64encode(os.urandom(stdout_size // 4)).decode('ascii')
+    response.update(returncode=0, stdout=(text + noise)[:stdout_size], stderr='',
+                    executor_name='host:1234:worker_th_0', pre_command_ts=1, post_command_ts=2,
+                    retries=0)
+    return response
+
+
+def bench(bench_codec, response, iterations):
+    start = time.time()
+    for _ in range(iterations):
+        body, content_encoding = bench_codec.encode(response)
+    encode_us = (time.time() - start) * 1000000 / iterations
+
+    properties = bench_codec.properties(content_encoding)
+    start = time.time()
+    for _ in range(iterations):
+        decode(body, properties)
+    decode_us = (time.time() - start) * 1000000 / iterations
+    return len(body), encode_us, decode_us
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=globals()['__doc__'], add_help=True)
+    parser.add_argument('--iterations', default=1000, dest='iterations', type=int)
+    args = parser.parse_args()
+
+    print('{:>10} {:>14} {:>12} {:>12} {:>12}'.format('stdout', 'codec', 'bytes',
+                                                      'encode us', 'decode us'))
+    for stdout_size in STDOUT_SIZES:
+        response = get_response(stdout_size)
+        iterations = max(1, args.iterations * 100 // stdout_size) if stdout_size > 100 \
+            else args.iterations
+        for name in CODECS:
+            try:
+                bench_codec = Codec(name)
+            except ImportError:
+                print('{:>10} {:>14} not available'.format(stdout_size, name))
+                continue
+            size, encode_us, decode_us = bench(bench_codec, response, iterations)
+            print('{:>10} {:>14} {:>12} {:>12.1f} {:>12.1f}'.format(stdout_size, name, size,
+                                                                   encode_us, decode_us))
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+""" bench_logging measures the per task logging overhead of an executor consumer thread
+    (log_received and log_executed of every task) for each log level and mode. Records go to
+    /dev/null. Does not need a RabbitMQ.
+    Usage sample: python benchmarks/bench_logging.py --tasks 100000
+"""
+import argparse
+import os
+import sys
+import time
+
+from bashtasks import logger as logger_mod
+from bashtasks.executor import log_received, log_executed
+from bashtasks.message import get_request
+
+MODES = (('text', False, False), ('queued', True, False), ('json', False, True),
+         ('queued json', True, True))
+LEVELS = ('DEBUG', 'INFO')
+
+
+def get_response():
+    response = get_request(['md5sum', '/data/input/file.bin'], max_retries=3)
+    response.update(returncode=0, stdout='d41d8cd98f00b204e9800998ecf8427e\n', stderr='',
+                    pre_command_ts=1, spawned_ts=2, post_command_ts=3, retries=0)
+    return response
+
+
+def bench(logger, response, tasks):
+    """ :return: us per task, logging included until the queued records are written.
+    """
+    start = time.time()
+    for pending in range(tasks):
+        log_received(logger, 'worker_th_0', 'bashtasks:pool:requests', response)
+        log_executed(logger, 'worker_th_0', response, pending)
+    consumer_us = (time.time() - start) * 1000000 / tasks
+    logger_mod.stop_listener()  # waits for the background writer
+    return consumer_us, (time.time() - start) * 1000000 / tasks
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=globals()['__doc__'], add_help=True)
+    parser.add_argument('--tasks', default=100000, dest='tasks', type=int)
+    args = parser.parse_args()
+
+    stdout = sys.stdout
+    sys.stderr = open(os.devnull, 'w')  # before configure: handlers write to sys.stderr
+    logger = logger_mod.get_logger(name='bench_logging')
+    response = get_response()
+
+    stdout.write('{:>8} {:>12} {:>16} {:>16}\n'.format('level', 'mode', 'consumer us/task',
+                                                       'total us/task'))
+    for level in LEVELS:
+        for mode, queued, json_records in MODES:
+            logger_mod.configure(level=level, queued=queued, json_records=json_records)
+            consumer_us, total_us = bench(logger, response, args.tasks)
+            stdout.write('{:>8} {:>12} {:>16.3f} {:>16.3f}\n'.format(level, mode, consumer_us,
+                                                                     total_us))
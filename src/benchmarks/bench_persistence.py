@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+""" bench_persistence compares persistent and transient (persistent=False) tasks:
+    post_tasks msgs/sec and the latency of a single confirmed publish.
+    Tasks go to a durable destination, where the broker writes persistent msgs to disk
+    (bashtasks pools are not durable). It is deleted when done.
+    Needs a RabbitMQ.
+    Usage sample: python benchmarks/bench_persistence.py --host 127.0.0.1 --tasks 20000
+"""
+import argparse
+import sys
+import time
+
+import bashtasks as bashtasks_mod
+import bashtasks.rabbit_util as rabbit_util
+
+BENCH_DESTINATION = 'bashtasks:bench:durable'
+
+
+def commands(tasks):
+    return (['echo', str(i)] for i in range(tasks))
+
+
+def bench_throughput(bashtasks, tasks, persistent):
+    start = time.time()
+    summary = bashtasks.post_tasks(commands(tasks), destination=BENCH_DESTINATION,
+                                   persistent=persistent)
+    return summary['count'] / (time.time() - start)
+
+
+def bench_latencies(bashtasks, probes, persistent):
+    """ :return: sorted ms from publish to broker confirm of probes single tasks.
+    """
+    latencies = []
+    for command in commands(probes):
+        start = time.time()
+        bashtasks.post_tasks([command], destination=BENCH_DESTINATION, persistent=persistent)
+        latencies.append((time.time() - start) * 1000)
+    return sorted(latencies)
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def purge_bench_destination(ch):
+    ch.queue_purge(queue=BENCH_DESTINATION)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=globals()['__doc__'], add_help=True)
+    parser.add_argument('--host', default='127.0.0.1', dest='host')
+    parser.add_argument('--port', default=5672, dest='port', type=int)
+    parser.add_argument('--user', default='guest', dest='usr')
+    parser.add_argument('--pass', default='guest', dest='pas')
+    parser.add_argument('--tasks', default=20000, dest='tasks', type=int)
+    parser.add_argument('--probes', default=500, dest='probes', type=int)
+
+    args = parser.parse_args()
+
+    if not rabbit_util.is_rabbit_available(host=args.host, port=args.port, usr=args.usr,
+                                           pas=args.pas):
+        print('RabbitMQ not available at {}:{}'.format(args.host, args.port))
+        sys.exit(1)
+
+    ch = rabbit_util.connect(host=args.host, port=args.port, usr=args.usr,
+                             pas=args.pas).channel()
+    ch = rabbit_util.declare_and_bind(ch, BENCH_DESTINATION, routing_key='#', durable=True)
+    bashtasks = bashtasks_mod.init(host=args.host, port=args.port, usr=args.usr, pas=args.pas)
+    try:
+        print('tasks: {} probes: {} destination: {} (durable)'.format(
+            args.tasks, args.probes, BENCH_DESTINATION))
+        for name, persistent in (('persistent', True), ('transient', False)):
+            rate = bench_throughput(bashtasks, args.tasks, persistent)
+            purge_bench_destination(ch)
+            latencies = bench_latencies(bashtasks, args.probes, persistent)
+            purge_bench_destination(ch)
+            print('    {:10s}: {:10.0f} msgs/sec  confirm p50 {:6.2f}ms p99 {:6.2f}ms'.format(
+                name, rate, percentile(latencies, 50), percentile(latencies, 99)))
+    finally:
+        ch.queue_delete(queue=BENCH_DESTINATION)
+        ch.exchange_delete(exchange=BENCH_DESTINATION)
+        rabbit_util.close_channel_and_conn(ch)
+        bashtasks_mod.reset()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+""" bench_post_tasks compares msgs/sec of post_tasks confirming every message (confirm window 1)
+    against post_tasks confirming once per confirm window. Both are confirmed, so comparable.
+    A post_task loop is also measured for reference: it is NOT confirmed, so not comparable.
+    Needs a RabbitMQ. Posted tasks are purged from the requests pool after each run.
+    Usage sample: python benchmarks/bench_post_tasks.py --host 127.0.0.1 --tasks 50000
+"""
+import argparse
+import sys
+import time
+
+import bashtasks as bashtasks_mod
+import bashtasks.rabbit_util as rabbit_util
+
+
+def commands(tasks):
+    return (['echo', str(i)] for i in range(tasks))
+
+
+def bench_post_task_loop(bashtasks, tasks):
+    start = time.time()
+    for command in commands(tasks):
+        bashtasks.post_task(command)
+    return tasks / (time.time() - start)
+
+
+def bench_post_tasks(bashtasks, tasks, confirm_window):
+    start = time.time()
+    summary = bashtasks.post_tasks(commands(tasks), confirm_window=confirm_window)
+    elapsed = time.time() - start
+    if summary['failures']:
+        print('    post_tasks failures: {}'.format(len(summary['failures'])))
+    return summary['count'] / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=globals()['__doc__'], add_help=True)
+    parser.add_argument('--host', default='127.0.0.1', dest='host')
+    parser.add_argument('--port', default=5672, dest='port', type=int)
+    parser.add_argument('--user', default='guest', dest='usr')
+    parser.add_argument('--pass', default='guest', dest='pas')
+    parser.add_argument('--tasks', default=20000, dest='tasks', type=int)
+    parser.add_argument('--confirm-window', default=1000, dest='confirm_window', type=int)
+
+    args = parser.parse_args()
+
+    if not rabbit_util.is_rabbit_available(host=args.host, port=args.port, usr=args.usr,
+                                           pas=args.pas):
+        print('RabbitMQ not available at {}:{}'.format(args.host, args.port))
+        sys.exit(1)
+
+    bashtasks = bashtasks_mod.init(host=args.host, port=args.port, usr=args.usr, pas=args.pas)
+    rabbit_util.purge(host=args.host, port=args.port, usr=args.usr, pas=args.pas)
+
+    loop_rate = bench_post_task_loop(bashtasks, args.tasks)
+    rabbit_util.purge(host=args.host, port=args.port, usr=args.usr, pas=args.pas)
+
+    confirmed_rate = bench_post_tasks(bashtasks, args.tasks, 1)
+    rabbit_util.purge(host=args.host, port=args.port, usr=args.usr, pas=args.pas)
+
+    bulk_rate = bench_post_tasks(bashtasks, args.tasks, args.confirm_window)
+    rabbit_util.purge(host=args.host, port=args.port, usr=args.usr, pas=args.pas)
+
+    print('tasks: {} confirm_window: {}'.format(args.tasks, args.confirm_window))
+    print('    post_tasks window 1: {:10.0f} msgs/sec (confirmed)'.format(confirmed_rate))
+    print('    post_tasks         : {:10.0f} msgs/sec (confirmed)'.format(bulk_rate))
+    print('    speedup            : {:10.2f}x'.format(bulk_rate / confirmed_rate))
+    print('    post_task loop     : {:10.0f} msgs/sec (no confirms, not comparable)'
+          .format(loop_rate))
+    bashtasks_mod.reset()
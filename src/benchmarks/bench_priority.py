@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+""" bench_priority measures how long high priority tasks wait (pre_command_ts - request_ts)
+    behind a backlog of low priority tasks saturating the executors.
+    Needs a RabbitMQ. Starts its own executors (start_executor.py) and purges queues when done.
+    Usage sample: python benchmarks/bench_priority.py --backlog 2000 --probes 50 --workers 4
+"""
+import argparse
+import subprocess
+import sys
+import time
+
+import bashtasks as bashtasks_mod
+import bashtasks.rabbit_util as rabbit_util
+from bashtasks import TaskStatistics
+from bashtasks.constants import MAX_PRIORITY
+
+
+def probe(bashtasks, probes, priority, interval):
+    """ :return: TaskStatistics of probes tasks executed with priority, every interval secs.
+    """
+    stats = TaskStatistics()
+    for _ in range(probes):
+        stats.trackMsg(bashtasks.execute_task(['true'], timeout=600, priority=priority))
+        time.sleep(interval)
+    return stats
+
+
+def print_waits(name, stats):
+    print('    {:14s}: wait p50 {:7d}ms p99 {:7d}ms max {:7d}ms'.format(
+        name, stats.percentileTimeWaiting(50), stats.percentileTimeWaiting(99),
+        stats.timesWaiting.maximum()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=globals()['__doc__'], add_help=True)
+    parser.add_argument('--host', default='127.0.0.1', dest='host')
+    parser.add_argument('--port', default=5672, dest='port', type=int)
+    parser.add_argument('--user', default='guest', dest='usr')
+    parser.add_argument('--pass', default='guest', dest='pas')
+    parser.add_argument('--backlog', default=2000, dest='backlog', type=int)
+    parser.add_argument('--backlog-command', default='sleep 0.05', dest='backlog_command')
+    parser.add_argument('--probes', default=50, dest='probes', type=int)
+    parser.add_argument('--probe-interval', default=0.05, dest='probe_interval', type=float)
+    parser.add_argument('--workers', default=4, dest='workers', type=int)
+
+    args = parser.parse_args()
+
+    if not rabbit_util.is_rabbit_available(host=args.host, port=args.port, usr=args.usr,
+                                           pas=args.pas):
+        print('RabbitMQ not available at {}:{}'.format(args.host, args.port))
+        sys.exit(1)
+
+    bashtasks = bashtasks_mod.init(host=args.host, port=args.port, usr=args.usr, pas=args.pas)
+    rabbit_util.purge(host=args.host, port=args.port, usr=args.usr, pas=args.pas)
+    executors = subprocess.Popen([sys.executable, 'start_executor.py', '--host', args.host,
+                                  '--port', str(args.port), '--user', args.usr,
+                                  '--pass', args.pas, '--workers', str(args.workers)])
+    try:
+        print('backlog: {} x "{}" workers: {} probes: {}'.format(
+            args.backlog, args.backlog_command, args.workers, args.probes))
+        results = []
+        for name, priority in (('no priority', None), ('high priority', MAX_PRIORITY)):
+            bashtasks.post_tasks(args.backlog_command.split() for _ in range(args.backlog))
+            results.append((name, probe(bashtasks, args.probes, priority, args.probe_interval)))
+            rabbit_util.purge(host=args.host, port=args.port, usr=args.usr, pas=args.pas)
+        for name, stats in results:
+            print_waits(name, stats)
+    finally:
+        executors.terminate()
+        executors.wait()
+        rabbit_util.purge(host=args.host, port=args.port, usr=args.usr, pas=args.pas)
+        bashtasks_mod.reset()
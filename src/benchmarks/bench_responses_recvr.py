@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+""" bench_responses_recvr measures responses/sec received by responses_recvr workers.
+    Needs a RabbitMQ. For every workers number, publishes --responses responses to the
+    responses pool and times the workers until all of them are processed.
+    Usage sample: python benchmarks/bench_responses_recvr.py --responses 50000 --workers 1 2 4 8
+"""
+import argparse
+import logging
+import sys
+import time
+
+import pika
+
+import bashtasks.rabbit_util as rabbit_util
+import responses_recvr
+from bashtasks.constants import TASK_RESPONSES_POOL
+from bashtasks.logger import get_logger
+from bashtasks.TaskStatistics import ShardedTaskStatistics
+
+
+def publish_responses(ch, responses):
+    props = pika.BasicProperties(content_type='application/json', delivery_mode=2)
+    now = int(time.time() * 1000)
+    for i in range(responses):
+        body = ('{{"correlation_id": {0}, "request_ts": {1}, "pre_command_ts": {1}, '
+                '"post_command_ts": {1}, "returncode": 0, "executor_name": "bench", '
+                '"command": ["echo", "{0}"], "stdout": "{0}", "stderr": ""}}').format(i, now)
+        ch.basic_publish(exchange=TASK_RESPONSES_POOL, routing_key='', body=body, properties=props)
+
+
+def bench_workers(args, workers):
+    responses_recvr.set_msgs_to_process(args.responses)
+    stats = ShardedTaskStatistics()
+    start = time.time()
+    responses_recvr.run_workers(workers, host=args.host, port=args.port, usr=args.usr,
+                                pas=args.pas, stats=stats, prefetch=args.prefetch)
+    elapsed = time.time() - start
+    return stats.msgsNumber() / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=globals()['__doc__'], add_help=True)
+    parser.add_argument('--host', default='127.0.0.1', dest='host')
+    parser.add_argument('--port', default=5672, dest='port', type=int)
+    parser.add_argument('--user', default='guest', dest='usr')
+    parser.add_argument('--pass', default='guest', dest='pas')
+    parser.add_argument('--responses', default=20000, dest='responses', type=int)
+    parser.add_argument('--prefetch', default=100, dest='prefetch', type=int)
+    parser.add_argument('--workers', default=[1, 2, 4, 8], dest='workers', type=int, nargs='+')
+
+    args = parser.parse_args()
+
+    if not rabbit_util.is_rabbit_available(host=args.host, port=args.port, usr=args.usr,
+                                           pas=args.pas):
+        print('RabbitMQ not available at {}:{}'.format(args.host, args.port))
+        sys.exit(1)
+
+    get_logger(name=responses_recvr.curr_module_name()).setLevel(logging.WARNING)
+    ch = rabbit_util.connect_and_declare(host=args.host, port=args.port, usr=args.usr,
+                                         pas=args.pas)
+    rabbit_util.purge(host=args.host, port=args.port, usr=args.usr, pas=args.pas)
+
+    print('responses: {} prefetch: {}'.format(args.responses, args.prefetch))
+    for workers in args.workers:
+        publish_responses(ch, args.responses)
+        rate = bench_workers(args, workers)
+        rabbit_util.purge(host=args.host, port=args.port, usr=args.usr, pas=args.pas)
+        print('    {:2d} workers : {:10.0f} responses/sec'.format(workers, rate))
+    rabbit_util.close_channel_and_conn(ch)
@@ -19,8 +19,11 @@ parser.add_argument('--user', default='guest', dest='usr')
 parser.add_argument('--pass', default='guest', dest='pas')
 parser.add_argument('--max-retries', default=None, dest='max_retries', type=int)
 parser.add_argument('--no-wait', default=False, action='store_true', dest='fire_and_forget')
+parser.add_argument('--local', default=False, action='store_true', dest='local')  # no broker
 parser.add_argument('--command', required=True, dest='command',
                     metavar='"COMMAND" to execute. Better wrapped with quotes (")')
+parser.add_argument('--codec', dest='codec', default=None,
+                    metavar='wire format of task and response: json (default), json+zlib, msgpack...')
 parser.add_argument('--destination', dest='destination', default=DEFAULT_DESTINATION,
                     metavar='"destination" (exchange->queue) to send the message to.')
 
@@ -29,6 +32,8 @@ if len(sys.argv) == 1:
     sys.exit(1)
 
 args = parser.parse_args()
+if args.local and args.fire_and_forget:
+    parser.error('--local runs the task in this process: it needs to wait for it, not --no-wait')
 args.command = args.command.split()
 
 
@@ -37,7 +42,9 @@ def currtimemillis():
 
 start_ts = currtimemillis()
 
-bashtasks = bashtasks_mod.init(host=args.host, port=args.port, usr=args.usr, pas=args.pas)
+bashtasks = bashtasks_mod.init(host=args.host, port=args.port, usr=args.usr, pas=args.pas,
+                               codec=args.codec, local_workers=1 if args.local else 0,
+                               local_options={'queue': args.destination})
 
 if args.fire_and_forget:
     bashtasks.post_task(args.command, max_retries=args.max_retries, destination=args.destination)
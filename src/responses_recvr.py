@@ -2,25 +2,42 @@
 """ responses_recvr is the process that asynchronously receives POOL responses
 """
 import argparse
+import itertools
 import subprocess
 import sys
 import os
 import json
+import logging
 import time
 import threading
 from socket import gethostname
 
 from bashtasks.rabbit_util import connect_and_declare
 
-from bashtasks import TaskStatistics
 from bashtasks import init_subscriber
+from bashtasks import metrics
+from bashtasks.TaskStatistics import ShardedTaskStatistics
 from bashtasks.constants import TASK_REQUESTS_POOL, TASK_RESPONSES_POOL
-from bashtasks.logger import get_logger
+from bashtasks.csv_writer import DEFAULT_FLUSH_INTERVAL
+from bashtasks import logger as logger_mod
+from bashtasks.logger import get_logger, log_fields, LEVELS
+from bashtasks.output_capture import is_chunk
+from bashtasks.spill import SpillWriter, DEFAULT_SEGMENT_BYTES
 
 pending_tasks = -1  # pending_tasks: -1 is infinite.
-index = 1  # index to differenciate same correlation_id msgs
+pending_lock = threading.Lock()
+all_processed = threading.Event()  # set once the last of the msgs to process is claimed
+index = itertools.count(1)  # index to differenciate same correlation_id msgs
 stats = None
 
+responses_received = metrics.registry.counter('bashtasks_responses_received_total',
+                                              'Task responses received.')
+responses_failed = metrics.registry.counter('bashtasks_responses_failed_total',
+                                            'Task responses with returncode not 0.',
+                                            ('returncode', ))
+response_latency_seconds = metrics.registry.histogram('bashtasks_responses_latency_seconds',
+                                                      'Secs from request to response received.')
+
 
 def curr_module_name():
     return os.path.splitext(os.path.basename(__file__))[0]
@@ -35,14 +52,21 @@ def is_error(msg):
 
 
 def trace_msg(msgs_dir, msg):
-    global index
-    filename = '{}.{}.msg.json'.format(msg['correlation_id'], index)
-    index += 1
+    filename = '{}.{}.msg.json'.format(msg['correlation_id'], next(index))
 
     with open(os.path.join(msgs_dir, filename), 'w') as err_file:
         err_file.write(json.dumps(msg))
 
 
+def get_msgs_spill(msgs_dir, segment_mb=DEFAULT_SEGMENT_BYTES // 1048576, file_per_msg=False):
+    """ :return: SpillWriter tracing msgs to msgs_dir in segments of segment_mb,
+        None if not tracing or tracing a file per msg (file_per_msg).
+    """
+    if not msgs_dir or file_per_msg:
+        return None
+    return SpillWriter(msgs_dir, prefix='msgs', segment_bytes=segment_mb * 1048576)
+
+
 def log_exc(txt):
     logger = get_logger(name=curr_module_name())
     logger.error(txt)
@@ -61,64 +85,120 @@ def init_dir(directory):
 
 
 def start_responses_recvr(host='127.0.0.1', port=5672, usr='guest', pas='guest', stats=None,
-                          msgs_dir=None, trace_err_only=False, verbose=False):
+                          msgs_dir=None, trace_err_only=False, verbose=False, subscriber=None,
+                          msgs_spill=None):
+    """ consumes responses until subscriber.stop(), or all msgs to process are processed.
+        every thread must have its own subscriber (and so connection).
+        stats: shared by threads, <ShardedTaskStatistics>
+        msgs_spill: SpillWriter msgs are traced to, instead of a file per msg in msgs_dir.
+    """
     logger = get_logger(name=curr_module_name())
-
-    def count_message_processed():
-        global pending_tasks
-        pending_tasks = -1 if pending_tasks == -1 else pending_tasks - 1
-
-        if pending_tasks == 0:
-            logger.info("Processed all messages... exiting.")
-            stats.sumaryPrettyPrint()
-            stats.closeCsvFile()
-            sys.exit()
-        else:  # pending_tasks < 0 -> infinite. > 0 is the nr msgs pending
-            logger.debug('-- still msgs_pending: %d', get_pending_nr())
+    subscriber = subscriber or init_subscriber(host=host, port=port, usr=usr, pas=pas)
 
     def handle_response(response_msg):
-        msg = json.loads(response_msg.body.decode('utf-8'))
-        logger.debug(">>>> response received: %s from queue %s correlation_id: %d \
-                      pending_msgs: %d is_error: %s",
-                     threading.current_thread().name, TASK_RESPONSES_POOL,
-                     msg['correlation_id'], get_pending_nr(), str(is_error(msg)))
+        msg = response_msg.decode()
+        if is_chunk(msg):  # output chunk of a task with chunks output_policy, not a response
+            response_msg.ack()
+            return
+        if not claim_message():  # all msgs to process are taken: left unacked, requeued
+            subscriber.stop()
+            return
+        if logger.isEnabledFor(logging.DEBUG):  # per response: nothing is formatted at INFO
+            logger.debug(">>>> response received: %s from queue %s correlation_id: %d "
+                         "pending_msgs: %d is_error: %s",
+                         threading.current_thread().name, TASK_RESPONSES_POOL,
+                         msg['correlation_id'], get_pending_nr(), str(is_error(msg)))
         if verbose:
-            logger.info('---------------------------------------- MSG:')
-            for key, value in msg.items():
-                logger.info('\t%s:-> %s', key, str(value))
-            logger.info('---------------------------------------------')
+            log_fields(logger, logging.INFO, '---------------------------------------- MSG:', msg)
 
         stats.trackMsg(msg)
+        observe_response(msg)
 
-        if msgs_dir and (not trace_err_only or is_error(msg)):
-            trace_msg(msgs_dir, msg)
+        if (msgs_dir or msgs_spill) and (not trace_err_only or is_error(msg)):
+            if msgs_spill is not None:
+                msgs_spill.write(msg)
+            else:
+                trace_msg(msgs_dir, msg)
 
         response_msg.ack()
 
-        count_message_processed()
+        if all_processed.is_set():
+            logger.info("Processed all messages... exiting.")
+            subscriber.stop()
 
     curr_th_name = threading.current_thread().name
 
     logger.info(">> Starting receiver %s connecting to rabbitmq: %s:%s@%s",
                 curr_th_name, usr, pas, host)
 
-    subscriber = init_subscriber(host=host, port=port, usr=usr, pas=pas)
     subscriber.subscribe(handle_response)
 
 
+def observe_response(msg):
+    responses_received.inc()
+    if is_error(msg):
+        responses_failed.inc(labels=(msg['returncode'], ))
+    if msg.get('request_ts'):
+        response_latency_seconds.observe(max(0, currtimemillis() - msg['request_ts']) / 1000.)
+
+
+def claim_message():
+    """ takes one of the msgs to process, before processing it.
+        :return: False if all msgs to process were already taken.
+    """
+    global pending_tasks
+    with pending_lock:
+        if pending_tasks == 0:
+            return False
+        if pending_tasks > 0:  # pending_tasks < 0 -> infinite. > 0 is the nr msgs pending
+            pending_tasks -= 1
+            if pending_tasks == 0:
+                all_processed.set()
+        return True
+
+
 def set_msgs_to_process(n):
     global pending_tasks
-    if n == 0:  # infinte
-        pending_tasks = -1
-    else:
-        pending_tasks = n
+    with pending_lock:
+        pending_tasks = -1 if n <= 0 else n  # 0: infinite
+        all_processed.clear()
 
 
 def get_pending_nr():
-    global pending_tasks
     return pending_tasks
 
 
+def run_workers(workers, host='127.0.0.1', port=5672, usr='guest', pas='guest', stats=None,
+                msgs_dir=None, trace_err_only=False, verbose=False, prefetch=1, msgs_spill=None):
+    """ runs workers receiver threads, each with its own connection, until all msgs to process
+        are processed (forever if infinite) or KeyboardInterrupt.
+    """
+    subscribers = [init_subscriber(host=host, port=port, usr=usr, pas=pas, prefetch=prefetch)
+                   for _ in range(0, workers)]
+    worker_ths = []
+    for x, subscriber in enumerate(subscribers):
+        worker_th = threading.Thread(target=start_responses_recvr,
+                                     kwargs=dict(host=host, port=port, usr=usr, pas=pas,
+                                                 stats=stats, msgs_dir=msgs_dir,
+                                                 trace_err_only=trace_err_only,
+                                                 verbose=verbose, subscriber=subscriber,
+                                                 msgs_spill=msgs_spill),
+                                     name='worker_th_' + str(x))
+        worker_th.daemon = True
+        worker_th.start()
+        worker_ths.append(worker_th)
+
+    try:
+        while any(th.is_alive() for th in worker_ths) and not all_processed.wait(0.5):
+            pass
+    except KeyboardInterrupt:
+        pass
+    for subscriber in subscribers:
+        subscriber.stop()
+    for worker_th in worker_ths:
+        worker_th.join()
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=globals()['__doc__'], add_help=True)
     parser.add_argument('--host', default='127.0.0.1', dest='host')
@@ -127,20 +207,41 @@ if __name__ == '__main__':
     parser.add_argument('--pass', default='guest', dest='pas')
     parser.add_argument('--workers', default=1, dest='workers', type=int)
     parser.add_argument('--tasks', default=-1, dest='tasks', type=int)
+    parser.add_argument('--prefetch', default=1, dest='prefetch', type=int,
+                        metavar='unacked responses per worker. Higher is faster')
     parser.add_argument('--stats-interval', default=0, dest='stats_interval', type=int)
     parser.add_argument('--csv', default=None, dest='stats_csv_filename')
+    parser.add_argument('--csv-flush-interval', default=DEFAULT_FLUSH_INTERVAL, type=float,
+                        dest='csv_flush_interval', metavar='max secs between csv flushes')
+    parser.add_argument('--csv-rotate-mb', default=None, type=int, dest='csv_rotate_mb',
+                        metavar='start a new csv file every N MB')
+    parser.add_argument('--csv-gzip', action='store_true', dest='csv_gzip')
     parser.add_argument('--msgs-dir', default=None, dest='msgs_dir')
+    parser.add_argument('--msgs-segment-mb', default=DEFAULT_SEGMENT_BYTES // 1048576,
+                        dest='msgs_segment_mb', type=int,
+                        metavar='trace msgs to --msgs-dir in segments of N MB')
+    parser.add_argument('--msgs-file-per-msg', action='store_true', dest='msgs_file_per_msg',
+                        help='trace a file per msg to --msgs-dir instead of segments')
     parser.add_argument('--trace-err-only', action='store_true', dest='trace_err_only')
     parser.add_argument('--verbose', action='store_true', dest='verbose')
+    parser.add_argument('--metrics-port', default=None, dest='metrics_port', type=int,
+                        metavar='port serving metrics at /metrics')
+    parser.add_argument('--log-level', default='DEBUG', dest='log_level', choices=LEVELS)
+    parser.add_argument('--log-queue', action='store_true', dest='log_queue')
+    parser.add_argument('--log-json', action='store_true', dest='log_json')
 
     if len(sys.argv) == 1:
         parser.print_help()
         sys.exit(1)
 
     args = parser.parse_args()
+    logger_mod.configure(level=args.log_level, queued=args.log_queue, json_records=args.log_json)
 
     set_msgs_to_process(args.tasks)
 
+    if args.metrics_port is not None:
+        metrics.serve(args.metrics_port)
+
     csvAutoSave = args.stats_csv_filename is not None
 
     if args.msgs_dir:
@@ -148,8 +249,13 @@ if __name__ == '__main__':
     if args.stats_csv_filename:
         init_dir(os.path.dirname(args.stats_csv_filename))
 
-    global stats
-    stats = TaskStatistics(csvAuto=csvAutoSave, csvFileName=args.stats_csv_filename)
+    msgs_spill = get_msgs_spill(args.msgs_dir, segment_mb=args.msgs_segment_mb,
+                                file_per_msg=args.msgs_file_per_msg)
+
+    csv_rotate_bytes = args.csv_rotate_mb * 1048576 if args.csv_rotate_mb else None
+    stats = ShardedTaskStatistics(csvAuto=csvAutoSave, csvFileName=args.stats_csv_filename,
+                                  csvFlushInterval=args.csv_flush_interval,
+                                  csvRotateBytes=csv_rotate_bytes, csvGzip=args.csv_gzip)
 
     if args.stats_interval > 0:  # print stats every stats_interval seconds
         logger = get_logger(name=curr_module_name())
@@ -167,10 +273,10 @@ if __name__ == '__main__':
         stats_th.daemon = True
         stats_th.start()
 
-    for x in range(0, args.workers):
-        worker_th = threading.Thread(target=start_responses_recvr,
-                                     args=(args.host, args.usr, args.pas, stats,
-                                           args.msgs_dir, args.trace_err_only,
-                                           args.verbose),
-                                     name='worker_th_' + str(x))
-        worker_th.start()
+    run_workers(args.workers, host=args.host, port=args.port, usr=args.usr, pas=args.pas,
+                stats=stats, msgs_dir=args.msgs_dir, trace_err_only=args.trace_err_only,
+                verbose=args.verbose, prefetch=args.prefetch, msgs_spill=msgs_spill)
+    stats.sumaryPrettyPrint()
+    stats.closeCsvFile()
+    if msgs_spill is not None:
+        msgs_spill.close()
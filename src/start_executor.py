@@ -7,7 +7,12 @@ import sys
 
 from bashtasks.constants import DestinationNames, TASK_REQUESTS_POOL
 from bashtasks.executor import register_signals_handling, start_executors, curr_module_name
-from bashtasks.logger import get_logger
+from bashtasks import logger as logger_mod
+from bashtasks.logger import get_logger, LEVELS
+from bashtasks.output_capture import OUTPUT_POLICIES, TRUNCATE, DEFAULT_CHUNK_SIZE
+from bashtasks.result_cache import DEFAULT_MAX_ENTRIES
+from bashtasks.fork_server import DEFAULT_PATTERN
+from bashtasks.retry import RETRY_POLICIES, EXPONENTIAL, DEFAULT_RETRY_DELAY, DEFAULT_RETRY_MAX_DELAY
 
 channels = []  # stores all executor thread channels.
 stop = False  # False until the executor is asked to stop
@@ -27,6 +32,48 @@ if __name__ == '__main__':
     parser.add_argument('--max-retries', default=0, dest='max_retries', type=int)
     parser.add_argument('--verbose', action='store_true', dest='verbose')
     parser.add_argument('--queue', default=DEFAULT_DESTINATION, dest='queue')
+    parser.add_argument('--slots', default=1, dest='slots', type=int,
+                        metavar='tasks executed concurrently by each worker, over its connection.')
+    parser.add_argument('--output-policy', default=TRUNCATE, dest='output_policy',
+                        choices=OUTPUT_POLICIES)
+    parser.add_argument('--output-cap', default=MB_10, dest='output_cap', type=int,
+                        metavar='truncate policy: max bytes of stdout/stderr kept, head and tail.')
+    parser.add_argument('--output-dir', default=None, dest='output_dir',
+                        metavar='file policy: directory to write stdout/stderr to.')
+    parser.add_argument('--chunk-size', default=DEFAULT_CHUNK_SIZE, dest='chunk_size', type=int,
+                        metavar='chunks policy: bytes of stdout/stderr per chunk message.')
+    parser.add_argument('--passive-declare', action='store_true', dest='passive_declare')
+    parser.add_argument('--retry-policy', default=EXPONENTIAL, dest='retry_policy',
+                        choices=RETRY_POLICIES)
+    parser.add_argument('--retry-delay', default=DEFAULT_RETRY_DELAY, dest='retry_delay', type=int,
+                        metavar='ms before first retry of a failed task. 0 retries immediately.')
+    parser.add_argument('--retry-max-delay', default=DEFAULT_RETRY_MAX_DELAY, type=int,
+                        dest='retry_max_delay', metavar='max ms between retries.')
+    parser.add_argument('--cache-size', default=DEFAULT_MAX_ENTRIES, dest='cache_size', type=int,
+                        metavar='results of cacheable tasks kept in memory.')
+    parser.add_argument('--cache-dir', default=None, dest='cache_dir',
+                        metavar='directory storing results of cacheable tasks, shared by executors')
+    parser.add_argument('--command-timeout', default=None, dest='command_timeout', type=float,
+                        metavar='secs a command may run before it is killed. Default: forever.')
+    parser.add_argument('--fork-server', action='store_true', dest='fork_server')
+    parser.add_argument('--fork-server-pattern', default=DEFAULT_PATTERN,
+                        dest='fork_server_pattern',
+                        metavar='regex of python commands run by the fork server.')
+    parser.add_argument('--fork-server-preload', default='', dest='fork_server_preload',
+                        metavar='comma separated modules imported by the fork server.')
+    parser.add_argument('--routing-pattern', default=[], dest='routing_patterns', action='append',
+                        metavar='topic pattern of routed tasks consumed too, eg: gpu.#')
+    parser.add_argument('--max-load', default=None, dest='max_load', type=float,
+                        metavar='1 minute load average consumption is paused at.')
+    parser.add_argument('--min-free-mem-mb', default=None, dest='min_free_mem_mb', type=int,
+                        metavar='available memory MB consumption is paused under.')
+    parser.add_argument('--max-children', default=None, dest='max_children', type=int,
+                        metavar='running commands consumption is paused at.')
+    parser.add_argument('--metrics-port', default=None, dest='metrics_port', type=int,
+                        metavar='port serving metrics at /metrics')
+    parser.add_argument('--log-level', default='DEBUG', dest='log_level', choices=LEVELS)
+    parser.add_argument('--log-queue', action='store_true', dest='log_queue')
+    parser.add_argument('--log-json', action='store_true', dest='log_json')
 
     register_signals_handling()
 
@@ -35,6 +82,20 @@ if __name__ == '__main__':
         sys.exit(1)
 
     args = parser.parse_args()
+    logger_mod.configure(level=args.log_level, queued=args.log_queue, json_records=args.log_json)
     start_executors(args.workers, args.host, args.port, args.usr, args.pas,  queue=args.queue,
-                    tasks_nr=args.tasks_nr, max_retries=args.max_retries, verbose=args.verbose)
+                    tasks_nr=args.tasks_nr, max_retries=args.max_retries, verbose=args.verbose,
+                    slots=args.slots, output_policy=args.output_policy,
+                    output_cap=args.output_cap, output_dir=args.output_dir,
+                    chunk_size=args.chunk_size, passive_declare=args.passive_declare,
+                    retry_policy=args.retry_policy, retry_delay=args.retry_delay,
+                    retry_max_delay=args.retry_max_delay, cache_size=args.cache_size,
+                    cache_dir=args.cache_dir, fork_server=args.fork_server,
+                    fork_server_pattern=args.fork_server_pattern,
+                    fork_server_preload=[module for module in args.fork_server_preload.split(',')
+                                         if module],
+                    command_timeout=args.command_timeout,
+                    routing_patterns=args.routing_patterns, max_load=args.max_load,
+                    min_free_mem_mb=args.min_free_mem_mb, max_children=args.max_children,
+                    metrics_port=args.metrics_port)
     get_logger(name=curr_module_name()).info('Executor exiting now.')
@@ -0,0 +1,94 @@
+""" fakes of pika connections and channels shared by tests.
+"""
+import pika
+
+
+class FakeConnection:
+    is_open = False
+
+    def close(*args, **kwargs):
+        pass
+
+
+class FakeChannel:
+    """ channel of a closed connection, records queue declarations.
+    """
+    is_open = False
+
+    def __init__(self):
+        self.connection = FakeConnection()
+        self._impl = self.connection
+        self.declared = []
+
+    def close(*args, **kwargs):
+        pass
+
+    def queue_declare(self, queue, arguments=None):
+        self.declared.append((queue, arguments))
+
+
+class FakeChannelWithConnection(FakeChannel):
+    """ its connection opens bulk_channel, eg: for post_tasks.
+    """
+    def __init__(self, bulk_channel):
+        FakeChannel.__init__(self)
+        self.connection = self
+        self.bulk_channel = bulk_channel
+
+    def channel(self):
+        return self.bulk_channel
+
+
+class FakeMethodFrame:
+    def __init__(self, method):
+        self.method = method
+
+
+class FakeImplChannel:
+    """ stands for the asynchronous pika channel: records publishes, confirms on demand.
+    """
+    def __init__(self):
+        self.published = []
+        self.on_confirm = None
+
+    def confirm_delivery(self, callback=None, nowait=False):
+        self.on_confirm = callback
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.published.append((exchange, routing_key, body, properties))
+
+
+class FakeConfirmingConnection:
+    """ every process_data_events confirms all messages published so far.
+        delivery tags in nack_tags are nacked. ack_all=False never confirms.
+    """
+    def __init__(self, impl, nack_tags=(), ack_all=True):
+        self.impl = impl
+        self.nack_tags = set(nack_tags)
+        self.ack_all = ack_all
+        self.confirmed = 0
+        self.process_calls = 0
+
+    def process_data_events(self, time_limit=0):
+        self.process_calls += 1
+        if not self.ack_all:
+            return
+        for tag in range(self.confirmed + 1, len(self.impl.published) + 1):
+            if tag in self.nack_tags:
+                method = pika.spec.Basic.Nack(delivery_tag=tag)
+            else:
+                method = pika.spec.Basic.Ack(delivery_tag=tag)
+            self.impl.on_confirm(FakeMethodFrame(method))
+        self.confirmed = len(self.impl.published)
+
+
+class FakeConfirmChannel:
+    is_open = True
+
+    def __init__(self, nack_tags=(), ack_all=True):
+        self._impl = FakeImplChannel()
+        self.connection = FakeConfirmingConnection(self._impl, nack_tags=nack_tags, ack_all=ack_all)
+        self.closed = False
+
+    def close(self):
+        self.closed = True
@@ -1,5 +1,7 @@
 import unittest
 from bashtasks import TaskStatistics
+from bashtasks.TaskStatistics import ShardedTaskStatistics
+import threading
 import time
 import os
 
@@ -34,9 +36,10 @@ def get_msg(request_ts=None, pre_command_ts=None, post_command_ts=None, returnco
             }
 
 
-def get_simple_experiment_stats(csvAuto=False, csvFileName=TEST_FILE, csvPersistenceRatio=0.2):
+def get_simple_experiment_stats(csvAuto=False, csvFileName=TEST_FILE, csvPersistenceRatio=0.2,
+                                keepSamples=True):
     stats = TaskStatistics(csvAuto=csvAuto, csvFileName=csvFileName,
-                           csvPersistenceRatio=csvPersistenceRatio)
+                           csvPersistenceRatio=csvPersistenceRatio, keepSamples=keepSamples)
     now = 1446628389719
     # total durations: 1000, 1700, 1500
     # waiting: 100, 50, 150
@@ -68,7 +71,7 @@ class TestBashTasks(unittest.TestCase):
         self.assertEqual(len(stats.msgs), 0)
 
     def test_trackMsg(self):
-        stats = TaskStatistics()
+        stats = TaskStatistics(keepSamples=True)
         msg = get_msg()
 
         stats.trackMsg(msg)
@@ -139,6 +142,35 @@ class TestBashTasks(unittest.TestCase):
         self.assertEqual(len(all_errors), 1)
         self.assertEqual(all_errors[0]['returncode'], err_code)
 
+    def test_allErrors_summarized_without_samples(self):
+        stats = TaskStatistics(maxErrors=2)
+        for i in range(3):
+            error = get_msg(returncode=err_code)
+            error['correlation_id'] = i
+            error['stdout'] = 'out'
+            error['stderr'] = 'x' * 5000 + 'boom'
+            stats.trackMsg(error)
+
+        all_errors = stats.allErrors()
+
+        self.assertEqual(stats.errorsNumber(), 3)
+        self.assertEqual([error['correlation_id'] for error in all_errors], [1, 2])
+        self.assertEqual(all_errors[0]['returncode'], err_code)
+        self.assertNotIn('stdout', all_errors[0])
+        self.assertTrue(all_errors[0]['stderr'].endswith('boom'))
+        self.assertEqual(len(all_errors[0]['stderr']), 1024)
+        self.assertEqual(stats.msgs, [])
+        self.assertEqual(len(stats.merge(get_simple_experiment_stats()).allErrors()), 2)
+
+    def test_allErrors_whole_with_samples(self):
+        stats = TaskStatistics(keepSamples=True)
+        error = get_msg(returncode=err_code)
+        error['stderr'] = 'boom'
+
+        stats.trackMsg(error)
+
+        self.assertEqual(stats.allErrors(), [error])
+
     def test_errorsNumber(self):
         stats = get_simple_experiment_stats()
 
@@ -165,6 +197,91 @@ class TestBashTasks(unittest.TestCase):
         self.assertEqual(return_codes_counter[0], 2)
         self.assertEqual(return_codes_counter[err_code], 1)
 
+    def test_percentiles(self):
+        stats = get_simple_experiment_stats()
+
+        # times to executed: 1000, 1500, 1700. percentiles are approximate (2%)
+        self.assertAlmostEqual(stats.percentileTimeToExecuted(50), 1500, delta=30)
+        self.assertAlmostEqual(stats.percentileTimeToExecuted(99), 1700, delta=34)
+        self.assertAlmostEqual(stats.percentileTimeWaiting(50), 100, delta=2)
+        self.assertAlmostEqual(stats.percentileExecutionTime(95), 1650, delta=33)
+
+    def test_empty_percentiles(self):
+        stats = TaskStatistics()
+
+        self.assertEqual(stats.percentileTimeToExecuted(99), 0)
+
+    def test_merge(self):
+        stats = get_simple_experiment_stats()
+        other = get_simple_experiment_stats()
+
+        stats.merge(other)
+
+        self.assertEqual(stats.msgsNumber(), 6)
+        self.assertEqual(stats.errorsNumber(), 2)
+        self.assertEqual(stats.avgTimeToExecuted(), 1400)
+        self.assertEqual(stats.maxTimeToExecuted(), 1700)
+        self.assertEqual(stats.getWorkersCounter()[WRKR_ONE], 4)
+        self.assertEqual(len(stats.msgs), 6)
+        self.assertEqual(len(stats.allErrors()), 2)
+
+    def test_keepSamples_false(self):
+        stats = TaskStatistics()
+        for _ in range(1000):
+            stats.trackMsg(get_msg())
+
+        self.assertEqual(stats.msgsNumber(), 1000)
+        self.assertEqual(len(stats.msgs), 0)
+        self.assertAlmostEqual(stats.avgTimeWaiting(), 200, delta=5)
+        self.assertTrue(len(stats.timesWaiting.histogram.buckets) < 5)
+
+    def test_msgs_keep_missing_fields_out(self):
+        stats = TaskStatistics(keepSamples=True)
+        msg = get_msg()
+        del msg['retries']
+
+        stats.trackMsg(msg)
+
+        self.assertEqual(stats.msgs, [msg])
+
+    def test_trackMsg_batch(self):
+        stats = TaskStatistics(keepSamples=True)
+        now = 1446628389719
+        msg = get_msg(request_ts=now, pre_command_ts=now + 100, post_command_ts=now + 900,
+                      returncode=err_code)
+        msg['batch'] = [{'command': 'ls', 'returncode': 0,
+                         'pre_command_ts': now + 100, 'post_command_ts': now + 300},
+                        {'command': 'false', 'returncode': err_code,
+                         'pre_command_ts': now + 300, 'post_command_ts': now + 900}]
+
+        stats.trackMsg(msg)
+
+        self.assertEqual(stats.msgsNumber(), 2)
+        self.assertEqual(stats.errorsNumber(), 1)
+        self.assertEqual(stats.maxExecutionTime(), 600)
+        self.assertEqual(stats.avgTimeWaiting(), 200)
+        self.assertEqual([m['command'] for m in stats.msgs], ['ls', 'false'])
+
+
+class TestShardedTaskStatistics(unittest.TestCase):
+    def test_trackMsg_from_threads(self):
+        stats = ShardedTaskStatistics()
+
+        def track(n):
+            for _ in range(n):
+                stats.trackMsg(get_msg(returncode=err_code))
+        threads = [threading.Thread(target=track, args=(250,)) for _ in range(4)]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+
+        self.assertEqual(stats.shardsNumber(), 4)
+        merged = stats.merged()
+        self.assertEqual(merged.msgsNumber(), 1000)
+        self.assertEqual(merged.errorsNumber(), 1000)
+        self.assertEqual(merged.getWorkersCounter()['exec1'], 1000)
+
 
 def readlines(filepath):
     with open(filepath, "r") as myfile:
@@ -0,0 +1,172 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import bashtasks
+from bashtasks import executor
+from bashtasks.admission import AdmissionController, count_children, get_cost
+from bashtasks.executor import DEFAULT_DESTINATION
+from bashtasks.memory_broker import MemoryBroker
+from bashtasks.transport import InMemoryTransport
+
+
+def write_host(proc_dir, load, mem_available_mb):
+    with open(os.path.join(proc_dir, 'loadavg'), 'w') as f:
+        f.write('{:.2f} 0.50 0.25 2/300 1234\n'.format(load))
+    with open(os.path.join(proc_dir, 'meminfo'), 'w') as f:
+        f.write('MemTotal:       16384000 kB\n')
+        f.write('MemAvailable:   {} kB\n'.format(mem_available_mb * 1024))
+
+
+class TestAdmission(unittest.TestCase):
+    def setUp(self):
+        self.proc_dir = tempfile.mkdtemp()
+        self.set_host(load=1.0, mem_available_mb=4096)
+        self.add_process(100, 1)  # executor
+        self.add_process(101, 100)
+        self.add_process(102, 100)
+        self.add_process(103, 101)  # grandchild
+        self.add_process(200, 1)
+
+    def tearDown(self):
+        shutil.rmtree(self.proc_dir)
+
+    def set_host(self, load, mem_available_mb):
+        write_host(self.proc_dir, load, mem_available_mb)
+
+    def add_process(self, pid, ppid):
+        os.mkdir(os.path.join(self.proc_dir, str(pid)))
+        with open(os.path.join(self.proc_dir, str(pid), 'stat'), 'w') as f:
+            f.write('{} (a (b) c) S {} {} {} 0\n'.format(pid, ppid, pid, pid))
+
+    def controller(self, **thresholds):
+        return AdmissionController(pids=[100], proc_dir=self.proc_dir, check_interval=0,
+                                   **thresholds)
+
+    def test_count_children(self):
+        self.assertEqual(count_children([100], self.proc_dir), 2)
+        self.assertEqual(count_children([100, 101], self.proc_dir), 2)
+        self.assertEqual(count_children([1], self.proc_dir), 2)
+
+    def test_get_cost(self):
+        self.assertEqual(get_cost(None), (0, 0))
+        self.assertEqual(get_cost({'cpu': 2}), (2, 0))
+        self.assertEqual(get_cost({'cpu': 0.5, 'mem_mb': 100}), (0.5, 100))
+
+    def test_no_thresholds(self):
+        admission = self.controller()
+
+        self.assertTrue(admission.admit({'cpu': 100, 'mem_mb': 100000}))
+
+    def test_max_load(self):
+        admission = self.controller(max_load=4)
+
+        self.assertTrue(admission.admit({'cpu': 3}))
+        self.assertFalse(admission.admit({'cpu': 2}))  # reserved cpu counts until released
+        admission.release({'cpu': 3})
+        self.assertTrue(admission.admits({'cpu': 2}))
+
+        self.set_host(load=4.5, mem_available_mb=4096)
+        self.assertFalse(admission.admit())
+        self.assertEqual(admission.rejected, 2)
+
+    def test_min_free_mem(self):
+        admission = self.controller(min_free_mem_mb=1024)
+
+        self.assertTrue(admission.admit({'mem_mb': 2048}))
+        self.assertTrue(admission.admit({'mem_mb': 1024}))
+        self.assertFalse(admission.admit({'mem_mb': 1}))
+        self.assertEqual(admission.running_nr(), 2)
+
+    def test_cost_beyond_host_admitted_alone(self):
+        admission = self.controller(min_free_mem_mb=1024)
+
+        self.assertTrue(admission.admit({'mem_mb': 10 ** 9}))
+        self.assertFalse(admission.admit({'mem_mb': 10 ** 9}))
+        self.assertFalse(admission.admits())  # reserved by the running task
+        admission.release({'mem_mb': 10 ** 9})
+        self.set_host(load=1.0, mem_available_mb=512)
+        self.assertFalse(admission.admit({'mem_mb': 10 ** 9}))  # host beyond thresholds
+
+    def test_max_children(self):
+        admission = self.controller(max_children=3)
+
+        self.assertTrue(admission.admit())  # 2 children running
+        self.add_process(104, 100)
+        self.assertFalse(admission.admits())
+
+        admission.watch(200)
+        self.add_process(201, 200)
+        self.assertEqual(admission.host_load().children, 4)
+
+    def test_host_load_sampled_every_check_interval(self):
+        admission = AdmissionController(max_load=2, pids=[100], proc_dir=self.proc_dir,
+                                        check_interval=3600)
+        self.assertTrue(admission.admits())
+
+        self.set_host(load=3, mem_available_mb=4096)
+
+        self.assertTrue(admission.admits())
+
+
+class TestExecutorAdmission(unittest.TestCase):
+    def setUp(self):
+        self.proc_dir = tempfile.mkdtemp()
+        write_host(self.proc_dir, load=1.0, mem_available_mb=4096)
+        self.transport = InMemoryTransport(MemoryBroker())
+        self.admission = AdmissionController(max_load=4, min_free_mem_mb=1024, pids=[],
+                                             proc_dir=self.proc_dir, check_interval=0)
+        self.client = bashtasks.init(transport=self.transport)
+
+    def tearDown(self):
+        bashtasks.reset()
+        shutil.rmtree(self.proc_dir)
+
+    def start_executor(self, tasks_nr):
+        executor.stop = False
+        del executor.channels[:]
+        executor_th = threading.Thread(target=executor.start_executor,
+                                       kwargs={'tasks_nr': tasks_nr, 'transport': self.transport,
+                                               'admission': self.admission})
+        executor_th.daemon = True
+        executor_th.start()
+        return executor_th
+
+    def wait_for(self, condition, timeout=10):
+        deadline = time.time() + timeout
+        while not condition():
+            self.assertLess(time.time(), deadline, 'Timeout waiting for condition')
+            time.sleep(0.01)
+
+    def test_pause_and_resume(self):
+        write_host(self.proc_dir, load=8.0, mem_available_mb=4096)
+        executor_th = self.start_executor(tasks_nr=1)
+        self.client.post_task(['echo', 'admitted'])
+        consumers = self.transport.broker.consumers
+
+        self.wait_for(lambda: self.admission.rejected > 0 and
+                      not consumers.get(DEFAULT_DESTINATION))
+        self.assertEqual(self.transport.broker.queues[DEFAULT_DESTINATION].size(), 1)
+
+        write_host(self.proc_dir, load=1.0, mem_available_mb=4096)
+        executor_th.join(10)
+        self.assertFalse(executor_th.is_alive())
+        self.assertEqual(self.transport.broker.queues[DEFAULT_DESTINATION].size(), 0)
+
+    def test_cost_beyond_host_does_not_block_queue(self):
+        executor_th = self.start_executor(tasks_nr=2)
+        self.client.post_task(['echo', 'oversized'], cost={'mem_mb': 10 ** 9})
+
+        response = self.client.execute_task(['echo', 'after'], timeout=10)
+
+        self.assertEqual(response['returncode'], 0)
+        executor_th.join(10)
+        self.assertFalse(executor_th.is_alive())
+        self.assertEqual(self.admission.rejected, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import sys
+import json
+import unittest
+
+py35 = sys.version_info >= (3, 5)
+
+if py35:
+    import asyncio
+    from bashtasks.async_client import AsyncBashTasks, InMemoryAsyncTransport
+    from bashtasks.message import from_str
+
+
+def echo_executor(request):
+    response = dict(request)
+    response.update(returncode=0, stdout=' '.join(request['command']), stderr='',
+                    executor_name='in_memory', retries=0)
+    return response
+
+
+@unittest.skipIf(not py35, "SKIP asyncio client Tests: python >= 3.5 required")
+class TestAsyncBashTasks(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_loop(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def start_client(self, transport):
+        return self.run_loop(AsyncBashTasks(transport, loop=self.loop).start())
+
+    def test_post_task_publishes_bashtasks_message(self):
+        transport = InMemoryAsyncTransport()
+        client = self.start_client(transport)
+
+        msg = self.run_loop(client.post_task(['ls', '-la'], destination='dest', max_retries=3))
+
+        published = from_str(transport.published['dest'][0])
+        self.assertEqual(published, msg)
+        self.assertEqual(published['max_retries'], 3)
+        self.assertEqual(published['reply_to'], transport.reply_queue)
+
+    def test_execute_task_returns_response(self):
+        client = self.start_client(InMemoryAsyncTransport(executor=echo_executor))
+
+        response = self.run_loop(client.execute_task(['echo', 'hi']))
+
+        self.assertEqual(response['returncode'], 0)
+        self.assertEqual(response['stdout'], 'echo hi')
+
+    def test_execute_task_gather_fan_out(self):
+        client = self.start_client(InMemoryAsyncTransport(executor=echo_executor))
+        commands = [['echo', str(i)] for i in range(5000)]
+
+        responses = self.run_loop(asyncio.gather(*[client.execute_task(command)
+                                                   for command in commands]))
+
+        self.assertEqual([response['command'] for response in responses], commands)
+
+    def test_execute_task_timeout(self):
+        client = self.start_client(InMemoryAsyncTransport())
+
+        with self.assertRaises(Exception):
+            self.run_loop(client.execute_task(['ls'], timeout=0.05))
+
+    def test_responses_iterates_posted_tasks(self):
+        transport = InMemoryAsyncTransport()
+        client = self.start_client(transport)
+        posted = [self.run_loop(client.post_task(['echo', str(i)])) for i in range(3)]
+        for msg in reversed(posted):
+            transport.reply(json.dumps(echo_executor(msg)))
+
+        responses = client.responses()
+        received = [self.run_loop(responses.__anext__()) for _ in posted]
+
+        self.assertEqual(set(r['correlation_id'] for r in received),
+                         set(m['correlation_id'] for m in posted))
+        self.assertEqual(client.pending_nr(), 0)
+        with self.assertRaises(StopAsyncIteration):
+            self.run_loop(responses.__anext__())
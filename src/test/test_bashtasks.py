@@ -9,8 +9,10 @@ import json
 
 import bashtasks as bashtasks_mod
 import bashtasks.rabbit_util as rabbit_util
+import bashtasks.bashtasks_client as bashtasks_client
 from bashtasks.constants import TASK_REQUESTS_POOL, TASK_RESPONSES_POOL
 from bashtasks.pika_assertions import assertMessageInQueue
+from test.fakes import FakeChannel, FakeChannelWithConnection, FakeConfirmChannel
 import bashtasks.executor as executor
 
 rabbit_host = os.getenv('RABBIT_HOST', '127.0.0.1')
@@ -24,21 +26,6 @@ unavailable_rabbit = not rabbit_util.is_rabbit_available(host=rabbit_host,
                                                          pas=rabbit_pass)
 
 
-class FakeConnection:
-    is_open = False
-
-    def close(*args, **kwargs):
-        pass
-
-
-class FakeChannel:
-    _impl = FakeConnection()
-    is_open = False
-
-    def close(*args, **kwargs):
-        pass
-
-
 class TestBashTasks(unittest.TestCase):
     def setUp(self):
         pass
@@ -51,6 +38,34 @@ class TestBashTasks(unittest.TestCase):
         isBashTask = hasattr(bashtask, 'post_task')
         self.assertTrue(isBashTask)
 
+    def test_post_tasks_returns_summary(self):
+        bulk_channel = FakeConfirmChannel(nack_tags=(3,))
+        bashtask = bashtasks_mod.init(channel=FakeChannelWithConnection(bulk_channel))
+
+        summary = bashtask.post_tasks((['echo', str(i)] for i in range(50)), confirm_window=8)
+
+        published = [json.loads(body) for _, _, body, _ in bulk_channel._impl.published]
+        self.assertEqual(summary['count'], 50)
+        self.assertEqual(len(published), 50)
+        self.assertEqual(published[3]['command'], ['echo', '3'])
+        self.assertEqual(summary['first_correlation_id'], published[0]['correlation_id'])
+        self.assertEqual(summary['last_correlation_id'], published[-1]['correlation_id'])
+        self.assertEqual(summary['failures'], [published[2]['correlation_id']])
+        self.assertTrue(bulk_channel.closed)
+
+    def test_post_tasks_to_transient_destination(self):
+        def published_delivery_modes(destination=bashtasks_client.DEFAULT_DESTINATION, **options):
+            bulk_channel = FakeConfirmChannel()
+            bashtask = bashtasks_mod.init(channel=FakeChannelWithConnection(bulk_channel),
+                                          transient=['probes'])
+            bashtask.post_tasks([['true']], destination=destination, **options)
+            return [(props.delivery_mode, json.loads(body).get('persistent'))
+                    for _, _, body, props in bulk_channel._impl.published]
+
+        self.assertEqual(published_delivery_modes('probes'), [(1, False)])
+        self.assertEqual(published_delivery_modes('probes', persistent=True), [(2, True)])
+        self.assertEqual(published_delivery_modes(), [(2, None)])
+
 
 @unittest.skipIf(unavailable_rabbit, "SKIP integration Tests: rabbitmq NOT available")
 class IntegTestPostTask(unittest.TestCase):
@@ -68,6 +83,16 @@ class IntegTestPostTask(unittest.TestCase):
         body = assertMessageInQueue(TASK_REQUESTS_POOL, host=rabbit_host,port=rabbit_port,
                                     usr=rabbit_user, pas=rabbit_pass)
 
+    def test_post_tasks_sends_messages(self):
+        bashtasks = bashtasks_mod.init(host=rabbit_host, port=rabbit_port, usr=rabbit_user, pas=rabbit_pass)
+        summary = bashtasks.post_tasks([['ls', '-la'], ['ls', '-l']])
+
+        self.assertEqual(summary['count'], 2)
+        self.assertEqual(summary['failures'], [])
+        for _ in range(2):
+            assertMessageInQueue(TASK_REQUESTS_POOL, host=rabbit_host, port=rabbit_port,
+                                 usr=rabbit_user, pas=rabbit_pass)
+
     def  test_post_task_creates_correct_task_msg(self):
         ls_task = ['ls', '-la']
         bashtasks = bashtasks_mod.init(host=rabbit_host, port=rabbit_port, usr=rabbit_user, pas=rabbit_pass)
@@ -79,10 +104,10 @@ class IntegTestPostTask(unittest.TestCase):
         self.assertTrue('request_ts' in msg)
 
 
-def start_executor_process(tasks_nr=1):
+def start_executor_process(tasks_nr=1, slots=1):
     p = multiprocessing.Process(target=executor.start_executor,
                                 kwargs=({'host': rabbit_host, 'port': rabbit_port, 'usr': rabbit_user,
-                                         'pas': rabbit_pass, 'tasks_nr': tasks_nr}))
+                                         'pas': rabbit_pass, 'tasks_nr': tasks_nr, 'slots': slots}))
     p.start()
     time.sleep(0.1)
     return p
@@ -119,13 +144,54 @@ class IntegTestExecuteTask(unittest.TestCase):
             self.assertTrue('returncode' in response_msg)
             self.assertTrue('request_ts' in response_msg)
             self.assertEqual(response_msg['command'], ls_task)
-            self.assertEqual(response_msg['reply_to'], TASK_RESPONSES_POOL)
+            self.assertEqual(response_msg['reply_to'], bashtasks_client.response_demux.queue)
             self.assertTrue('correlation_id' in response_msg)
         finally:
             kill_executor_process(p)
             time.sleep(0.2)
 
 
+    def test_execute_batch_returns_response_per_command(self):
+        try:
+            p = start_executor_process()
+            bashtasks = bashtasks_mod.init(host=rabbit_host, port=rabbit_port, usr=rabbit_user, pas=rabbit_pass)
+            commands = [['echo', str(i)] for i in range(10)] + [['false']]
+
+            responses = bashtasks.execute_batch(commands, parallelism=4)
+
+            self.assertEqual([r['command'] for r in responses], commands)
+            self.assertEqual([r['stdout'].strip() for r in responses[:10]],
+                             [str(i) for i in range(10)])
+            self.assertEqual(responses[10]['returncode'], 1)
+            self.assertTrue(all(r['pre_command_ts'] <= r['post_command_ts'] for r in responses))
+        finally:
+            kill_executor_process(p)
+            time.sleep(0.2)
+
+    def test_execute_task_concurrently_with_slots(self):
+        try:
+            slots = 4
+            p = start_executor_process(tasks_nr=slots, slots=slots)
+            bashtasks = bashtasks_mod.init(host=rabbit_host, port=rabbit_port, usr=rabbit_user, pas=rabbit_pass)
+            responses = []
+
+            def execute_sleep():
+                responses.append(bashtasks.execute_task(['sleep', '1']))
+
+            start = time.time()
+            callers = [threading.Thread(target=execute_sleep) for _ in range(slots)]
+            for caller in callers:
+                caller.start()
+            for caller in callers:
+                caller.join()
+
+            self.assertEqual(len(responses), slots)
+            self.assertLess(time.time() - start, 2.5)
+        finally:
+            kill_executor_process(p)
+            time.sleep(0.2)
+
+
 @unittest.skipIf(unavailable_rabbit, "SKIP integration Tests: rabbitmq NOT available")
 class IntegTestTaskResponseSubscriber(unittest.TestCase):
     def setUp(self):
@@ -0,0 +1,33 @@
+import unittest
+
+from bashtasks import bench
+
+
+class TestBench(unittest.TestCase):
+    def test_parse_mix(self):
+        self.assertEqual(bench.parse_mix('true=8,sleep=1,big-output'),
+                         [('true', 8), ('sleep', 1), ('big-output', 1)])
+        with self.assertRaises(ValueError):
+            bench.parse_mix('rm=1')
+
+    def test_get_commands(self):
+        commands = list(bench.get_commands(100, 'true=1,sleep=1', sleep_ms=5, seed=1))
+
+        self.assertEqual(len(commands), 100)
+        self.assertIn(['true'], commands)
+        self.assertIn(['sleep', '0.005'], commands)
+
+    def test_run_memory(self):
+        report = bench.run(broker=bench.MEMORY, executors=2, slots=2, tasks=20,
+                           mix='true=3,big-output=1', output_kb=1, timeout=30, seed=1)
+
+        self.assertEqual(report['responses'], 20)
+        self.assertEqual(report['errors'], 0)
+        self.assertGreater(report['throughput'], 0)
+        self.assertGreater(report['cpu_ms_per_task'], 0)
+        self.assertLessEqual(report['wait_ms'][50], report['total_ms'][99])
+        self.assertIn('throughput', bench.format_report(report))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import unittest
+import json
+
+from bashtasks import codec
+from bashtasks.codec import Codec, get_codec, get_reply_codec, decode
+from bashtasks.message import get_request, from_body
+
+msgpack_available = codec.msgpack is not None
+
+
+def get_response(stdout_size=100):
+    response = get_request(['ls', '-la'], max_retries=2)
+    response.update(returncode=0, stdout='x' * stdout_size, stderr='', executor_name='e:1:th')
+    return response
+
+
+class TestCodec(unittest.TestCase):
+    def test_json_default_is_plain_json(self):
+        response = get_response()
+
+        body, content_encoding = get_codec().encode(response)
+
+        self.assertIsNone(content_encoding)
+        self.assertEqual(json.loads(body.decode('utf-8')), response)
+
+    def test_decode_without_properties_is_json(self):
+        response = get_response()
+
+        self.assertEqual(decode(json.dumps(response).encode('utf-8')), response)
+
+    def test_zlib_compresses_above_threshold(self):
+        zlib_codec = Codec('json+zlib', compress_threshold=1000)
+        small, big = get_response(10), get_response(100000)
+
+        small_body, small_encoding = zlib_codec.encode(small)
+        big_body, big_encoding = zlib_codec.encode(big)
+
+        self.assertIsNone(small_encoding)
+        self.assertEqual(big_encoding, codec.ZLIB)
+        self.assertLess(len(big_body), 10000)
+        self.assertEqual(decode(big_body, zlib_codec.properties(big_encoding)), big)
+        self.assertEqual(decode(small_body, zlib_codec.properties(small_encoding)), small)
+
+    @unittest.skipIf(not msgpack_available, "SKIP msgpack Tests: msgpack not installed")
+    def test_msgpack_round_trip(self):
+        msgpack_codec = get_codec('msgpack+zlib')
+        response = get_response(5000)
+
+        body, content_encoding = msgpack_codec.encode(response)
+        msg = from_body(body, msgpack_codec.properties(content_encoding))
+
+        self.assertEqual(msg, response)
+
+    def test_unknown_codec(self):
+        with self.assertRaises(ValueError):
+            Codec('yaml')
+
+    def test_properties_are_reused(self):
+        zlib_codec = get_codec('json+zlib')
+
+        self.assertIs(zlib_codec.properties(codec.ZLIB), zlib_codec.properties(codec.ZLIB))
+        self.assertEqual(zlib_codec.properties().headers[codec.CODEC_HEADER], 'json+zlib')
+
+    def test_properties_priority(self):
+        json_codec = get_codec('json')
+
+        self.assertEqual(json_codec.properties(priority=5).priority, 5)
+        self.assertIsNone(json_codec.properties().priority)
+
+    def test_reply_codec_is_request_codec(self):
+        zlib_codec = get_codec('json+zlib')
+
+        self.assertIs(get_reply_codec(zlib_codec.properties()), zlib_codec)
+
+    def test_reply_codec_defaults_to_json(self):
+        class UnknownCodecProperties:
+            headers = {codec.CODEC_HEADER: 'yaml+bz2'}
+
+        self.assertEqual(get_reply_codec(None).name, 'json')
+        self.assertEqual(get_reply_codec(UnknownCodecProperties()).name, 'json')
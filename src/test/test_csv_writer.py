@@ -0,0 +1,97 @@
+import gzip
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from bashtasks.csv_writer import CsvWriter, get_segment_path
+
+FIELDS = ('correlation_id', 'returncode', 'command')
+
+
+def get_msg(i):
+    return {'correlation_id': i, 'returncode': 0, 'command': 'echo {}'.format(i),
+            'stdout': 'not a field'}
+
+
+def readlines(filepath):
+    opener = gzip.open if filepath.endswith('.gz') else open
+    with opener(filepath, 'rb') as f:
+        return f.read().decode('utf-8').splitlines()
+
+
+class TestCsvWriter(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'stats.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_close_writes_all_rows(self):
+        writer = CsvWriter(self.path, FIELDS, batch_size=7)
+        for i in range(100):
+            writer.write(get_msg(i))
+
+        writer.close()
+
+        lines = readlines(self.path)
+        self.assertEqual(lines[0], 'correlation_id;returncode;command')
+        self.assertEqual(len(lines), 101)
+        self.assertEqual(lines[42], '41;0;echo 41')
+        self.assertEqual(writer.rows_written, 100)
+
+    def test_close_without_rows_writes_headers(self):
+        CsvWriter(self.path, FIELDS).close()
+
+        self.assertEqual(readlines(self.path), ['correlation_id;returncode;command'])
+
+    def test_flush(self):
+        writer = CsvWriter(self.path, FIELDS, flush_interval=60)
+        writer.write(get_msg(1))
+
+        self.assertTrue(writer.flush(timeout=5))
+
+        self.assertEqual(len(readlines(self.path)), 2)
+        writer.close()
+
+    def test_flush_interval(self):
+        writer = CsvWriter(self.path, FIELDS, flush_interval=0.1)
+        writer.write(get_msg(1))
+
+        time.sleep(0.5)
+
+        self.assertEqual(len(readlines(self.path)), 2)
+        writer.close()
+
+    def test_write_after_close(self):
+        writer = CsvWriter(self.path, FIELDS)
+        writer.close()
+
+        self.assertRaises(ValueError, writer.write, get_msg(1))
+
+    def test_rotate_gzip(self):
+        writer = CsvWriter(self.path, FIELDS, batch_size=10, rotate_bytes=100, gzip_output=True)
+        for i in range(50):
+            writer.write(get_msg(i))
+            writer.flush()
+
+        writer.close()
+
+        self.assertTrue(writer.segment > 0)
+        rows = []
+        for segment in range(writer.segment + 1):
+            lines = readlines(get_segment_path(self.path, segment, gzip_output=True))
+            self.assertEqual(lines[0], 'correlation_id;returncode;command')
+            rows.extend(lines[1:])
+        self.assertEqual(rows, ['{0};0;echo {0}'.format(i) for i in range(50)])
+
+    def test_segment_path(self):
+        self.assertEqual(get_segment_path('/tmp/stats.csv', 0), '/tmp/stats.csv')
+        self.assertEqual(get_segment_path('/tmp/stats.csv', 2), '/tmp/stats.2.csv')
+        self.assertEqual(get_segment_path('/tmp/stats.csv', 1, True), '/tmp/stats.1.csv.gz')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import os
+import re
+import shutil
+import signal
+import sys
+import tempfile
+import time
+import unittest
+
+from bashtasks.fork_server import ForkServer, get_interpreter_pattern
+from bashtasks.output_capture import HeadTailSink, capture_output, TIMEOUT_RETURNCODE
+
+SCRIPT = '''
+import sys
+import json
+sys.stdout.write('argv: ' + ' '.join(sys.argv[1:]) + '\\n')
+sys.stderr.write('json loaded: {}\\n'.format('json' in sys.modules))
+if sys.argv[1] in ('sleep', 'close-output'):
+    import os
+    import time
+    if sys.argv[1] == 'close-output':
+        os.close(1)
+        os.close(2)
+    time.sleep(30)
+sys.exit(int(sys.argv[1]))
+'''
+
+
+def run(fork_server, command):
+    """ :return: (returncode, stdout, stderr) of command run by fork_server.
+    """
+    response = {}
+    stdout_sink, stderr_sink = HeadTailSink(10000), HeadTailSink(10000)
+    returncode = capture_output(fork_server.spawn(command), stdout_sink, stderr_sink)
+    stdout_sink.fill(response, 'stdout')
+    stderr_sink.fill(response, 'stderr')
+    return returncode, response['stdout'], response['stderr']
+
+
+class TestForkServer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.fork_server = ForkServer(preload=['json'])
+        cls.dir = tempfile.mkdtemp()
+        cls.script = os.path.join(cls.dir, 'script.py')
+        with open(cls.script, 'w') as f:
+            f.write(SCRIPT)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.fork_server.stop()
+        shutil.rmtree(cls.dir)
+
+    def test_handles(self):
+        python = 'python{}.{}'.format(*sys.version_info[:2])
+        self.assertTrue(self.fork_server.handles([sys.executable, 'script.py', 'a']))
+        self.assertTrue(self.fork_server.handles([python, 'script.py', 'a']))
+        self.assertTrue(self.fork_server.handles(['/usr/bin/' + python, '-m', 'json.tool']))
+        self.assertFalse(self.fork_server.handles([python, '-c', 'print(1)']))
+        self.assertFalse(self.fork_server.handles([python]))
+        self.assertFalse(self.fork_server.handles(['ls', '-la']))
+        self.assertFalse(self.fork_server.handles(['my' + python, 'script.py']))
+
+    def test_other_interpreters_not_handled(self):
+        other = 'python3' if sys.version_info[0] == 2 else 'python2'
+        self.assertFalse(self.fork_server.handles([other, 'script.py']))
+        self.assertFalse(self.fork_server.handles([other, '-m', 'json.tool']))
+        self.assertFalse(self.fork_server.handles(['/usr/bin/python3.11', 'script.py']))
+
+        pattern = re.compile(get_interpreter_pattern('/usr/bin/python2.7', (2, 7)))
+        self.assertTrue(pattern.match('/usr/bin/python2.7 script.py'))
+        self.assertTrue(pattern.match('python2.7 -m json.tool'))
+        self.assertFalse(pattern.match('python3 -c print(1)'))
+        self.assertFalse(pattern.match('python3 script.py'))
+        self.assertFalse(pattern.match('/usr/bin/python3.11 -m json.tool'))
+        self.assertFalse(pattern.match('python script.py'))  # maybe python 3, on PATH
+
+    def test_runs_script(self):
+        returncode, out, err = run(self.fork_server, ['python', self.script, '3', 'x'])
+
+        self.assertEqual(returncode, 3)
+        self.assertEqual(out, 'argv: 3 x\n')
+        self.assertEqual(err, 'json loaded: True\n')
+
+    def test_runs_module(self):
+        returncode, out, err = run(self.fork_server, ['python', '-m', 'platform'])
+
+        self.assertEqual(returncode, 0)
+        self.assertTrue(out)
+
+    def test_exception_returns_error(self):
+        returncode, out, err = run(self.fork_server, ['python', os.path.join(self.dir, 'no.py')])
+
+        self.assertEqual(returncode, 1)
+        self.assertTrue('Traceback' in err)
+
+    def test_own_process_group(self):
+        process = self.fork_server.spawn(['python', self.script, '0'])
+        capture_output(process, HeadTailSink(100), HeadTailSink(100))
+
+        self.assertEqual(process.returncode, 0)
+        self.assertNotEqual(process.pid, os.getpid())
+
+    def test_timeout_kills_command(self):
+        process = self.fork_server.spawn(['python', self.script, 'sleep'])
+
+        returncode = capture_output(process, HeadTailSink(100), HeadTailSink(100), timeout=0.3)
+
+        self.assertEqual(returncode, TIMEOUT_RETURNCODE)
+
+    def test_timeout_kills_command_with_output_closed(self):
+        process = self.fork_server.spawn(['python', self.script, 'close-output'])
+
+        start = time.time()
+        returncode = capture_output(process, HeadTailSink(100), HeadTailSink(100), timeout=0.3)
+
+        self.assertEqual(returncode, TIMEOUT_RETURNCODE)
+        self.assertLess(time.time() - start, 3)
+
+    def test_poll(self):
+        process = self.fork_server.spawn(['python', self.script, 'sleep'])
+        self.assertIsNone(process.poll())
+
+        os.killpg(process.pid, signal.SIGKILL)
+        deadline = time.time() + 5
+        while process.poll() is None and time.time() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(process.poll(), -signal.SIGKILL)
+        process.stdout.close()
+        process.stderr.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
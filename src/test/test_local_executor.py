@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import bashtasks
+from bashtasks import memory_broker, message
+from bashtasks.bashtasks_client import publish
+from bashtasks.constants import TASK_REQUESTS_POOL, TASK_RESPONSES_POOL
+from bashtasks.TaskStatistics import TaskStatistics
+
+
+class TestLocalExecutor(unittest.TestCase):
+    def setUp(self):
+        for queue in (TASK_REQUESTS_POOL, TASK_RESPONSES_POOL):
+            if queue in memory_broker.broker.queues:
+                memory_broker.broker.queue_purge(queue)
+        self.client = bashtasks.init(local_workers=2, local_options={'slots': 2})
+
+    def tearDown(self):
+        bashtasks.reset()
+
+    def test_execute_task(self):
+        response = self.client.execute_task(['echo', 'local'], timeout=10)
+
+        self.assertEqual(response['returncode'], 0)
+        self.assertEqual(response['stdout'], 'local\n')
+        self.assertEqual(response['retries'], 0)
+        self.assertIn('local_worker_th_', response['executor_name'])
+        self.assertLessEqual(response['request_ts'], response['pre_command_ts'])
+        self.assertLessEqual(response['pre_command_ts'], response['post_command_ts'])
+
+    def test_retries(self):
+        response = self.client.execute_task(['false'], max_retries=2, retry_delay=10,
+                                            retry_policy='fixed', timeout=10)
+
+        self.assertEqual(response['returncode'], 1)
+        self.assertEqual(response['retries'], 2)
+
+    def test_responses_feed_task_statistics(self):
+        for i in range(6):
+            self.client.post_task(['true'])
+        stats = TaskStatistics()
+        subscriber = bashtasks.init_subscriber(transport='memory', prefetch=10)
+
+        def track(msg):
+            stats.trackMsg(msg.decode())
+            msg.ack()
+            if stats.msgsNumber() == 6:
+                subscriber.stop()
+
+        subscriber.subscribe(track)
+
+        self.assertEqual(stats.okNumber(), 6)
+        self.assertEqual(sum(stats.getWorkersCounter().values()), 6)
+
+    def test_reset_stops_workers(self):
+        local_executors = bashtasks.bashtasks_client.local_executors
+        self.assertTrue(local_executors.is_running())
+
+        bashtasks.reset()
+
+        self.assertFalse(local_executors.is_running())
+
+
+    def test_output_files_of_same_correlation_id(self):
+        output_dir = tempfile.mkdtemp()
+        try:
+            bashtasks.reset()
+            bashtasks.init(local_workers=1, local_options={'output_dir': output_dir})
+            tasks = [message.get_request(['echo', text], output_policy='file')
+                     for text in ('first', 'second')]
+            tasks[1]['correlation_id'] = tasks[0]['correlation_id']  # posted by another client
+            for task in tasks:
+                publish(task)
+            responses = []
+            subscriber = bashtasks.init_subscriber(transport='memory', prefetch=10)
+
+            def collect(msg):
+                responses.append(msg.decode())
+                msg.ack()
+                if len(responses) == 2:
+                    subscriber.stop()
+
+            subscriber.subscribe(collect)
+
+            outputs = []
+            for response in responses:
+                with open(response['stdout_file']) as f:
+                    outputs.append(f.read())
+            self.assertEqual(sorted(outputs), ['first\n', 'second\n'])
+            self.assertEqual(len(os.listdir(output_dir)), 4)
+        finally:
+            shutil.rmtree(output_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import json
+import logging
+import sys
+import unittest
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from bashtasks import logger as logger_mod
+from bashtasks.logger import get_logger, log_fields
+
+
+class CountingStr:
+    formatted = 0
+
+    def __str__(self):
+        CountingStr.formatted += 1
+        return 'counted'
+
+
+class TestLogger(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.NOTSET)
+        self.stderr = sys.stderr
+        sys.stderr = self.output = StringIO()  # before configure: handlers write to sys.stderr
+        self.logger = get_logger(name='test_logger')
+
+    def tearDown(self):
+        logger_mod.configure(level=logging.DEBUG, queued=False, json_records=False)
+        sys.stderr = self.stderr
+        logger_mod.configure()
+        logging.disable(logging.CRITICAL)
+
+    def test_level(self):
+        logger_mod.configure(level='INFO')
+        CountingStr.formatted = 0
+
+        self.logger.debug('%s', CountingStr())
+        log_fields(self.logger, logging.DEBUG, 'msg', {'field': CountingStr()})
+        self.logger.info('%s', CountingStr())
+
+        self.assertEqual(CountingStr.formatted, 1)
+        self.assertEqual(self.logger.level, logging.INFO)
+
+    def test_log_fields_single_record(self):
+        logger_mod.configure()
+
+        log_fields(self.logger, logging.INFO, 'MSG: 1', {'returncode': 0})
+
+        lines = self.output.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].endswith(';test_logger;MainThread;INFO;MSG: 1'))
+        self.assertEqual(lines[1], '\treturncode:-> 0')
+
+    def test_json_records(self):
+        logger_mod.configure(json_records=True)
+
+        log_fields(self.logger, logging.INFO, 'MSG: 1', {'returncode': 2, 'command': ['ls']})
+        self.logger.debug('done %d', 1, extra={'fields': {'correlation_id': 1}})
+
+        records = [json.loads(line) for line in self.output.getvalue().splitlines()]
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0]['msg'], 'MSG: 1')
+        self.assertEqual(records[0]['command'], ['ls'])
+        self.assertEqual(records[0]['level'], 'INFO')
+        self.assertEqual(records[1]['msg'], 'done 1')
+        self.assertEqual(records[1]['correlation_id'], 1)
+
+    def test_queued(self):
+        logger_mod.configure(queued=True, json_records=True)
+
+        for i in range(100):
+            self.logger.info('record %d', i, extra={'fields': {'i': i}})
+        logger_mod.stop_listener()
+
+        records = [json.loads(line) for line in self.output.getvalue().splitlines()]
+        self.assertEqual([record['i'] for record in records], list(range(100)))
+        self.assertEqual(records[-1]['msg'], 'record 99')
+
+
+if __name__ == '__main__':
+    unittest.main()
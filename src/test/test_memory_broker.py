@@ -0,0 +1,139 @@
+import time
+import unittest
+
+import pika
+
+from bashtasks import memory_broker
+from bashtasks.memory_broker import MemoryBroker, topic_matches
+from bashtasks.rabbit_util import declare_and_bind, declare_routed_queue, PipelinedPublisher
+from bashtasks.retry import declare_delay_queue
+
+
+class TestMemoryBroker(unittest.TestCase):
+    def setUp(self):
+        self.broker = MemoryBroker()
+        self.conn = memory_broker.connect(self.broker)
+        self.ch = self.conn.channel()
+        self.received = []
+
+    def consume(self, queue, ch=None, no_ack=False):
+        ch = ch or self.ch
+
+        def on_msg(ch, method, properties, body):
+            self.received.append((method, properties, body))
+        return ch.basic_consume(on_msg, queue=queue, no_ack=no_ack)
+
+    def bodies(self):
+        return [body for method, properties, body in self.received]
+
+    def test_topic_matches(self):
+        self.assertTrue(topic_matches('#', ''))
+        self.assertTrue(topic_matches('gpu.#', 'gpu.none.mem.high'))
+        self.assertTrue(topic_matches('gpu.*.mem.#', 'gpu.a.mem'))
+        self.assertFalse(topic_matches('gpu.*', 'gpu.a.b'))
+        self.assertFalse(topic_matches('cpu.#', 'gpu'))
+
+    def test_publish_consume_ack(self):
+        declare_and_bind(self.ch, 'tasks', routing_key='#')
+        self.ch.basic_publish(exchange='tasks', routing_key='', body='hi')
+        self.ch.basic_publish(exchange='', routing_key='tasks', body=b'there')
+        self.consume('tasks')
+
+        self.conn.process_data_events(time_limit=0)
+
+        self.assertEqual(self.bodies(), [b'hi', b'there'])
+        self.ch.basic_ack(self.received[1][0].delivery_tag)
+        self.ch.basic_ack(self.received[0][0].delivery_tag)
+        self.assertEqual(self.ch.queue_declare(queue='tasks', passive=True).method.message_count,
+                         0)
+
+    def test_priority_and_prefetch(self):
+        declare_and_bind(self.ch, 'tasks')
+        for priority in (1, 5, 3):
+            self.ch.basic_publish(exchange='', routing_key='tasks', body=str(priority),
+                                  properties=pika.BasicProperties(priority=priority))
+        self.ch.basic_qos(prefetch_count=1)
+        self.consume('tasks')
+
+        self.conn.process_data_events(time_limit=0)
+        self.conn.process_data_events(time_limit=0)
+        self.assertEqual(self.bodies(), [b'5'])  # prefetch: waits for ack
+
+        self.ch.basic_ack(self.received[0][0].delivery_tag)
+        self.conn.process_data_events(time_limit=0)
+        self.assertEqual(self.bodies(), [b'5', b'3'])
+
+    def test_nack_requeues(self):
+        declare_and_bind(self.ch, 'tasks')
+        self.ch.basic_publish(exchange='', routing_key='tasks', body='a')
+        self.consume('tasks')
+        self.conn.process_data_events(time_limit=0)
+
+        self.ch.basic_nack(self.received[0][0].delivery_tag, requeue=True)
+        self.conn.process_data_events(time_limit=0)
+
+        self.assertEqual(self.bodies(), [b'a', b'a'])
+        self.assertTrue(self.received[1][0].redelivered)
+
+    def test_close_requeues_unacked(self):
+        declare_and_bind(self.ch, 'tasks')
+        self.ch.basic_publish(exchange='', routing_key='tasks', body='a')
+        self.consume('tasks')
+        self.conn.process_data_events(time_limit=0)
+
+        self.ch.close()
+
+        ch = self.conn.channel()
+        self.assertEqual(ch.queue_declare(queue='tasks', passive=True).method.message_count, 1)
+
+    def test_passive_declare_of_missing_queue_closes_channel(self):
+        with self.assertRaises(pika.exceptions.ChannelClosed):
+            self.ch.queue_declare(queue='missing', passive=True)
+        self.assertFalse(self.ch.is_open)
+
+    def test_alternate_exchange(self):
+        declare_and_bind(self.ch, 'tasks', routing_key='#')
+        routed = declare_routed_queue(self.ch, 'tasks', 'gpu.#')
+
+        self.ch.basic_publish(exchange='tasks:routed', routing_key='gpu.a', body='gpu')
+        self.ch.basic_publish(exchange='tasks:routed', routing_key='cpu.a', body='cpu')
+
+        self.consume(routed)
+        self.conn.process_data_events(time_limit=0)
+        self.assertEqual(self.bodies(), [b'gpu'])
+        self.consume('tasks')
+        self.conn.process_data_events(time_limit=0)
+        self.assertEqual(self.bodies(), [b'gpu', b'cpu'])
+
+    def test_ttl_dead_letters(self):
+        declare_and_bind(self.ch, 'tasks', routing_key='#')
+        delay_queue = declare_delay_queue(self.ch, 'tasks', 10)
+        self.ch.basic_publish(exchange='', routing_key=delay_queue, body='retry')
+        self.consume('tasks')
+
+        self.conn.process_data_events(time_limit=0)
+        self.assertEqual(self.bodies(), [])
+        time.sleep(0.02)
+        self.conn.process_data_events(time_limit=1)
+        self.assertEqual(self.bodies(), [b'retry'])
+
+    def test_exclusive_queue_deleted_with_connection(self):
+        queue = self.ch.queue_declare(queue='', exclusive=True).method.queue
+
+        self.conn.close()
+
+        self.assertNotIn(queue, self.broker.queues)
+
+    def test_pipelined_publisher_confirms(self):
+        declare_and_bind(self.ch, 'tasks')
+        publisher = PipelinedPublisher(self.conn.channel(), window=2)
+        for i in range(5):
+            publisher.publish('', 'tasks', str(i), key=i)
+        publisher.wait_for_confirms(timeout=1)
+
+        self.assertEqual(publisher.unconfirmed_nr(), 0)
+        self.assertEqual(publisher.failures, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
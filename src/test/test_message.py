@@ -1,5 +1,6 @@
 import unittest
-from bashtasks.message import get_request, from_str
+from bashtasks.message import get_request, get_batch_request, from_str
+from bashtasks.message import is_batch, unpack_responses, get_delivery_mode
 from bashtasks.constants import Destination
 
 command = ['ps', '-axf']
@@ -36,3 +37,68 @@ class TestBashTasksMessage(unittest.TestCase):
         msg_copy = from_str(msg_str)
 
         self.assertEqual(msg, msg_copy)
+
+    def test_correlation_ids_are_unique(self):
+        msgs = [get_request(command) for _ in range(1000)]
+
+        correlation_ids = set(msg['correlation_id'] for msg in msgs)
+
+        self.assertEqual(len(correlation_ids), len(msgs))
+
+    def test_task_options(self):
+        msg = get_request(command, output_policy='chunks', output_cap=None)
+
+        self.assertEqual(msg['output_policy'], 'chunks')
+        self.assertFalse('output_cap' in msg)
+
+    def test_unknown_task_option(self):
+        with self.assertRaises(TypeError):
+            get_request(command, no_such_option=1)
+
+    def test_priority(self):
+        self.assertEqual(get_request(command, priority=7)['priority'], 7)
+        with self.assertRaises(ValueError):
+            get_request(command, priority=11)
+
+    def test_persistent(self):
+        self.assertEqual(get_delivery_mode(get_request(command)), 2)
+        self.assertEqual(get_delivery_mode(get_request(command, persistent=True)), 2)
+        self.assertEqual(get_delivery_mode(get_request(command, persistent=False)), 1)
+
+    def test_cost(self):
+        msg = get_request(command, cost={'cpu': 2, 'mem_mb': 512}, routing_key='gpu.none')
+
+        self.assertEqual(msg['cost'], {'cpu': 2, 'mem_mb': 512})
+        self.assertEqual(msg['routing_key'], 'gpu.none')
+        with self.assertRaises(ValueError):
+            get_request(command, cost={'gpus': 1})
+
+    def test_batch_request(self):
+        msg = get_batch_request([command, ['ls']], parallelism=2, priority=3)
+
+        self.assertTrue(is_batch(msg))
+        self.assertFalse(is_batch(get_request(command)))
+        self.assertEqual(msg['batch'], [{'command': command}, {'command': ['ls']}])
+        self.assertEqual(msg['batch_parallelism'], 2)
+        self.assertEqual(msg['priority'], 3)
+        with self.assertRaises(ValueError):
+            get_batch_request([])
+
+    def test_unpack_responses(self):
+        response = get_batch_request([command, ['ls']])
+        response.update(returncode=2, executor_name='executor_1')
+        response['batch'][0].update(returncode=0, stdout='ok', pre_command_ts=1,
+                                    post_command_ts=2)
+        response['batch'][1].update(returncode=2, stdout='ko', pre_command_ts=2,
+                                    post_command_ts=5)
+
+        responses = unpack_responses(response)
+
+        self.assertEqual([r['command'] for r in responses], [command, ['ls']])
+        self.assertEqual([r['returncode'] for r in responses], [0, 2])
+        self.assertEqual([r['post_command_ts'] for r in responses], [2, 5])
+        self.assertEqual([r['batch_index'] for r in responses], [0, 1])
+        self.assertEqual(responses[1]['correlation_id'], response['correlation_id'])
+        self.assertEqual(responses[1]['executor_name'], 'executor_1')
+        self.assertFalse('batch' in responses[0])
+        self.assertEqual(unpack_responses(get_request(command))[0]['command'], command)
@@ -0,0 +1,89 @@
+import unittest
+
+try:
+    from urllib.request import urlopen
+    from urllib.error import HTTPError
+except ImportError:  # python 2
+    from urllib2 import urlopen, HTTPError
+
+from bashtasks.metrics import Registry, serve
+
+
+class TestMetrics(unittest.TestCase):
+    def test_counter(self):
+        registry = Registry()
+        failed = registry.counter('tasks_failed_total', 'Failed tasks.', ('returncode', ))
+
+        failed.inc(labels=(1, ))
+        failed.inc(2, labels=(1, ))
+        failed.inc(labels=(-9, ))
+
+        self.assertIs(registry.counter('tasks_failed_total', 'Failed tasks.'), failed)
+        self.assertEqual(failed.get(labels=(1, )), 3)
+        self.assertEqual(registry.render(), '# HELP tasks_failed_total Failed tasks.\n'
+                                            '# TYPE tasks_failed_total counter\n'
+                                            'tasks_failed_total{returncode="1"} 3\n'
+                                            'tasks_failed_total{returncode="-9"} 1\n')
+
+    def test_gauge(self):
+        registry = Registry()
+        in_flight = registry.gauge('in_flight', 'Tasks running.')
+
+        in_flight.inc()
+        in_flight.inc()
+        in_flight.dec()
+
+        self.assertEqual(in_flight.get(), 1)
+        self.assertTrue(registry.render().endswith('in_flight 1\n'))
+
+    def test_unlabelled_exposed_as_zero(self):
+        registry = Registry()
+        registry.counter('tasks_total', 'Tasks.')
+        registry.histogram('wait_seconds', 'Secs waiting.', buckets=(1, ))
+
+        self.assertEqual(registry.render().split('\n'), [
+            '# HELP tasks_total Tasks.', '# TYPE tasks_total counter', 'tasks_total 0',
+            '# HELP wait_seconds Secs waiting.', '# TYPE wait_seconds histogram',
+            'wait_seconds_bucket{le="1.0"} 0', 'wait_seconds_bucket{le="+Inf"} 0',
+            'wait_seconds_sum 0', 'wait_seconds_count 0', ''])
+
+    def test_histogram(self):
+        registry = Registry()
+        wait = registry.histogram('wait_seconds', 'Secs waiting.', buckets=(0.1, 1))
+
+        for value in (0.05, 0.5, 0.5, 7):
+            wait.observe(value)
+
+        self.assertEqual(wait.get(), (4, 8.05))
+        self.assertEqual(registry.render().split('\n')[2:], [
+            'wait_seconds_bucket{le="0.1"} 1',
+            'wait_seconds_bucket{le="1.0"} 3',
+            'wait_seconds_bucket{le="+Inf"} 4',
+            'wait_seconds_sum 8.05',
+            'wait_seconds_count 4',
+            ''])
+
+    def test_label_values_escaped(self):
+        registry = Registry()
+        registry.counter('c', 'C.', ('path', )).inc(labels=('a"b\\c\n', ))
+
+        self.assertIn(r'c{path="a\"b\\c\n"} 1', registry.render())
+
+    def test_serve(self):
+        registry = Registry()
+        registry.counter('tasks_total', 'Tasks.').inc()
+        server = serve(0, host='127.0.0.1', registry=registry)
+        url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+        try:
+            response = urlopen(url + '/metrics')
+            self.assertTrue(response.headers['Content-Type'].startswith('text/plain'))
+            self.assertIn('tasks_total 1\n', response.read().decode('utf-8'))
+            with self.assertRaises(HTTPError):
+                urlopen(url + '/other')
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
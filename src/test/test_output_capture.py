@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+import unittest
+import os
+import sys
+import tempfile
+import shutil
+import time
+
+from bashtasks.output_capture import HeadTailSink, FileSink, ChunkSink, ChunksCollector
+from bashtasks.output_capture import run_command, get_chunk_msg, TIMEOUT_RETURNCODE
+
+big_output_command = [sys.executable, '-c', 'import sys; sys.stdout.write("x" * 5000000)']
+
+
+def is_running(pid):
+    """ :return: False if pid exited, even if not reaped yet (zombie).
+    """
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            return f.read().split(')')[-1].split()[0] != 'Z'
+    except IOError:
+        return False
+
+
+class TestHeadTailSink(unittest.TestCase):
+    def test_small_output_is_kept(self):
+        sink = HeadTailSink(100)
+        sink.write(b'hello ')
+        sink.write(b'world')
+        response_msg = {}
+
+        sink.fill(response_msg, 'stdout')
+
+        self.assertEqual(response_msg['stdout'], 'hello world')
+        self.assertFalse('stdout_truncated' in response_msg)
+
+    def test_big_output_keeps_head_and_tail(self):
+        sink = HeadTailSink(10)
+        for i in range(100):
+            sink.write(str(i % 10).encode('utf-8') * 10)
+        response_msg = {}
+
+        sink.fill(response_msg, 'stdout')
+
+        self.assertTrue(response_msg['stdout'].startswith('00000'))
+        self.assertTrue(response_msg['stdout'].endswith('99999'))
+        self.assertEqual(response_msg['stdout_truncated'], 990)
+        self.assertLessEqual(len(sink.head) + len(sink.tail), 10)
+
+
+class TestChunkSink(unittest.TestCase):
+    def test_chunks_are_sequenced(self):
+        chunks = []
+        sink = ChunkSink(lambda seq, data: chunks.append((seq, data)), chunk_size=4)
+
+        sink.write(b'0123456')
+        sink.write(b'789')
+        sink.close()
+        response_msg = {}
+        sink.fill(response_msg, 'stdout')
+
+        self.assertEqual(chunks, [(0, '0123'), (1, '4567'), (2, '89')])
+        self.assertEqual(response_msg['stdout_chunks'], 3)
+        self.assertEqual(response_msg['stdout_bytes'], 10)
+
+    def test_multibyte_chars_split_across_chunks(self):
+        chunks = []
+        sink = ChunkSink(lambda seq, data: chunks.append(data), chunk_size=3)
+
+        sink.write(u'ñañaña'.encode('utf-8'))
+        sink.close()
+
+        self.assertEqual(u''.join(chunks), u'ñañaña')
+
+
+class TestChunksCollector(unittest.TestCase):
+    def test_complete_rebuilds_output_of_last_execution(self):
+        msg = {'correlation_id': 7, 'retries': 1}
+        collector = ChunksCollector()
+        collector.add(get_chunk_msg({'correlation_id': 7, 'retries': 0}, 'stdout', 0, 'old', 'e'))
+        collector.add(get_chunk_msg(msg, 'stdout', 1, 'world', 'e'))
+        collector.add(get_chunk_msg(msg, 'stdout', 0, 'hello ', 'e'))
+
+        response_msg = collector.complete({'correlation_id': 7, 'retries': 1,
+                                           'stdout': '', 'stdout_chunks': 2})
+
+        self.assertEqual(response_msg['stdout'], 'hello world')
+
+
+class TestRunCommand(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_run_command_captures_both_streams(self):
+        stdout_sink, stderr_sink = HeadTailSink(100), HeadTailSink(100)
+        command = [sys.executable, '-c', 'import sys; sys.stdout.write("out"); '
+                                         'sys.stderr.write("err"); sys.exit(3)']
+
+        returncode = run_command(command, stdout_sink, stderr_sink)
+        response_msg = {}
+        stdout_sink.fill(response_msg, 'stdout')
+        stderr_sink.fill(response_msg, 'stderr')
+
+        self.assertEqual(returncode, 3)
+        self.assertEqual(response_msg['stdout'], 'out')
+        self.assertEqual(response_msg['stderr'], 'err')
+
+    def test_run_command_big_output_is_capped(self):
+        stdout_sink = HeadTailSink(1000)
+
+        returncode = run_command(big_output_command, stdout_sink, HeadTailSink(1000))
+
+        self.assertEqual(returncode, 0)
+        self.assertEqual(stdout_sink.total, 5000000)
+        self.assertLessEqual(len(stdout_sink.head) + len(stdout_sink.tail), 1000)
+
+    def test_run_command_to_file(self):
+        path = os.path.join(self.tmp_dir, 'task.stdout')
+        stdout_sink = FileSink(path)
+
+        run_command(big_output_command, stdout_sink, HeadTailSink(1000))
+        response_msg = {}
+        stdout_sink.fill(response_msg, 'stdout')
+
+        self.assertEqual(os.path.getsize(path), 5000000)
+        self.assertEqual(response_msg['stdout_file'], path)
+        self.assertEqual(response_msg['stdout_bytes'], 5000000)
+
+    def test_run_command_timeout_kills_process_group(self):
+        pid_path = os.path.join(self.tmp_dir, 'child.pid')
+        command = ['sh', '-c', 'echo partial; sleep 30 & echo $! > {}; wait'.format(pid_path)]
+        stdout_sink = HeadTailSink(100)
+
+        start = time.time()
+        returncode = run_command(command, stdout_sink, HeadTailSink(100), timeout=0.5)
+        response_msg = {}
+        stdout_sink.fill(response_msg, 'stdout')
+
+        self.assertEqual(returncode, TIMEOUT_RETURNCODE)
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(response_msg['stdout'], 'partial\n')
+        with open(pid_path) as f:
+            child_pid = int(f.read())
+        time.sleep(0.1)
+        self.assertFalse(is_running(child_pid))
+
+    def test_run_command_timeout_with_output_closed(self):
+        command = ['sh', '-c', 'exec >/dev/null 2>&1; sleep 6']
+
+        start = time.time()
+        returncode = run_command(command, HeadTailSink(100), HeadTailSink(100), timeout=0.5)
+
+        self.assertEqual(returncode, TIMEOUT_RETURNCODE)
+        self.assertLess(time.time() - start, 3)
+
+    def test_run_command_within_timeout(self):
+        returncode = run_command(['true'], HeadTailSink(100), HeadTailSink(100), timeout=10)
+
+        self.assertEqual(returncode, 0)
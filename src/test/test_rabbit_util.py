@@ -0,0 +1,304 @@
+import threading
+import time
+import unittest
+
+import pika
+
+from bashtasks.rabbit_util import PipelinedPublisher, ConnectionPool, ConfirmTimeout
+from bashtasks.rabbit_util import declaration_cache, declare_and_bind, connect_and_declare
+from bashtasks.rabbit_util import non_priority_queues
+from bashtasks.constants import MAX_PRIORITY
+from bashtasks.memory_broker import MemoryBroker
+from bashtasks.transport import InMemoryTransport
+from test.fakes import FakeConfirmChannel, FakeMethodFrame
+
+
+class TestPipelinedPublisher(unittest.TestCase):
+    def test_publish_waits_for_confirms_once_per_window(self):
+        ch = FakeConfirmChannel()
+        publisher = PipelinedPublisher(ch, window=10)
+
+        for i in range(100):
+            publisher.publish('exch', '', 'body', key=i)
+        publisher.wait_for_confirms()
+
+        self.assertEqual(len(ch._impl.published), 100)
+        self.assertEqual(publisher.unconfirmed_nr(), 0)
+        self.assertEqual(publisher.failures, [])
+        self.assertLessEqual(ch.connection.process_calls, 100 // 5 + 1)
+
+    def test_nacked_messages_are_failures(self):
+        ch = FakeConfirmChannel(nack_tags=(2, 5))
+        publisher = PipelinedPublisher(ch, window=3)
+
+        for key in ('a', 'b', 'c', 'd', 'e', 'f'):
+            publisher.publish('exch', '', 'body', key=key)
+        publisher.wait_for_confirms()
+
+        self.assertEqual(sorted(publisher.failures), ['b', 'e'])
+
+    def test_multiple_ack(self):
+        ch = FakeConfirmChannel(ack_all=False)
+        publisher = PipelinedPublisher(ch, window=100)
+        for key in range(5):
+            publisher.publish('exch', '', 'body', key=key)
+
+        ch._impl.on_confirm(FakeMethodFrame(pika.spec.Basic.Ack(delivery_tag=3, multiple=True)))
+
+        self.assertEqual(publisher.unconfirmed_nr(), 2)
+
+    def test_unconfirmed_on_timeout_are_failures(self):
+        ch = FakeConfirmChannel(ack_all=False)
+        publisher = PipelinedPublisher(ch, window=100)
+        for key in range(3):
+            publisher.publish('exch', '', 'body', key=key)
+
+        publisher.wait_for_confirms(timeout=0)
+
+        self.assertEqual(publisher.failures, [0, 1, 2])
+        self.assertEqual(publisher.unconfirmed_nr(), 0)
+
+    def test_full_window_times_out(self):
+        ch = FakeConfirmChannel(ack_all=False)
+        publisher = PipelinedPublisher(ch, window=2, timeout=0)
+        publisher.publish('exch', '', 'body', key=0)
+
+        self.assertRaises(ConfirmTimeout, publisher.publish, 'exch', '', 'body', key=1)
+        self.assertEqual(publisher.failures, [0, 1])
+        self.assertEqual(publisher.unconfirmed_nr(), 0)
+
+
+class FakePooledConnection:
+    def __init__(self):
+        self.is_open = True
+        self.heartbeats = 0
+
+    def process_data_events(self, time_limit=0):
+        if not self.is_open:
+            raise pika.exceptions.ConnectionClosed()
+        self.heartbeats += 1
+
+    def close(self):
+        self.is_open = False
+
+
+class FakePooledChannel:
+    def __init__(self):
+        self.connection = FakePooledConnection()
+        self._impl = self.connection
+        self.published = []
+
+    @property
+    def is_open(self):
+        return self.connection.is_open
+
+    def close(self):
+        self.connection.close()
+
+    def basic_publish(self, **kwargs):
+        if not self.is_open:
+            raise pika.exceptions.ConnectionClosed()
+        self.published.append(kwargs)
+
+
+class FakeConnectionPool(ConnectionPool):
+    def _open(self):
+        self.connections_opened += 1
+        return FakePooledChannel()
+
+
+class TestConnectionPool(unittest.TestCase):
+    def test_lazy_and_reused(self):
+        pool = FakeConnectionPool()
+        self.assertEqual(pool.connections_opened, 0)
+
+        for _ in range(5):
+            with pool.channel() as ch:
+                ch.basic_publish(body='x')
+
+        self.assertEqual(pool.connections_opened, 1)
+        self.assertEqual(pool.idle_nr(), 1)
+
+    def test_checkout_is_exclusive(self):
+        pool = FakeConnectionPool()
+
+        ch1 = pool.checkout()
+        ch2 = pool.checkout()
+
+        self.assertIsNot(ch1, ch2)
+        self.assertEqual(pool.size(), 2)
+
+    def test_max_size_blocks(self):
+        pool = FakeConnectionPool(max_size=1)
+        ch = pool.checkout()
+
+        self.assertRaises(Exception, pool.checkout, timeout=0.05)
+        threading.Timer(0.05, pool.checkin, args=(ch,)).start()
+        self.assertIs(pool.checkout(timeout=5), ch)
+
+    def test_broken_channel_replaced(self):
+        pool = FakeConnectionPool()
+        ch = pool.checkout()
+        pool.checkin(ch)
+        ch.connection.is_open = False  # broker dropped the connection
+
+        new_ch = pool.checkout()
+
+        self.assertIsNot(new_ch, ch)
+        self.assertEqual(pool.size(), 1)
+
+    def test_idle_channel_health_checked(self):
+        pool = FakeConnectionPool(heartbeat=0.02)
+        ch = pool.checkout()
+        pool.checkin(ch)
+
+        time.sleep(0.05)
+        self.assertIs(pool.checkout(), ch)
+        self.assertEqual(ch.connection.heartbeats, 1)
+
+    def test_run_reconnects(self):
+        pool = FakeConnectionPool()
+        ch = pool.checkout()
+        pool.checkin(ch)
+        calls = []
+
+        def publish(channel):
+            calls.append(channel)
+            if channel is ch:
+                raise pika.exceptions.ConnectionClosed()
+            channel.basic_publish(body='x')
+
+        pool.run(publish)
+
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(len(calls[1].published), 1)
+        self.assertEqual(pool.connections_opened, 2)
+        self.assertEqual(pool.size(), 1)
+
+    def test_close(self):
+        pool = FakeConnectionPool()
+        ch = pool.checkout()
+        pool.checkin(ch)
+
+        pool.close()
+
+        self.assertFalse(ch.is_open)
+        self.assertEqual(pool.size(), 0)
+        self.assertRaises(Exception, pool.checkout)
+
+
+class FakeDeclaringChannel:
+    """ records declarations. passive declares of names not in existing close the channel.
+    """
+    def __init__(self, connection=None, existing=()):
+        self.connection = connection or FakePooledConnection()
+        self.existing = set(existing)
+        self.calls = []
+        self.channels_opened = 0
+        self.connection.channel = self._new_channel
+
+    def _new_channel(self):
+        self.channels_opened += 1
+        return self
+
+    def exchange_declare(self, exchange, type, passive=False, durable=False, arguments=None):
+        self.calls.append(('exchange', exchange, passive))
+        self.durable = durable
+        self.exchange_arguments = arguments
+        if passive and exchange not in self.existing:
+            raise pika.exceptions.ChannelClosed(404, 'NOT_FOUND')
+
+    def queue_declare(self, queue, passive=False, arguments=None, durable=False):
+        self.calls.append(('queue', queue, passive))
+        self.arguments = arguments
+        self.durable = durable
+        if passive and queue not in self.existing:
+            raise pika.exceptions.ChannelClosed(404, 'NOT_FOUND')
+
+    def queue_bind(self, exchange, queue, routing_key=''):
+        self.calls.append(('bind', queue, routing_key))
+
+
+class TestDeclarationCache(unittest.TestCase):
+    def setUp(self):
+        declaration_cache.clear()
+
+    def test_declares_once_per_connection(self):
+        ch = FakeDeclaringChannel()
+
+        for _ in range(10):
+            declare_and_bind(ch, 'dest', routing_key='#')
+
+        self.assertEqual(len(ch.calls), 3)
+        self.assertEqual(declaration_cache.stats(), {'declares_sent': 3, 'declares_skipped': 27})
+        self.assertEqual(ch.arguments, {'x-max-priority': MAX_PRIORITY})
+        self.assertFalse(ch.durable)
+
+    def test_durable(self):
+        ch = FakeDeclaringChannel()
+
+        declare_and_bind(ch, 'dest', durable=True)
+
+        self.assertTrue(ch.durable)
+
+    def test_new_connection_declares_again(self):
+        declare_and_bind(FakeDeclaringChannel(), 'dest')
+        ch = FakeDeclaringChannel()
+
+        declare_and_bind(ch, 'dest')
+
+        self.assertEqual(len(ch.calls), 3)
+
+    def test_invalidate(self):
+        ch = FakeDeclaringChannel()
+        declare_and_bind(ch, 'dest')
+
+        declaration_cache.invalidate(ch.connection)
+        declare_and_bind(ch, 'dest')
+
+        self.assertEqual(len(ch.calls), 6)
+
+    def test_passive_existing(self):
+        ch = FakeDeclaringChannel(existing=('dest',))
+
+        declare_and_bind(ch, 'dest', passive=True)
+
+        self.assertEqual(ch.calls, [('exchange', 'dest', True), ('queue', 'dest', True),
+                                    ('bind', 'dest', '')])
+
+    def test_passive_missing_declares(self):
+        ch = FakeDeclaringChannel()
+
+        new_ch = declare_and_bind(ch, 'dest', passive=True)
+
+        self.assertEqual(ch.channels_opened, 1)
+        self.assertIs(new_ch, ch)
+        self.assertEqual(ch.calls, [('exchange', 'dest', True), ('exchange', 'dest', False),
+                                    ('queue', 'dest', False), ('bind', 'dest', '')])
+
+
+class TestPriorityQueueDeclare(unittest.TestCase):
+    def setUp(self):
+        self.transport = InMemoryTransport(MemoryBroker())
+        self.transport.broker.queue_declare('old')  # by an older version, without priority
+
+    def tearDown(self):
+        non_priority_queues.discard('old')
+
+    def test_priority_queue(self):
+        connect_and_declare(destinations=['new'], transport=self.transport)
+
+        self.assertEqual(self.transport.broker.queues['new'].max_priority, MAX_PRIORITY)
+        self.assertNotIn('new', non_priority_queues)
+
+    def test_queue_without_priority_used_as_it_is(self):
+        ch = connect_and_declare(destinations=['old'], transport=self.transport)
+
+        self.assertTrue(ch.is_open)
+        self.assertIn('old', non_priority_queues)
+        self.assertIn(('old', '#'), self.transport.broker.exchanges['old'].bindings)
+
+        ch = connect_and_declare(destinations=['old'], transport=self.transport)
+        declaration_cache.invalidate(ch.connection)
+
+        self.assertIs(declare_and_bind(ch, 'old'), ch)  # no longer refused: channel kept
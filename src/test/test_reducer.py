@@ -0,0 +1,121 @@
+import shutil
+import tempfile
+import threading
+import unittest
+
+from bashtasks import message
+from bashtasks.codec import get_codec
+from bashtasks.constants import TASK_RESPONSES_POOL
+from bashtasks.memory_broker import MemoryBroker
+from bashtasks.output_capture import get_chunk_msg
+from bashtasks.rabbit_util import connect_and_declare
+from bashtasks.reducer import StreamingReducer, is_error
+from bashtasks.spill import SpillWriter, read_spill
+from bashtasks.task_response_subscriber import init_subscriber
+from bashtasks.transport import InMemoryTransport
+
+
+def get_response(correlation_id, job_id, returncode=0):
+    return {'correlation_id': correlation_id, 'job_id': job_id, 'request_ts': 10,
+            'pre_command_ts': 20, 'post_command_ts': 20 + correlation_id,
+            'returncode': returncode, 'executor_name': 'exec1', 'command': ['echo']}
+
+
+class TestReducer(unittest.TestCase):
+    def test_fold_summary_per_job(self):
+        reducer = StreamingReducer()
+        for i in range(5):
+            reducer.add(get_response(i, 'a', returncode=i % 2))
+        reducer.add(get_response(9, 'b'))
+
+        summary = reducer.result('a')
+        self.assertEqual(summary['count'], 5)
+        self.assertEqual(summary['errors'], 2)
+        self.assertEqual(summary['returncodes'], {0: 3, 1: 2})
+        self.assertEqual(summary['first_request_ts'], 10)
+        self.assertEqual(summary['last_post_command_ts'], 24)
+        self.assertEqual(summary['max_execution_ms'], 4)
+        self.assertEqual(reducer.result('b')['count'], 1)
+        self.assertEqual(reducer.responses_nr, 6)
+
+    def test_custom_fold(self):
+        def add_ids(total, response):
+            return total + response['correlation_id']
+        reducer = StreamingReducer(fold=add_ids, initial=int)
+        for i in range(4):
+            reducer.add(get_response(i, 'sum'))
+
+        self.assertEqual(reducer.pop('sum'), 6)
+        self.assertEqual(reducer.results(), {})
+
+    def test_batch_folded_per_command_and_chunks_skipped(self):
+        batch = message.get_batch_request([['true'], ['false']], job_id='batch')
+        batch.update(pre_command_ts=1, post_command_ts=2, returncode=1, executor_name='e',
+                     batch=[{'command': ['true'], 'returncode': 0},
+                            {'command': ['false'], 'returncode': 1}])
+        reducer = StreamingReducer()
+
+        reducer.add(batch)
+        reducer.add(get_chunk_msg(batch, 'stdout', 0, 'x', 'e'))
+
+        self.assertEqual(reducer.result('batch')['count'], 2)
+        self.assertEqual(reducer.result('batch')['errors'], 1)
+
+    def test_spill_filter(self):
+        directory = tempfile.mkdtemp()
+        try:
+            spill = SpillWriter(directory)
+            reducer = StreamingReducer(spill=spill, spill_filter=is_error)
+            reducer.add(get_response(1, 'a'))
+            reducer.add(get_response(2, 'a', returncode=3))
+            spill.close()
+
+            self.assertEqual([r['correlation_id'] for r in read_spill(directory, 'responses')],
+                             [2])
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestSubscriberReduce(unittest.TestCase):
+    def setUp(self):
+        self.transport = InMemoryTransport(MemoryBroker())
+        self.ch = connect_and_declare(transport=self.transport)
+        codec = get_codec()
+        for i in range(50):
+            body, content_encoding = codec.encode(get_response(i, 'job' + str(i % 2)))
+            self.ch.basic_publish(exchange=TASK_RESPONSES_POOL, routing_key='', body=body,
+                                  properties=codec.properties(content_encoding))
+
+    def test_reduce_acks_in_batches(self):
+        subscriber = init_subscriber(transport=self.transport, prefetch=20)
+        acks = []
+
+        class CountingReducer(StreamingReducer):
+            def flush(self):
+                acks.append(self.responses_nr)
+                if self.responses_nr == 50:
+                    subscriber.stop()
+
+        reducer = subscriber.reduce(CountingReducer())
+
+        self.assertEqual(reducer.result('job0')['count'], 25)
+        self.assertEqual(reducer.result('job1')['count'], 25)
+        self.assertEqual(acks, [10, 20, 30, 40, 50])
+        queue = self.transport.broker.queues[TASK_RESPONSES_POOL]
+        self.assertEqual(queue.size(), 0)
+
+    def test_stop_acks_responses_folded(self):
+        subscriber = init_subscriber(transport=self.transport, prefetch=100)
+        threading.Timer(0.2, subscriber.stop).start()
+
+        reducer = subscriber.reduce(StreamingReducer(), ack_every=1000, ack_interval=60)
+
+        self.assertEqual(reducer.responses_nr, 50)
+        self.assertEqual(self.transport.broker.queues[TASK_RESPONSES_POOL].size(), 0)
+        ch = connect_and_declare(transport=self.transport)
+        self.assertEqual(ch.queue_declare(queue=TASK_RESPONSES_POOL,
+                                          passive=True).method.message_count, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import unittest
+import threading
+
+from bashtasks.response_demux import ResponseDemultiplexer, ResponseFuture
+from bashtasks.message import get_request
+
+
+class TestResponseDemultiplexer(unittest.TestCase):
+    def setUp(self):
+        self.demux = ResponseDemultiplexer()
+
+    def test_dispatch_to_expecting_caller(self):
+        msg = get_request(['ls'])
+        future = self.demux.expect(msg['correlation_id'])
+
+        dispatched = self.demux.dispatch(msg)
+
+        self.assertTrue(dispatched)
+        self.assertTrue(future.done())
+        self.assertEqual(future.response(), msg)
+        self.assertEqual(self.demux.pending_nr(), 0)
+
+    def test_dispatch_routes_by_correlation_id(self):
+        msg_one = get_request(['ls'])
+        msg_two = get_request(['ps'])
+        future_one = self.demux.expect(msg_one['correlation_id'])
+        future_two = self.demux.expect(msg_two['correlation_id'])
+
+        self.demux.dispatch(msg_two)
+
+        self.assertFalse(future_one.done())
+        self.assertEqual(future_two.response()['command'], ['ps'])
+
+    def test_dispatch_unexpected_response_is_discarded(self):
+        dispatched = self.demux.dispatch(get_request(['ls']))
+
+        self.assertFalse(dispatched)
+
+    def test_forget(self):
+        msg = get_request(['ls'])
+        future = self.demux.expect(msg['correlation_id'])
+
+        self.demux.forget(msg['correlation_id'])
+
+        self.assertFalse(self.demux.dispatch(msg))
+        self.assertFalse(future.done())
+
+    def test_concurrent_waiters(self):
+        msgs = [get_request(['echo', str(i)]) for i in range(200)]
+        futures = [self.demux.expect(msg['correlation_id']) for msg in msgs]
+        results = {}
+
+        def wait_for(future):
+            if future.wait(5):
+                results[future.correlation_id] = future.response()
+
+        waiters = [threading.Thread(target=wait_for, args=(future,)) for future in futures]
+        for waiter in waiters:
+            waiter.start()
+        for msg in reversed(msgs):
+            self.demux.dispatch(msg)
+        for waiter in waiters:
+            waiter.join()
+
+        self.assertEqual(len(results), len(msgs))
+        for msg in msgs:
+            self.assertEqual(results[msg['correlation_id']]['command'], msg['command'])
+
+
+class TestResponseFuture(unittest.TestCase):
+    def test_wait_timeout(self):
+        future = ResponseFuture(1)
+
+        self.assertFalse(future.wait(0.01))
+        self.assertIsNone(future.response())
+
+
+class TestResponseDemultiplexerChunks(unittest.TestCase):
+    def test_chunks_are_joined_into_response(self):
+        demux = ResponseDemultiplexer()
+        msg = get_request(['ls'], output_policy='chunks')
+        future = demux.expect(msg['correlation_id'])
+        chunk = {'chunk': True, 'correlation_id': msg['correlation_id'], 'retries': 0,
+                 'stream': 'stdout', 'chunk_seq': 0, 'data': 'hello', 'executor_name': 'e'}
+
+        demux.dispatch(chunk)
+        self.assertFalse(future.done())
+
+        response = dict(msg, stdout='', stdout_chunks=1, stderr='', retries=0)
+        demux.dispatch(response)
+
+        self.assertEqual(future.response()['stdout'], 'hello')
@@ -0,0 +1,128 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import responses_recvr
+from bashtasks.spill import read_spill
+from bashtasks.TaskStatistics import ShardedTaskStatistics
+
+
+class FakeResponse:
+    def __init__(self, msg, acks):
+        self.msg = msg
+        self.acks = acks
+
+    def decode(self):
+        return self.msg
+
+    def ack(self):
+        self.acks.append(self.msg['correlation_id'])
+
+
+class FakeSubscriber:
+    """ delivers responses from a shared list until stopped.
+    """
+    def __init__(self, responses, lock, acks):
+        self.responses = responses
+        self.lock = lock
+        self.acks = acks
+        self.stopped = False
+
+    def subscribe(self, callback):
+        while not self.stopped:
+            with self.lock:
+                msg = self.responses.pop() if self.responses else None
+            if msg is None:
+                return
+            callback(FakeResponse(msg, self.acks))
+
+    def stop(self):
+        self.stopped = True
+
+
+def get_response(i):
+    return {'correlation_id': i, 'request_ts': 1, 'pre_command_ts': 2, 'post_command_ts': 3,
+            'returncode': 0, 'executor_name': 'exec1', 'command': ['echo']}
+
+
+class TestResponsesRecvr(unittest.TestCase):
+    def tearDown(self):
+        responses_recvr.set_msgs_to_process(0)
+
+    def test_workers_stop_after_msgs_to_process(self):
+        responses = [get_response(i) for i in range(200)]
+        lock = threading.Lock()
+        acks = []
+        stats = ShardedTaskStatistics()
+        responses_recvr.set_msgs_to_process(150)
+
+        workers = []
+        for _ in range(4):
+            subscriber = FakeSubscriber(responses, lock, acks)
+            worker = threading.Thread(target=responses_recvr.start_responses_recvr,
+                                      kwargs=dict(stats=stats, subscriber=subscriber))
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join(5)
+
+        self.assertTrue(responses_recvr.all_processed.is_set())
+        self.assertEqual(responses_recvr.get_pending_nr(), 0)
+        self.assertEqual(len(acks), 150)
+        self.assertEqual(stats.msgsNumber(), 150)
+
+    def test_msgs_spill(self):
+        msgs_dir = tempfile.mkdtemp()
+        try:
+            responses = [get_response(i) for i in range(30)]
+            responses[0]['returncode'] = 1
+            spill = responses_recvr.get_msgs_spill(msgs_dir)
+            subscriber = FakeSubscriber(responses, threading.Lock(), [])
+
+            responses_recvr.start_responses_recvr(stats=ShardedTaskStatistics(),
+                                                  subscriber=subscriber, msgs_dir=msgs_dir,
+                                                  trace_err_only=True, msgs_spill=spill)
+            spill.close()
+
+            self.assertEqual([msg['correlation_id'] for msg in read_spill(msgs_dir, 'msgs')],
+                             [0])
+            self.assertEqual(len(os.listdir(msgs_dir)), 1)
+        finally:
+            shutil.rmtree(msgs_dir)
+
+    def test_msgs_file_per_msg(self):
+        msgs_dir = tempfile.mkdtemp()
+        try:
+            self.assertIsNone(responses_recvr.get_msgs_spill(msgs_dir, file_per_msg=True))
+            subscriber = FakeSubscriber([get_response(i) for i in range(3)], threading.Lock(), [])
+
+            responses_recvr.start_responses_recvr(stats=ShardedTaskStatistics(),
+                                                  subscriber=subscriber, msgs_dir=msgs_dir)
+
+            self.assertEqual(len(os.listdir(msgs_dir)), 3)
+        finally:
+            shutil.rmtree(msgs_dir)
+
+    def test_metrics(self):
+        received = responses_recvr.responses_received.get()
+        failed = responses_recvr.responses_failed.get(labels=(2, ))
+        response = get_response(1)
+        response['returncode'] = 2
+
+        responses_recvr.observe_response(response)
+
+        self.assertEqual(responses_recvr.responses_received.get(), received + 1)
+        self.assertEqual(responses_recvr.responses_failed.get(labels=(2, )), failed + 1)
+
+    def test_infinite(self):
+        responses_recvr.set_msgs_to_process(0)
+
+        self.assertTrue(responses_recvr.claim_message())
+        self.assertEqual(responses_recvr.get_pending_nr(), -1)
+        self.assertFalse(responses_recvr.all_processed.is_set())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,175 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import bashtasks
+from bashtasks import executor
+from bashtasks.local_executor import LocalExecutors
+from bashtasks.memory_broker import MemoryBroker
+from bashtasks.message import get_request
+from bashtasks.result_cache import ResultCache, get_cache_key, get_result
+from bashtasks.task_response_subscriber import init_subscriber
+from bashtasks.transport import InMemoryTransport
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_cache_key(self):
+        md5 = get_request(['md5sum', 'a.wav'], cacheable=True)
+
+        self.assertEqual(get_cache_key(md5), get_cache_key(get_request(['md5sum', 'a.wav'])))
+        self.assertNotEqual(get_cache_key(md5), get_cache_key(get_request(['md5sum', 'b.wav'])))
+        self.assertNotEqual(get_cache_key(md5),
+                            get_cache_key(get_request(['md5sum', 'a.wav'], fingerprint='v2')))
+
+    def test_cache_key_output_policy(self):
+        md5 = get_request(['md5sum', 'a.wav'], cacheable=True)
+        key = get_cache_key(md5, output_policy='truncate', output_cap=100)
+
+        self.assertEqual(key, get_cache_key(get_request(['md5sum', 'a.wav'], output_cap=100),
+                                            output_policy='truncate', output_cap=1000))
+        self.assertNotEqual(key, get_cache_key(md5, output_policy='file', output_cap=100))
+        self.assertNotEqual(key, get_cache_key(md5, output_policy='truncate', output_cap=10))
+        self.assertNotEqual(key, get_cache_key(get_request(['md5sum', 'a.wav'],
+                                                           output_policy='file'),
+                                               output_policy='truncate', output_cap=100))
+
+    def test_get_result(self):
+        response = get_request(['ls'])
+        response.update(returncode=0, stdout='x', stderr='', stdout_truncated=3)
+
+        self.assertEqual(get_result(response), {'returncode': 0, 'stdout': 'x', 'stderr': '',
+                                                'stdout_truncated': 3})
+
+    def test_put_get(self):
+        cache = ResultCache()
+        cache.put('k', {'returncode': 0})
+
+        self.assertEqual(cache.get('k'), {'returncode': 0})
+        self.assertIsNone(cache.get('other'))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_ttl(self):
+        cache = ResultCache()
+        cache.put('k', {'returncode': 0}, ttl=0.01)
+
+        time.sleep(0.02)
+
+        self.assertIsNone(cache.get('k'))
+
+    def test_lru_eviction(self):
+        cache = ResultCache(max_entries=2)
+        cache.put('a', {'returncode': 0})
+        cache.put('b', {'returncode': 0})
+        cache.get('a')
+
+        cache.put('c', {'returncode': 0})
+
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertEqual(cache.size(), 2)
+
+    def test_store_dir(self):
+        ResultCache(store_dir=self.dir).put('k', {'returncode': 0, 'stdout': 'x'})
+
+        restarted = ResultCache(store_dir=self.dir)
+
+        self.assertEqual(restarted.get('k'), {'returncode': 0, 'stdout': 'x'})
+        self.assertEqual(restarted.size(), 1)
+
+
+class TestExecutorResultCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.runs_path = os.path.join(self.dir, 'runs')
+        self.transport = InMemoryTransport(MemoryBroker())
+        self.client = bashtasks.init(transport=self.transport)
+
+    def tearDown(self):
+        bashtasks.reset()
+        shutil.rmtree(self.dir)
+
+    def start_executor(self, tasks_nr):
+        executor.stop = False
+        del executor.channels[:]
+        executor_th = threading.Thread(target=executor.start_executor,
+                                       kwargs={'tasks_nr': tasks_nr, 'slots': 4,
+                                               'transport': self.transport})
+        executor_th.daemon = True
+        executor_th.start()
+        return executor_th
+
+    def command(self, returncode):
+        """ :return: command recording its runs, slow enough for duplicates to arrive meanwhile.
+        """
+        return ['sh', '-c', 'echo run >> {}; sleep 0.3; exit {}'.format(self.runs_path,
+                                                                       returncode)]
+
+    def runs(self):
+        if not os.path.exists(self.runs_path):
+            return 0
+        with open(self.runs_path) as runs_file:
+            return len(runs_file.readlines())
+
+    def post_duplicates(self, command, tasks):
+        """ :return: responses of tasks identical cacheable tasks of command.
+        """
+        for i in range(tasks):
+            self.client.post_task(command, cacheable=True)
+        subscriber = init_subscriber(transport=self.transport, prefetch=tasks)
+        responses = []
+
+        def on_response(msg):
+            responses.append(msg.decode())
+            msg.ack()
+            if len(responses) == tasks:
+                subscriber.stop()
+
+        subscriber.subscribe(on_response)
+        return responses
+
+    def execute_duplicates(self, command, tasks):
+        executor_th = self.start_executor(tasks_nr=tasks)
+        responses = self.post_duplicates(command, tasks)
+        executor_th.join(10)
+        self.assertFalse(executor_th.is_alive())
+        return responses
+
+    def test_duplicates_run_once(self):
+        responses = self.execute_duplicates(self.command(0), 4)
+
+        self.assertEqual(self.runs(), 1)
+        self.assertEqual([response['returncode'] for response in responses], [0] * 4)
+        self.assertEqual(len([response for response in responses if response.get('cached')]),
+                         3)
+
+    def test_duplicates_run_once_by_workers(self):
+        workers = LocalExecutors(workers=2, transport=self.transport).start()
+        try:
+            responses = self.post_duplicates(self.command(0), 4)
+        finally:
+            workers.stop()
+
+        self.assertEqual(self.runs(), 1)
+        self.assertEqual(len([response for response in responses if response.get('cached')]),
+                         3)
+        self.assertEqual(len(set(response['executor_name'] for response in responses)), 2)
+
+    def test_duplicates_run_on_their_own_if_leader_fails(self):
+        responses = self.execute_duplicates(self.command(1), 3)
+
+        self.assertEqual(self.runs(), 3)
+        self.assertEqual([response['returncode'] for response in responses], [1] * 3)
+        self.assertFalse([response for response in responses if response.get('cached')])
+
+
+if __name__ == '__main__':
+    unittest.main()
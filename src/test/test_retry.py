@@ -0,0 +1,57 @@
+import unittest
+
+from bashtasks.rabbit_util import declaration_cache
+from bashtasks.retry import FIXED, EXPONENTIAL, JITTER
+from bashtasks.retry import get_retry_delay, quantize_delay, declare_delay_queue
+from test.fakes import FakeChannel
+
+
+class TestRetry(unittest.TestCase):
+    def test_fixed(self):
+        self.assertEqual(get_retry_delay(FIXED, 0, 500), 500)
+        self.assertEqual(get_retry_delay(FIXED, 5, 500), 500)
+
+    def test_exponential(self):
+        delays = [get_retry_delay(EXPONENTIAL, retries, 1000) for retries in range(4)]
+
+        self.assertEqual(delays, [1000, 2000, 4000, 8000])
+
+    def test_exponential_max_delay(self):
+        self.assertEqual(get_retry_delay(EXPONENTIAL, 100, 1000, retry_max_delay=60000), 60000)
+
+    def test_jitter(self):
+        self.assertEqual(get_retry_delay(JITTER, 3, 1000, rand=lambda: 0.5), 4000)
+        self.assertEqual(get_retry_delay(JITTER, 3, 1000, rand=lambda: 0), 0)
+
+    def test_quantize_delay(self):
+        self.assertEqual(quantize_delay(0), 0)
+        self.assertEqual(quantize_delay(1000), 1000)
+        self.assertEqual(quantize_delay(1234), 2000)
+        self.assertEqual(quantize_delay(87000), 90000)
+
+    def test_declare_delay_queue_once(self):
+        declaration_cache.clear()
+        ch = FakeChannel()
+
+        for _ in range(3):
+            name = declare_delay_queue(ch, 'bashtasks:pool:requests', 2000)
+
+        self.assertEqual(name, 'bashtasks:pool:requests:retry:2000ms')
+        self.assertEqual(ch.declared, [(name, {'x-message-ttl': 2000,
+                                               'x-dead-letter-exchange': 'bashtasks:pool:requests'})])
+
+    def test_declare_routed_delay_queue(self):
+        declaration_cache.clear()
+        ch = FakeChannel()
+        ch.exchange_declare = lambda exchange, type, arguments: None
+
+        name = declare_delay_queue(ch, 'bashtasks:pool:requests', 2000, 'gpu.mem.high')
+
+        self.assertEqual(name, 'bashtasks:pool:requests:retry:2000ms:gpu.mem.high')
+        self.assertEqual(ch.declared, [(name, {
+            'x-message-ttl': 2000, 'x-dead-letter-exchange': 'bashtasks:pool:requests:routed',
+            'x-dead-letter-routing-key': 'gpu.mem.high'})])
+
+
+if __name__ == '__main__':
+    unittest.main()
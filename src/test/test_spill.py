@@ -0,0 +1,65 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from bashtasks.spill import SpillWriter, get_segments, read_spill
+
+
+class TestSpill(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_write_and_read(self):
+        spill = SpillWriter(self.directory, prefix='msgs')
+        for i in range(10):
+            spill.write({'correlation_id': i, 'stdout': u'caf\xe9'})
+        spill.close()
+
+        records = list(read_spill(self.directory, 'msgs'))
+
+        self.assertEqual([record['correlation_id'] for record in records], list(range(10)))
+        self.assertEqual(records[0]['stdout'], u'caf\xe9')
+        self.assertEqual(spill.records_written, 10)
+
+    def test_segments(self):
+        spill = SpillWriter(self.directory, prefix='msgs', segment_bytes=100)
+        for i in range(20):
+            spill.write({'correlation_id': i, 'stdout': 'x' * 30})
+        spill.close()
+
+        segments = get_segments(self.directory, 'msgs')
+
+        self.assertGreater(len(segments), 5)
+        self.assertLess(len(segments), 20)
+        self.assertEqual([segment for segment, path in segments], list(range(len(segments))))
+        self.assertEqual(len(list(read_spill(self.directory, 'msgs'))), 20)
+
+    def test_append_only(self):
+        first = SpillWriter(self.directory, prefix='msgs')
+        first.write({'correlation_id': 1})
+        first.close()
+        second = SpillWriter(self.directory, prefix='msgs')
+        second.write({'correlation_id': 2})
+        second.close()
+
+        self.assertEqual(len(get_segments(self.directory, 'msgs')), 2)
+        self.assertEqual([record['correlation_id'] for record in
+                          read_spill(self.directory, 'msgs')], [1, 2])
+
+    def test_other_prefixes_are_ignored(self):
+        with open(os.path.join(self.directory, 'other.000000.jsonl'), 'w') as other:
+            other.write('{"correlation_id": 3}\n')
+        spill = SpillWriter(self.directory, prefix='msgs')
+        spill.write({'correlation_id': 1})
+        spill.flush()
+
+        self.assertEqual(list(read_spill(self.directory, 'msgs')), [{'correlation_id': 1}])
+        spill.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
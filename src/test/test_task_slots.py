@@ -0,0 +1,59 @@
+import unittest
+import time
+import threading
+
+from bashtasks.task_slots import TaskSlots
+
+
+def wait_drained(task_slots, complete, expected, timeout=5):
+    completed = 0
+    start = time.time()
+    while completed < expected and time.time() - start < timeout:
+        completed += task_slots.drain(complete, timeout=0.05)
+    return completed
+
+
+class TestTaskSlots(unittest.TestCase):
+    def test_results_are_drained_with_their_context(self):
+        task_slots = TaskSlots(2, lambda msg: msg * 2)
+        results = {}
+
+        for i in range(10):
+            task_slots.submit('ctx' + str(i), i)
+        completed = wait_drained(task_slots, lambda ctx, msg, result: results.update({ctx: result}),
+                                 10)
+        task_slots.stop()
+
+        self.assertEqual(completed, 10)
+        self.assertEqual(results['ctx7'], 14)
+        self.assertEqual(task_slots.busy_nr(), 0)
+
+    def test_tasks_run_concurrently(self):
+        running = []
+        max_running = []
+        lock = threading.Lock()
+
+        def run(msg):
+            with lock:
+                running.append(msg)
+                max_running.append(len(running))
+            time.sleep(0.1)
+            with lock:
+                running.remove(msg)
+            return msg
+
+        task_slots = TaskSlots(4, run)
+        start = time.time()
+        for i in range(4):
+            task_slots.submit(None, i)
+        wait_drained(task_slots, lambda ctx, msg, result: None, 4)
+        task_slots.stop()
+
+        self.assertEqual(max(max_running), 4)
+        self.assertLess(time.time() - start, 0.35)
+
+    def test_drain_without_results(self):
+        task_slots = TaskSlots(1, lambda msg: msg)
+
+        self.assertEqual(task_slots.drain(lambda ctx, msg, result: None), 0)
+        task_slots.stop()
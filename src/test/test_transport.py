@@ -0,0 +1,84 @@
+import threading
+import unittest
+
+import bashtasks
+from bashtasks import executor
+from bashtasks.constants import TASK_RESPONSES_POOL
+from bashtasks.memory_broker import MemoryBroker, MemoryConnection
+from bashtasks.rabbit_util import ConnectionPool, connect_and_declare
+from bashtasks.task_response_subscriber import init_subscriber
+from bashtasks.transport import get_transport, InMemoryTransport, PikaTransport, MEMORY, PIKA
+
+
+class TestTransport(unittest.TestCase):
+    def setUp(self):
+        self.transport = InMemoryTransport(MemoryBroker())
+
+    def tearDown(self):
+        bashtasks.reset()
+
+    def start_executor(self, tasks_nr):
+        executor.stop = False
+        del executor.channels[:]
+        executor_th = threading.Thread(target=executor.start_executor,
+                                       kwargs={'tasks_nr': tasks_nr, 'transport': self.transport})
+        executor_th.daemon = True
+        executor_th.start()
+        return executor_th
+
+    def test_get_transport(self):
+        self.assertIsInstance(get_transport(), PikaTransport)
+        self.assertIsInstance(get_transport(PIKA), PikaTransport)
+        self.assertIsInstance(get_transport(MEMORY), InMemoryTransport)
+        self.assertIs(get_transport(self.transport), self.transport)
+        self.assertRaises(ValueError, get_transport, 'carrier-pigeon')
+
+    def test_connect_and_declare(self):
+        ch = connect_and_declare(transport=self.transport)
+
+        self.assertIsInstance(ch.connection, MemoryConnection)
+        self.assertIn(TASK_RESPONSES_POOL, self.transport.broker.queues)
+
+    def test_execute_task_in_memory(self):
+        executor_th = self.start_executor(tasks_nr=1)
+        client = bashtasks.init(transport=self.transport)
+
+        response = client.execute_task(['echo', 'in memory'], timeout=10)
+
+        self.assertEqual(response['returncode'], 0)
+        self.assertEqual(response['stdout'].strip(), 'in memory')
+        executor_th.join(5)
+        self.assertFalse(executor_th.is_alive())
+
+    def test_subscriber_requeue(self):
+        executor_th = self.start_executor(tasks_nr=1)
+        bashtasks.init(transport=self.transport).post_task(['true'])
+        subscriber = init_subscriber(transport=self.transport)
+        received = []
+
+        def on_response(msg):
+            received.append(msg.decode())
+            if len(received) == 1:
+                msg.requeue()
+            else:
+                msg.ack()
+                subscriber.stop()
+
+        subscriber.subscribe(on_response)
+
+        self.assertEqual([msg['correlation_id'] for msg in received],
+                         [received[0]['correlation_id']] * 2)
+        executor_th.join(5)
+
+    def test_connection_pool(self):
+        pool = ConnectionPool(destinations=['tasks'], transport=self.transport)
+
+        pool.run(lambda ch: ch.basic_publish(exchange='tasks', routing_key='', body='task'))
+
+        self.assertEqual(pool.connections_opened, 1)
+        self.assertEqual(self.transport.broker.queues['tasks'].size(), 1)
+        pool.close()
+
+
+if __name__ == '__main__':
+    unittest.main()